@@ -0,0 +1,146 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Database methods exposed by AsyncDatabase, split by the executor they run on.
+# Reads run in parallel on the reader pool, writes are serialized on one thread
+# so they queue in Python instead of contending for SQLite's write lock.
+READ_METHODS = frozenset({
+    'get_user',
+    'find_user_by_username',
+    'get_debt',
+    'get_user_debts',
+    'get_debts_i_owe',
+    'get_debts_owed_to_me',
+    'get_history',
+    'get_history_page',
+    'get_debt_balance',
+    'get_debt_balances',
+    'check_paid_totals',
+    'get_pair_balances',
+    'get_pair_balances_among',
+    'check_pair_balances',
+    'get_unread_notifications',
+    'get_cached_parse',
+    'get_cached_transcript',
+    'transcript_cache_stats',
+    'get_user_circles',
+    'get_circle_members',
+    'find_circle_member',
+    'search_member_by_name',
+    'find_circle_by_members',
+    'explain',
+    'check_query_plans',
+    'stats',
+})
+WRITE_METHODS = frozenset({
+    'create_user',
+    'link_pending_debts',
+    'create_debt',
+    'confirm_debt',
+    'create_group_expense',
+    'add_payment',
+    'link_debt_to_user',
+    'confirm_payment',
+    'backfill_paid_totals',
+    'rebuild_pair_balances',
+    'cancel_debt',
+    'create_notification',
+    'mark_notification_read',
+    'enqueue_message',
+    'claim_outbox',
+    'complete_outbox',
+    'retry_outbox',
+    'drop_outbox',
+    'save_cached_parse',
+    'prune_parse_cache',
+    'record_transcript_hit',
+    'save_transcript',
+    'save_conversation_state',
+    'delete_conversation_state',
+    'load_conversation_state',
+    'create_circle',
+    'add_member_to_circle',
+    'rebuild_name_index',
+    'ensure_user_by_username',
+})
+MAX_PENDING_CALLS = 256
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Background database write failed: {future.exception()}")
+
+
+class AsyncDatabase:
+    """Awaitable facade mirroring the Database API.
+
+    Every Database method listed in READ_METHODS / WRITE_METHODS is available
+    under the same name as a coroutine, e.g. ``await db.get_debt(debt_id)``.
+    """
+
+    def __init__(self, db, readers=None, max_pending=MAX_PENDING_CALLS):
+        self.db = db
+        self._read_executor = ThreadPoolExecutor(
+            max_workers=readers or db.pool_size, thread_name_prefix='db-read'
+        )
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+        # Bound the work handed to each executor so a burst applies backpressure
+        # to the handlers instead of growing the executor queue without limit
+        self._read_slots = asyncio.Semaphore(max_pending)
+        self._write_slots = asyncio.Semaphore(max_pending)
+
+    async def run_read(self, fn, *args, **kwargs):
+        """Run a callable on the reader executor"""
+        async with self._read_slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._read_executor, functools.partial(fn, *args, **kwargs)
+            )
+
+    async def run_write(self, fn, *args, **kwargs):
+        """Run a callable on the single writer thread"""
+        async with self._write_slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._write_executor, functools.partial(fn, *args, **kwargs)
+            )
+
+    def submit_write(self, name, *args, **kwargs):
+        """Queue a write method on the writer thread without waiting for it.
+
+        Writes still run in submission order; failures are logged.
+        """
+        if name not in WRITE_METHODS:
+            raise AttributeError(f"'{name}' is not a write method")
+        future = self._write_executor.submit(getattr(self.db, name), *args, **kwargs)
+        future.add_done_callback(_log_failure)
+        return future
+
+    def __getattr__(self, name):
+        if name in READ_METHODS:
+            runner = self.run_read
+        elif name in WRITE_METHODS:
+            runner = self.run_write
+        else:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+        method = getattr(self.db, name)
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            with metrics.timed('database', name):
+                return await runner(method, *args, **kwargs)
+
+        # Cache so __getattr__ only runs once per method
+        setattr(self, name, call)
+        return call
+
+    def close(self):
+        """Wait for queued calls, then close the underlying connections"""
+        self._write_executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        self.db.close()
@@ -0,0 +1,73 @@
+"""find_circle_by_members for users who own hundreds of circles, per-circle loop vs one query.
+
+The "before" numbers replay the old implementation: one SELECT for the
+user's circles, then one SELECT member_name per circle and a Python set
+overlap, stopping at the first circle with half the names in it. The
+names asked for always come from the user's last circle, the worst case
+for the loop.
+"""
+import argparse
+import os
+import random
+import tempfile
+
+from database import Database
+from benchmarks.common import print_report, summarize, time_calls
+
+CIRCLE_COUNTS = (10, 100, 300, 1000)
+NAMES = ('Murod', 'Alisher', 'Dilnoza', 'Xurshid', 'Jasur', 'Sardor', 'Nodira', 'Gulnora', 'Bekzod', 'Aziz',
+         'Shahzod', 'Madina', 'Kamola', 'Otabek', 'Sanjar', 'Umid', 'Farrux', 'Lola', 'Zarina', 'Timur')
+
+
+def seed_circles(db, user_id, circles, members_per_circle, rng):
+    """Give user_id circles of random members; returns the last circle's names"""
+    db.create_user(user_id, f'user{user_id}', f'User {user_id}', None)
+    members = []
+    for index in range(circles):
+        circle_id = db.create_circle(user_id, f'Circle {index}')
+        members = [f'{name} {rng.randrange(circles)}' for name in rng.sample(NAMES, members_per_circle)]
+        for name in members:
+            db.add_member_to_circle(circle_id, name)
+    return members
+
+
+def legacy_find_circle_by_members(db, user_id, member_names):
+    with db.read() as cursor:
+        cursor.execute('SELECT id FROM user_circles WHERE user_id = ?', (user_id,))
+        for circle in cursor.fetchall():
+            cursor.execute('SELECT member_name FROM circle_members WHERE circle_id = ?', (circle['id'],))
+            circle_members = [m['member_name'] for m in cursor.fetchall()]
+            if len(set(member_names) & set(circle_members)) >= len(member_names) * 0.5:
+                return circle['id']
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--circles', type=int, nargs='+', default=CIRCLE_COUNTS)
+    parser.add_argument('--members-per-circle', type=int, default=6)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    report = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        for user_id, circles in enumerate(args.circles, start=1):
+            names = seed_circles(db, user_id, circles, args.members_per_circle, rng)
+            found = db.find_circle_by_members(user_id, names)
+            report.append({
+                'circles': circles,
+                'members': circles * args.members_per_circle,
+                'same_circle': found is not None and found[0] == legacy_find_circle_by_members(db, user_id, names),
+                'before': summarize(time_calls(lambda: legacy_find_circle_by_members(db, user_id, names),
+                                               args.iterations)),
+                'after': summarize(time_calls(lambda: db.find_circle_by_members(user_id, names), args.iterations)),
+            })
+        db.close()
+    print_report(report)
+
+
+if __name__ == '__main__':
+    main()
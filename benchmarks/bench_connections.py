@@ -0,0 +1,91 @@
+"""Connections opened and latency per list handler, per-call connect vs pool.
+
+The "before" numbers replay the handler's query sequence the way the old
+Database did it: a fresh sqlite3.connect per statement with default pragmas.
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+
+from database import Database
+from benchmarks.common import print_report, seed_debts, summarize, time_calls
+
+I_OWE_SQL = '''
+    SELECT d.*, c.first_name as creditor_first_name, c.username as creditor_db_username
+    FROM debts d
+    LEFT JOIN users c ON d.creditor_id = c.user_id
+    WHERE d.debtor_id = ? AND d.status = 'active'
+    ORDER BY d.created_at DESC
+'''
+BALANCE_SQL = '''
+    SELECT d.amount, COALESCE(SUM(p.amount), 0) as total_paid
+    FROM debts d
+    LEFT JOIN payments p ON d.id = p.debt_id AND p.confirmed = TRUE
+    WHERE d.id = ?
+    GROUP BY d.id
+'''
+
+
+class LegacyConnections:
+    """Open-query-close, exactly like the old Database.get_connection()"""
+
+    def __init__(self, path):
+        self.path = path
+        self.connections_opened = 0
+
+    def query(self, sql, params):
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        self.connections_opened += 1
+        rows = conn.execute(sql, params).fetchall()
+        conn.close()
+        return rows
+
+    def show_i_owe(self, user_id):
+        debts = self.query(I_OWE_SQL, (user_id,))
+        for debt in debts:
+            self.query(BALANCE_SQL, (debt['id'],))
+        for debt in debts[:5]:
+            self.query(BALANCE_SQL, (debt['id'],))
+
+
+def pooled_show_i_owe(db, user_id):
+    debts = db.get_debts_i_owe(user_id)
+    for debt in debts:
+        db.get_debt_balance(debt['id'])
+    for debt in debts[:5]:
+        db.get_debt_balance(debt['id'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--debts-per-user', type=int, default=30)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        db = Database(path)
+        seed_debts(db, debts_per_user=args.debts_per_user)
+
+        legacy = LegacyConnections(path)
+        legacy_samples = time_calls(lambda: legacy.show_i_owe(7), args.iterations)
+
+        pooled_show_i_owe(db, 7)  # warm the pool
+        opened_before = db.connections_opened
+        pooled_samples = time_calls(lambda: pooled_show_i_owe(db, 7), args.iterations)
+        db.close()
+
+        print_report({
+            'handler': 'show_i_owe',
+            'debts_listed': args.debts_per_user,
+            'before': dict(summarize(legacy_samples),
+                           connections_per_handler=legacy.connections_opened / args.iterations),
+            'after': dict(summarize(pooled_samples),
+                          connections_per_handler=(db.connections_opened - opened_before) / args.iterations),
+        })
+
+
+if __name__ == '__main__':
+    main()
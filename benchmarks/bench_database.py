@@ -0,0 +1,545 @@
+"""Latency of every public Database method on synthetic datasets of several sizes.
+
+Each size's dataset (benchmarks/dataset.py) is copied to a scratch file, so
+write methods never touch the cached original. Every case prepares its
+arguments outside the timed region (a fresh payment for confirm_payment, a
+known circle owner for search_member_by_name, ...) and times just the call.
+get_history_page is the query behind DebtBot.show_history.
+
+Maintenance methods that walk whole tables (rebuild_*, check_*) run fewer
+iterations. Every case runs in --repeat rounds, interleaved with the other
+cases, and reports the median of the rounds' statistics: a burst of
+background load then skews one round instead of the result. Public methods with no case are listed under "uncovered", so a
+new method cannot silently go unbenchmarked.
+
+    python -m benchmarks.bench_database --sizes small large --output run.json
+    python -m benchmarks.compare base.json run.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+
+from database import HOT_QUERIES, Database
+from benchmarks import dataset
+from benchmarks.common import print_report, summarize
+
+# Connection and schema plumbing rather than queries
+NOT_BENCHMARKED = {'close', 'read', 'transaction', 'get_connection'}
+WARMUP = 5
+MAINTENANCE_ITERATIONS = 3
+
+CASES = {}  # case name -> (kind, prepare(db, ctx, rng) -> zero-argument call)
+
+
+def case(kind='read', name=None):
+    def register(fn):
+        CASES[name or fn.__name__] = (kind, fn)
+        return fn
+    return register
+
+
+class Context:
+    """Ids and names from the dataset, plus counters for rows the write cases add"""
+
+    def __init__(self, db, counts):
+        self.users = counts['users']
+        self.debts = counts['debts']
+        self.circles = counts['user_circles']
+        with db.read() as cursor:
+            cursor.execute('SELECT owner_user_id, name_latin FROM circle_member_names ORDER BY member_id LIMIT 2000')
+            self.members = [(row[0], row[1]) for row in cursor.fetchall()]
+            cursor.execute('SELECT id FROM notifications WHERE read = FALSE ORDER BY id LIMIT 20000')
+            self.unread = [row[0] for row in cursor.fetchall()]
+        self.next_user = 10_000_000
+        self.next_key = 0
+
+    def user(self, rng):
+        return 1 + min(self.users - 1, int(self.users * rng.random() ** 2))
+
+    def debt(self, rng):
+        return rng.randint(1, self.debts)
+
+    def key(self, prefix):
+        self.next_key += 1
+        return f'{prefix}{self.next_key}'
+
+
+def _new_debt(db, ctx, rng, confirmed=True):
+    creditor = ctx.user(rng)
+    debtor = creditor % ctx.users + 1
+    debt_id = db.create_debt(creditor, creditor, debtor, 100_000, "so'm", 'bench')
+    if confirmed:
+        db.confirm_debt(debt_id, debtor)
+    return debt_id, creditor, debtor
+
+
+# Reads
+
+@case()
+def get_user(db, ctx, rng):
+    user_id = ctx.user(rng)
+    return lambda: db.get_user(user_id)
+
+
+@case()
+def find_user_by_username(db, ctx, rng):
+    username = f'user{ctx.user(rng)}'
+    return lambda: db.find_user_by_username(username)
+
+
+@case()
+def get_debt(db, ctx, rng):
+    debt_id = ctx.debt(rng)
+    return lambda: db.get_debt(debt_id)
+
+
+@case()
+def get_user_debts(db, ctx, rng):
+    user_id = ctx.user(rng)
+    return lambda: db.get_user_debts(user_id)
+
+
+@case()
+def get_debts_i_owe(db, ctx, rng):
+    user_id = ctx.user(rng)
+    return lambda: db.get_debts_i_owe(user_id)
+
+
+@case()
+def get_debts_owed_to_me(db, ctx, rng):
+    user_id = ctx.user(rng)
+    return lambda: db.get_debts_owed_to_me(user_id)
+
+
+@case()
+def get_history(db, ctx, rng):
+    user_id = ctx.user(rng)
+    return lambda: db.get_history(user_id)
+
+
+@case()
+def get_history_page(db, ctx, rng):
+    user_id = ctx.user(rng)
+    return lambda: db.get_history_page(user_id, limit=10)
+
+
+@case(name='get_history_page[older]')
+def get_history_page_older(db, ctx, rng):
+    user_id = ctx.user(rng)
+    cursor = db.get_history_page(user_id, limit=10)['next_cursor']
+    return lambda: db.get_history_page(user_id, cursor=cursor, limit=10)
+
+
+@case()
+def get_debt_balance(db, ctx, rng):
+    debt_id = ctx.debt(rng)
+    return lambda: db.get_debt_balance(debt_id)
+
+
+@case()
+def get_debt_balances(db, ctx, rng):
+    debt_ids = [ctx.debt(rng) for _ in range(20)]
+    return lambda: db.get_debt_balances(debt_ids)
+
+
+@case()
+def get_pair_balances(db, ctx, rng):
+    user_id = ctx.user(rng)
+    return lambda: db.get_pair_balances(user_id)
+
+
+@case()
+def get_pair_balances_among(db, ctx, rng):
+    user_ids = [ctx.user(rng) for _ in range(6)]
+    return lambda: db.get_pair_balances_among(user_ids)
+
+
+@case()
+def get_unread_notifications(db, ctx, rng):
+    user_id = ctx.user(rng)
+    return lambda: db.get_unread_notifications(user_id)
+
+
+@case()
+def get_cached_parse(db, ctx, rng):
+    key = f'parse{rng.randint(1, max(1, ctx.next_key))}'
+    return lambda: db.get_cached_parse(key, 86400)
+
+
+@case()
+def transcript_cache_stats(db, ctx, rng):
+    return db.transcript_cache_stats
+
+
+@case()
+def get_user_circles(db, ctx, rng):
+    owner = rng.choice(ctx.members)[0]
+    return lambda: db.get_user_circles(owner)
+
+
+@case()
+def get_circle_members(db, ctx, rng):
+    circle_id = rng.randint(1, ctx.circles)
+    return lambda: db.get_circle_members(circle_id)
+
+
+@case()
+def find_circle_member(db, ctx, rng):
+    owner, name = rng.choice(ctx.members)
+    return lambda: db.find_circle_member(owner, name)
+
+
+@case()
+def search_member_by_name(db, ctx, rng):
+    owner, name = rng.choice(ctx.members)
+    # Drop a letter so the trigram fallback runs as well as the word match
+    misspelled = name[:2] + name[3:]
+    return lambda: db.search_member_by_name(owner, misspelled)
+
+
+@case()
+def find_circle_by_members(db, ctx, rng):
+    owner = rng.choice(ctx.members)[0]
+    names = [name for member_owner, name in ctx.members if member_owner == owner][:3]
+    return lambda: db.find_circle_by_members(owner, names)
+
+
+@case()
+def explain(db, ctx, rng):
+    return lambda: db.explain(HOT_QUERIES['get_user_debts'])
+
+
+@case()
+def stats(db, ctx, rng):
+    return db.stats
+
+
+@case()
+def load_conversation_state(db, ctx, rng):
+    return lambda: db.load_conversation_state('user_context')
+
+
+# Writes
+
+@case('write')
+def create_user(db, ctx, rng):
+    ctx.next_user += 1
+    user_id = ctx.next_user
+    return lambda: db.create_user(user_id, f'bench{user_id}', 'Bench', None)
+
+
+@case('write')
+def ensure_user_by_username(db, ctx, rng):
+    username = ctx.key('placeholder')
+    return lambda: db.ensure_user_by_username(username, 'Placeholder')
+
+
+@case('write')
+def link_pending_debts(db, ctx, rng):
+    ctx.next_user += 1
+    user_id = ctx.next_user
+    username = f'bench{user_id}'
+    creditor = ctx.user(rng)
+    db.create_debt(creditor, creditor, None, 50_000, "so'm", 'bench', debtor_username=username)
+    return lambda: db.link_pending_debts(username, user_id)
+
+
+@case('write')
+def create_debt(db, ctx, rng):
+    creditor = ctx.user(rng)
+    debtor = creditor % ctx.users + 1
+    return lambda: db.create_debt(creditor, creditor, debtor, 100_000, "so'm", 'bench')
+
+
+@case('write')
+def confirm_debt(db, ctx, rng):
+    debt_id, _, debtor = _new_debt(db, ctx, rng, confirmed=False)
+    return lambda: db.confirm_debt(debt_id, debtor)
+
+
+@case('write')
+def create_group_expense(db, ctx, rng):
+    creditor = ctx.user(rng)
+    debts = [{'debtor_id': ctx.user(rng), 'debtor_name': f'Debtor {i}', 'amount': 30_000, 'reason': 'bench'}
+             for i in range(3)]
+    return lambda: db.create_group_expense(creditor, debts, notification_template='{amount} {currency} {reason}')
+
+
+@case('write', 'create_group_expense[unresolved]')
+def create_group_expense_unresolved(db, ctx, rng):
+    # Debtors by name: one from the owner's circles, one @username, one nobody knows
+    owner, name = rng.choice(ctx.members)
+    debts = [
+        {'debtor_name': name, 'amount': 30_000, 'reason': 'bench'},
+        {'debtor_name': 'Someone', 'debtor_username': f'@user{ctx.user(rng)}', 'amount': 30_000, 'reason': 'bench'},
+        {'debtor_name': 'Nomalum Odam', 'amount': 30_000, 'reason': 'bench'},
+    ]
+    return lambda: db.create_group_expense(owner, debts, notification_template='{amount} {currency} {reason}')
+
+
+@case('write')
+def add_payment(db, ctx, rng):
+    debt_id = ctx.debt(rng)
+    payer = ctx.user(rng)
+    return lambda: db.add_payment(debt_id, payer, 1000)
+
+
+@case('write')
+def confirm_payment(db, ctx, rng):
+    payment_id = db.add_payment(ctx.debt(rng), ctx.user(rng), 1000)
+    return lambda: db.confirm_payment(payment_id)
+
+
+@case('write')
+def link_debt_to_user(db, ctx, rng):
+    debt_id, _, debtor = _new_debt(db, ctx, rng)
+    other = debtor % ctx.users + 1
+    return lambda: db.link_debt_to_user(debt_id, 'debtor', other)
+
+
+@case('write')
+def cancel_debt(db, ctx, rng):
+    debt_id, creditor, _ = _new_debt(db, ctx, rng)
+    return lambda: db.cancel_debt(debt_id, creditor)
+
+
+@case('write')
+def create_notification(db, ctx, rng):
+    user_id, debt_id = ctx.user(rng), ctx.debt(rng)
+    return lambda: db.create_notification(user_id, debt_id, 'bench', 'debt_created')
+
+
+@case('write')
+def mark_notification_read(db, ctx, rng):
+    notification_id = ctx.unread.pop() if ctx.unread else 1
+    return lambda: db.mark_notification_read(notification_id)
+
+
+@case('write')
+def enqueue_message(db, ctx, rng):
+    chat_id, debt_id = ctx.user(rng), ctx.debt(rng)
+    return lambda: db.enqueue_message(chat_id, 'bench', notification=(debt_id, 'debt_created'))
+
+
+@case('write')
+def claim_outbox(db, ctx, rng):
+    for _ in range(20):
+        db.enqueue_message(ctx.user(rng), 'bench')
+    # Claimed rows stay leased, so every call finds the ones just queued
+    return lambda: db.claim_outbox(20)
+
+
+@case('write')
+def complete_outbox(db, ctx, rng):
+    ids = [db.enqueue_message(ctx.user(rng), 'bench') for _ in range(20)]
+    return lambda: db.complete_outbox(ids)
+
+
+@case('write')
+def retry_outbox(db, ctx, rng):
+    outbox_id = db.enqueue_message(ctx.user(rng), 'bench')
+    return lambda: db.retry_outbox(outbox_id, 5, 'bench')
+
+
+@case('write')
+def drop_outbox(db, ctx, rng):
+    outbox_id = db.enqueue_message(ctx.user(rng), 'bench')
+    return lambda: db.drop_outbox(outbox_id)
+
+
+@case('write')
+def save_cached_parse(db, ctx, rng):
+    key = ctx.key('parse')
+    return lambda: db.save_cached_parse(key, '{"amount": 50000}')
+
+
+@case('write')
+def prune_parse_cache(db, ctx, rng):
+    return lambda: db.prune_parse_cache(30 * 86400)
+
+
+@case('write')
+def save_transcript(db, ctx, rng):
+    file_id = ctx.key('voice')
+    return lambda: db.save_transcript(file_id, "Alisher menga 50 ming so'm qarz berdi", 4)
+
+
+@case()
+def get_cached_transcript(db, ctx, rng):
+    file_id = f'voice{rng.randint(1, max(1, ctx.next_key))}'
+    return lambda: db.get_cached_transcript(file_id)
+
+
+@case('write')
+def record_transcript_hit(db, ctx, rng):
+    file_id = f'voice{rng.randint(1, max(1, ctx.next_key))}'
+    return lambda: db.record_transcript_hit(file_id)
+
+
+@case('write')
+def save_conversation_state(db, ctx, rng):
+    key = str(ctx.user(rng))
+    return lambda: db.save_conversation_state('user_context', key, '{"type": "PaymentState", "fields": {}}',
+                                              time.time() + 3600)
+
+
+@case('write')
+def delete_conversation_state(db, ctx, rng):
+    key = str(ctx.user(rng))
+    db.save_conversation_state('user_context', key, '{}', time.time() + 3600)
+    return lambda: db.delete_conversation_state('user_context', key)
+
+
+@case('write')
+def create_circle(db, ctx, rng):
+    owner = ctx.user(rng)
+    name = ctx.key('Circle ')
+    return lambda: db.create_circle(owner, name)
+
+
+@case('write')
+def add_member_to_circle(db, ctx, rng):
+    circle_id = rng.randint(1, ctx.circles)
+    name = f'{rng.choice(dataset.FIRST_NAMES)} {ctx.key("")}'
+    return lambda: db.add_member_to_circle(circle_id, name)
+
+
+# Whole-table maintenance
+
+@case('maintenance')
+def init_database(db, ctx, rng):
+    return db.init_database
+
+
+@case('maintenance')
+def check_query_plans(db, ctx, rng):
+    return db.check_query_plans
+
+
+@case('maintenance')
+def backfill_paid_totals(db, ctx, rng):
+    return db.backfill_paid_totals
+
+
+@case('maintenance')
+def check_paid_totals(db, ctx, rng):
+    return db.check_paid_totals
+
+
+@case('maintenance')
+def rebuild_pair_balances(db, ctx, rng):
+    return db.rebuild_pair_balances
+
+
+@case('maintenance')
+def check_pair_balances(db, ctx, rng):
+    return db.check_pair_balances
+
+
+@case('maintenance')
+def rebuild_name_index(db, ctx, rng):
+    return db.rebuild_name_index
+
+
+def uncovered():
+    """Public Database methods with no case"""
+    public = {name for name in dir(Database) if not name.startswith('_') and callable(getattr(Database, name))}
+    covered = {name.split('[')[0] for name in CASES}
+    return sorted(public - covered - NOT_BENCHMARKED)
+
+
+def run_case(db, ctx, prepare, iterations, rng, warmup=WARMUP):
+    for _ in range(warmup):
+        prepare(db, ctx, rng)()
+    samples = []
+    for _ in range(iterations):
+        call = prepare(db, ctx, rng)
+        started = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def run_size(size, args, scratch):
+    source = dataset.ensure(size, args.seed, args.data_dir)
+    path = os.path.join(scratch, f'{size}.db')
+    shutil.copyfile(source, path)
+    db = Database(path)
+    ctx = Context(db, dataset.counts(source))
+    cases = {name: entry for name, entry in CASES.items()
+             if not args.methods or name.split('[')[0] in args.methods}
+    # Per-case seed: the same users and ids whichever other cases run
+    rngs = {name: random.Random(f'{args.seed}:{name}') for name in cases}
+    rounds = {name: [] for name in cases}
+    for _ in range(args.repeat):
+        for name, (kind, prepare) in cases.items():
+            if kind == 'maintenance':
+                iterations = max(1, MAINTENANCE_ITERATIONS // args.repeat)
+                samples = run_case(db, ctx, prepare, iterations, rngs[name], warmup=0)
+            else:
+                samples = run_case(db, ctx, prepare, args.iterations, rngs[name])
+            rounds[name].append(summarize(samples))
+    methods = {}
+    for name, (kind, _) in cases.items():
+        summaries = rounds[name]
+        methods[name] = {key: round(statistics.median(summary[key] for summary in summaries), 4)
+                         for key in summaries[0]}
+        methods[name].update(count=sum(summary['count'] for summary in summaries), kind=kind)
+    db.close()
+    os.remove(path)
+    return {'dataset': dataset.counts(source), 'methods': methods}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', choices=dataset.SIZES, default=['tiny', 'small'])
+    parser.add_argument('--iterations', type=int, default=200, help='timed calls per case per round')
+    parser.add_argument('--repeat', type=int, default=3, help='rounds per case; the median round is reported')
+    parser.add_argument('--methods', nargs='+', help='only these Database methods')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--data-dir', default=dataset.DEFAULT_DATA_DIR)
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'iterations': args.iterations,
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'uncovered': uncovered(),
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as scratch:
+        for size in args.sizes:
+            report['results'][size] = run_size(size, args, scratch)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    print_report(report)
+
+
+if __name__ == '__main__':
+    main()
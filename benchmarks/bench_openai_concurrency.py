@@ -0,0 +1,71 @@
+"""Throughput of concurrent voice senders against a local fake OpenAI server.
+
+Each sender does one Whisper transcription followed by one chat completion,
+like handle_voice. 'sync' calls the blocking OpenAI client from coroutines
+(the old handler code); 'async' goes through OpenAIGateway. Latency is
+measured from the moment all senders start, so queueing time counts.
+"""
+import argparse
+import asyncio
+import time
+
+from openai import OpenAI
+
+from openai_client import OpenAIGateway
+from benchmarks.common import print_report, summarize
+from benchmarks.fake_openai import FakeOpenAIServer
+
+AUDIO = b'\x00' * 16_000
+MESSAGES = [{'role': 'user', 'content': "Alisher menga 50 ming so'm qarz berdi"}]
+
+
+async def sync_sender(client, start, samples):
+    client.audio.transcriptions.create(model='whisper-1', file=('voice.ogg', AUDIO, 'audio/ogg'))
+    client.chat.completions.create(model='gpt-4o-mini', messages=MESSAGES, temperature=0.3)
+    samples.append(time.perf_counter() - start)
+
+
+async def async_sender(gateway, start, samples, queued):
+    async def on_queued():
+        queued.append(1)
+
+    await gateway.transcribe(AUDIO, on_queued=on_queued)
+    await gateway.chat(MESSAGES, on_queued=on_queued)
+    samples.append(time.perf_counter() - start)
+
+
+async def run(mode, base_url, senders, chat_concurrency, transcribe_concurrency):
+    samples, queued = [], []
+    start = time.perf_counter()
+    if mode == 'sync':
+        client = OpenAI(api_key='fake', base_url=base_url)
+        await asyncio.gather(*(sync_sender(client, start, samples) for _ in range(senders)))
+    else:
+        gateway = OpenAIGateway(api_key='fake', base_url=base_url, chat_concurrency=chat_concurrency,
+                                transcribe_concurrency=transcribe_concurrency)
+        await asyncio.gather(*(async_sender(gateway, start, samples, queued) for _ in range(senders)))
+        await gateway.aclose()
+    wall = time.perf_counter() - start
+    return dict(summarize(samples), wall_seconds=round(wall, 3),
+                voice_notes_per_sec=round(senders / wall, 2), queued_notices=len(queued))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--senders', type=int, default=50)
+    parser.add_argument('--chat-latency', type=float, default=0.5)
+    parser.add_argument('--transcribe-latency', type=float, default=1.5)
+    parser.add_argument('--chat-concurrency', type=int, default=16)
+    parser.add_argument('--transcribe-concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    with FakeOpenAIServer(chat_latency=args.chat_latency, transcribe_latency=args.transcribe_latency) as server:
+        report = {'senders': args.senders}
+        for mode in ('sync', 'async'):
+            report[mode] = asyncio.run(run(mode, server.base_url, args.senders,
+                                           args.chat_concurrency, args.transcribe_concurrency))
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Transfers and run time of the settlement engine for growing circles.
+
+Each member gets a few random debts with other members, like repeated
+group splits. The report compares the pairwise debts outstanding with
+the transfers settle() proposes, and times the greedy and exact solvers
+(the exact one only where it is used, up to settlement.EXACT_LIMIT).
+"""
+import argparse
+import random
+
+import settlement
+from benchmarks.common import print_report, summarize, time_calls
+
+SIZES = (5, 10, 12, 50, 500, 5000)
+
+
+def random_pairs(members, debts_per_member, rng):
+    """pair_balances-style rows for random debts between members"""
+    net = {}
+    for debtor in range(members):
+        for _ in range(min(debts_per_member, members - 1)):
+            # Anyone but the debtor
+            creditor = rng.randrange(members - 1)
+            if creditor >= debtor:
+                creditor += 1
+            key = (min(debtor, creditor), max(debtor, creditor))
+            # net_amount is what user_b owes user_a
+            sign = 1 if debtor == key[1] else -1
+            net[key] = net.get(key, 0) + sign * rng.randrange(10, 500) * 1000
+    return [{'user_a': a, 'user_b': b, 'net_amount': amount} for (a, b), amount in net.items() if amount]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--debts-per-member', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    report = []
+    for members in args.sizes:
+        pairs = random_pairs(members, args.debts_per_member, rng)
+        balances = settlement.net_balances(pairs)
+        greedy = settlement.greedy_transfers(balances)
+        row = {
+            'members': members,
+            'pairwise_debts': len(pairs),
+            'greedy_transfers': len(greedy),
+            'greedy': summarize(time_calls(lambda: settlement.greedy_transfers(balances), args.iterations)),
+        }
+        if sum(1 for amount in balances.values() if amount) <= settlement.EXACT_LIMIT:
+            row['exact_transfers'] = len(settlement.exact_transfers(balances))
+            row['exact'] = summarize(time_calls(lambda: settlement.exact_transfers(balances), args.iterations))
+        report.append(row)
+    print_report(report)
+
+
+if __name__ == '__main__':
+    main()
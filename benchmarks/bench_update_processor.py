@@ -0,0 +1,102 @@
+"""Latency of quick updates while one user's update is slow, per update processor.
+
+Drives each processor the way Application does (one task per update, in
+arrival order). One user sends a slow update (a long Whisper call) followed
+by quick ones; the other users' quick updates arrive in the same burst.
+
+  sequential   PTB's default: one update at a time
+  concurrent   PTB's SimpleUpdateProcessor (concurrent_updates=N)
+  per_user     update_processor.PerUserUpdateProcessor
+
+order_violations counts updates a user saw handled out of the order sent;
+only per_user is both fast for everyone and violation-free.
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from telegram import Update
+from telegram.ext import SimpleUpdateProcessor
+
+from update_processor import PerUserUpdateProcessor
+from benchmarks.common import print_report, summarize
+from benchmarks.replay_webhook import for_user, load_updates
+
+SLOW_USER = 1
+
+
+def make_updates(users, per_user, rng):
+    """(update, handler seconds) pairs in arrival order, each user's in the order sent"""
+    text_update = load_updates()[2]
+    queues = {}
+    update_id = 1
+    for user_id in range(SLOW_USER, SLOW_USER + users):
+        queues[user_id] = []
+        for _ in range(per_user):
+            update = Update.de_json(for_user(text_update, user_id, update_id), None)
+            queues[user_id].append((update, rng.uniform(0.001, 0.02)))
+            update_id += 1
+    # The slow user's first update arrives first, the rest interleave at random
+    updates = [queues[SLOW_USER].pop(0)]
+    while queues:
+        user_id = rng.choice(list(queues))
+        updates.append(queues[user_id].pop(0))
+        if not queues[user_id]:
+            del queues[user_id]
+    return updates
+
+
+async def run(mode, updates, concurrency, slow_seconds):
+    handled = {}
+    latencies = []
+    violations = 0
+
+    async def handle(update, seconds, arrived):
+        nonlocal violations
+        first_of_slow = update.effective_user.id == SLOW_USER and update.update_id == 1
+        await asyncio.sleep(slow_seconds if first_of_slow else seconds)
+        last = handled.get(update.effective_user.id, 0)
+        if update.update_id < last:
+            violations += 1
+        handled[update.effective_user.id] = max(last, update.update_id)
+        if update.effective_user.id != SLOW_USER:
+            latencies.append(time.perf_counter() - arrived)
+
+    # The whole burst arrives at once; latency counts the time spent queued
+    arrived = time.perf_counter()
+    if mode == 'sequential':
+        for update, seconds in updates:
+            await handle(update, seconds, arrived)
+    else:
+        processor = (SimpleUpdateProcessor(concurrency) if mode == 'concurrent'
+                     else PerUserUpdateProcessor(concurrency))
+        async with processor:
+            tasks = [asyncio.create_task(processor.process_update(update, handle(update, seconds, arrived)))
+                     for update, seconds in updates]
+            await asyncio.gather(*tasks)
+        if mode == 'per_user':
+            stats = processor.stats()
+            return dict(summarize(latencies), order_violations=violations,
+                        wait_p99_ms=stats['wait_p99_ms'], max_user_depth=stats['max_user_depth'])
+    return dict(summarize(latencies), order_violations=violations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--updates-per-user', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--slow-seconds', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    report = {}
+    for mode in ('sequential', 'concurrent', 'per_user'):
+        updates = make_updates(args.users, args.updates_per_user, random.Random(args.seed))
+        report[mode] = asyncio.run(run(mode, updates, args.concurrency, args.slow_seconds))
+    print_report(report)
+
+
+if __name__ == '__main__':
+    main()
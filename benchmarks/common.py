@@ -0,0 +1,68 @@
+"""Shared helpers for the benchmark scripts.
+
+Run any benchmark from the repository root, e.g.
+    python -m benchmarks.bench_connections
+"""
+import json
+import random
+import statistics
+import time
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    """Summarize latency samples (seconds) as a JSON-friendly dict in ms"""
+    total = sum(samples)
+    return {
+        'count': len(samples),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 4) if samples else 0.0,
+        'p50_ms': round(percentile(samples, 50) * 1000, 4),
+        'p99_ms': round(percentile(samples, 99) * 1000, 4),
+        'max_ms': round(max(samples) * 1000, 4) if samples else 0.0,
+        'ops_per_sec': round(len(samples) / total, 1) if total else 0.0,
+    }
+
+
+def time_calls(fn, iterations):
+    """Call fn() repeatedly and return the per-call latencies in seconds"""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def seed_debts(db, user_count=50, debts_per_user=30, payments_per_debt=2, seed=42):
+    """Fill a Database with users, active debts and confirmed payments"""
+    rng = random.Random(seed)
+    with db.transaction() as cursor:
+        cursor.executemany(
+            'INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, ?, ?)',
+            [(uid, f'user{uid}', f'User {uid}') for uid in range(1, user_count + 1)]
+        )
+        for debtor_id in range(1, user_count + 1):
+            for _ in range(debts_per_user):
+                creditor_id = rng.choice([u for u in range(1, user_count + 1) if u != debtor_id])
+                cursor.execute('''
+                    INSERT INTO debts (creator_id, creditor_id, debtor_id, amount, currency, reason,
+                                       status, confirmed_by_creditor, confirmed_by_debtor)
+                    VALUES (?, ?, ?, ?, 'so''m', 'benchmark', 'active', TRUE, TRUE)
+                ''', (creditor_id, creditor_id, debtor_id, rng.randrange(10, 500) * 1000))
+                debt_id = cursor.lastrowid
+                cursor.executemany(
+                    'INSERT INTO payments (debt_id, payer_id, amount, confirmed) VALUES (?, ?, ?, TRUE)',
+                    [(debt_id, debtor_id, 1000) for _ in range(payments_per_debt)]
+                )
+
+
+def print_report(report):
+    print(json.dumps(report, indent=2, ensure_ascii=False))
@@ -0,0 +1,89 @@
+"""Compare two bench_database.py reports and flag regressions.
+
+A method regresses when a --gate metric (p50 by default) in the new run is
+more than --threshold percent above the base run and also more than
+--min-delta-ms slower in absolute terms (sub-0.1 ms calls jitter by more
+than 10%). Changes in the other metrics are listed under "ungated": p99 of
+a few hundred calls moves by tens of percent between runs of the same code
+on a busy machine.
+
+Changes are measured after dividing out the size's drift, the median
+new/base p50 ratio over all its methods: a slower or busier machine moves
+every method, a regression moves a few. --absolute turns this off. Exits 1 when anything regressed, so it can gate CI.
+
+    python -m benchmarks.compare base.json new.json --threshold 15
+"""
+import argparse
+import json
+import statistics
+import sys
+
+from benchmarks.common import print_report
+
+METRICS = ('p50_ms', 'p99_ms')
+
+
+def drift(base_methods, new_methods):
+    """Median new/base p50 ratio over the methods both runs have"""
+    ratios = [new_methods[method]['p50_ms'] / before['p50_ms'] for method, before in base_methods.items()
+              if method in new_methods and before['p50_ms']]
+    return statistics.median(ratios) if ratios else 1.0
+
+
+def compare(base, new, threshold, min_delta_ms, gate=('p50_ms',), absolute=False):
+    report = {'base': base['meta'], 'new': new['meta'], 'drift_pct': {}, 'regressions': [], 'improvements': [],
+              'ungated': [], 'unchanged': 0, 'missing': [], 'added': []}
+    for size, base_result in base['results'].items():
+        new_methods = new['results'].get(size, {}).get('methods')
+        if new_methods is None:
+            report['missing'].append(size)
+            continue
+        scale = 1.0 if absolute else drift(base_result['methods'], new_methods)
+        report['drift_pct'][size] = round((scale - 1) * 100, 1)
+        for method, before in base_result['methods'].items():
+            after = new_methods.get(method)
+            if after is None:
+                report['missing'].append(f'{size}/{method}')
+                continue
+            changes = {}
+            for metric in METRICS:
+                expected = before[metric] * scale
+                delta = after[metric] - expected
+                pct = delta / expected * 100 if expected else 0.0
+                if abs(pct) > threshold and abs(delta) > min_delta_ms:
+                    changes[metric] = {'before': before[metric], 'after': after[metric], 'change_pct': round(pct, 1)}
+            row = {'size': size, 'method': method, **changes}
+            gated = [changes[metric]['change_pct'] for metric in gate if metric in changes]
+            if any(pct > 0 for pct in gated):
+                report['regressions'].append(row)
+            elif gated:
+                report['improvements'].append(row)
+            elif changes:
+                report['ungated'].append(row)
+            else:
+                report['unchanged'] += 1
+        report['added'].extend(f'{size}/{method}' for method in new_methods if method not in base_result['methods'])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=15.0, help='percent change that counts')
+    parser.add_argument('--min-delta-ms', type=float, default=0.05, help='ignore smaller absolute changes')
+    parser.add_argument('--gate', nargs='+', choices=METRICS, default=['p50_ms'], help='metrics that can regress')
+    parser.add_argument('--absolute', action='store_true', help='do not correct for machine-wide drift')
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    report = compare(base, new, args.threshold, args.min_delta_ms, args.gate, args.absolute)
+    print_report(report)
+    sys.exit(1 if report['regressions'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""Synthetic SQLite databases shaped like production, at several sizes.
+
+Users are picked with a skew (a few heavy users, a long tail), debt ids grow
+with created_at over two years, statuses and confirmed payments are mixed
+like a live ledger, and the derived tables (paid_total, pair_balances, the
+circle member name index) are rebuilt with the Database's own maintenance
+methods. A generated file is cached under --data-dir by size and seed.
+
+    python -m benchmarks.dataset --size large      # 10k users, 1M debts, 3M payments
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from database import Database
+
+SIZES = {
+    'tiny': dict(users=200, debts=5_000, payments_per_debt=3, circles=100, notifications=2_500),
+    'small': dict(users=1_000, debts=50_000, payments_per_debt=3, circles=500, notifications=25_000),
+    'medium': dict(users=3_000, debts=250_000, payments_per_debt=3, circles=1_500, notifications=125_000),
+    'large': dict(users=10_000, debts=1_000_000, payments_per_debt=3, circles=5_000, notifications=500_000),
+}
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), 'hamyon-bench')
+# Bump when the generator changes so cached files are rebuilt
+GENERATOR_VERSION = 1
+INSERT_BATCH = 50_000
+HISTORY_DAYS = 730
+
+FIRST_NAMES = ('Alisher', 'Dilnoza', 'Jasur', 'Malika', 'Bekzod', 'Nodira', 'Sardor', 'Gulnora', 'Otabek',
+               'Shahnoza', 'Rustam', 'Zarina', 'Aziz', 'Kamola', 'Jamshid', 'Madina', 'Sherzod', 'Feruza')
+REASONS = ('tushlik', 'kafe', 'taksi', 'kino', "do'kon", 'ijara', 'sovg\'a', 'benzin', 'kitob', 'kontsert')
+CIRCLE_NAMES = ('Hamkasblar', "Do'stlar", 'Oila')
+# (status, weight); statuses of a live ledger
+STATUSES = (('active', 60), ('paid', 20), ('pending', 12), ('cancelled', 8))
+
+
+def dataset_path(size, seed=42, data_dir=DEFAULT_DATA_DIR):
+    return os.path.join(data_dir, f'{size}-seed{seed}-v{GENERATOR_VERSION}.db')
+
+
+def _skewed(rng, count):
+    """1..count, low ids far more often (heavy users)"""
+    return 1 + min(count - 1, int(count * rng.random() ** 2))
+
+
+def _batched(rows, cursor, sql):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= INSERT_BATCH:
+            cursor.executemany(sql, batch)
+            batch.clear()
+    if batch:
+        cursor.executemany(sql, batch)
+
+
+def _users(config):
+    for user_id in range(1, config['users'] + 1):
+        yield user_id, f'user{user_id}', FIRST_NAMES[user_id % len(FIRST_NAMES)], f'Test{user_id}'
+
+
+def _debts(config, rng, paid_totals):
+    users = config['users']
+    start = datetime.now() - timedelta(days=HISTORY_DAYS)
+    step = HISTORY_DAYS * 86400 / config['debts']
+    statuses, weights = zip(*STATUSES)
+    for debt_id in range(1, config['debts'] + 1):
+        creditor = _skewed(rng, users)
+        debtor = _skewed(rng, users)
+        if debtor == creditor:
+            debtor = creditor % users + 1
+        status = rng.choices(statuses, weights)[0]
+        created = start + timedelta(seconds=debt_id * step + rng.random() * step)
+        unlinked = rng.random() < 0.05
+        yield (
+            debt_id, creditor, creditor, None if unlinked else debtor, rng.randrange(10, 2000) * 1000,
+            "so'm", rng.choice(REASONS), status, created.strftime('%Y-%m-%d %H:%M:%S'),
+            status != 'pending', status in ('active', 'paid'),
+            f'newuser{debtor}' if unlinked else None, paid_totals.get(debt_id, 0),
+        )
+
+
+def _payments(config, rng, paid_totals):
+    per_debt = config['payments_per_debt']
+    for debt_id in range(1, config['debts'] + 1):
+        for _ in range(rng.randint(0, 2 * per_debt)):
+            confirmed = rng.random() < 0.85
+            amount = rng.randrange(1, 50) * 1000
+            if confirmed:
+                paid_totals[debt_id] = paid_totals.get(debt_id, 0) + amount
+            yield debt_id, _skewed(rng, config['users']), amount, confirmed
+
+
+def _circles(config, rng):
+    """(circle row, [member rows]) pairs; at most one circle per name per owner"""
+    circle_id = 0
+    for owner in range(1, config['users'] + 1):
+        for name in CIRCLE_NAMES:
+            if circle_id >= config['circles']:
+                return
+            circle_id += 1
+            members = []
+            for _ in range(rng.randint(3, 8)):
+                member = _skewed(rng, config['users'])
+                linked = rng.random() < 0.7
+                members.append((circle_id, f'{FIRST_NAMES[member % len(FIRST_NAMES)]} {member}',
+                                member if linked else None, f'user{member}' if linked else None))
+            yield (circle_id, owner, name), members
+
+
+def _notifications(config, rng):
+    for _ in range(config['notifications']):
+        debt_id = rng.randint(1, config['debts'])
+        yield _skewed(rng, config['users']), debt_id, f'Yangi qarz #{debt_id}', 'debt_created', rng.random() < 0.8
+
+
+def generate(path, size='small', seed=42):
+    """Write a dataset of the given size to path; returns its row counts"""
+    config = SIZES[size]
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    if os.path.exists(path):
+        os.remove(path)
+    db = Database(path)
+    # Payments first so each debt's paid_total is known when the debt is written
+    paid_totals = {}
+    payments = list(_payments(config, rng, paid_totals))
+    with db.transaction() as cursor:
+        _batched(_users(config), cursor,
+                 'INSERT INTO users (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)')
+        _batched(_debts(config, rng, paid_totals), cursor, '''
+            INSERT INTO debts (id, creator_id, creditor_id, debtor_id, amount, currency, reason, status, created_at,
+                               confirmed_by_creditor, confirmed_by_debtor, debtor_username, paid_total)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''')
+        _batched(payments, cursor, 'INSERT INTO payments (debt_id, payer_id, amount, confirmed) VALUES (?, ?, ?, ?)')
+        del payments
+        for circle, members in _circles(config, rng):
+            cursor.execute('INSERT INTO user_circles (id, user_id, circle_name) VALUES (?, ?, ?)', circle)
+            cursor.executemany('''
+                INSERT INTO circle_members (circle_id, member_name, member_user_id, member_username)
+                VALUES (?, ?, ?, ?)
+            ''', members)
+        _batched(_notifications(config, rng), cursor,
+                 'INSERT INTO notifications (user_id, debt_id, message, type, read) VALUES (?, ?, ?, ?, ?)')
+    db.rebuild_pair_balances()
+    db.rebuild_name_index()
+    with db.transaction() as cursor:
+        cursor.execute('ANALYZE')
+        counts = {table: cursor.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                  for table in ('users', 'debts', 'payments', 'user_circles', 'circle_members', 'notifications',
+                                'pair_balances')}
+    db.close()
+    counts['generate_seconds'] = round(time.perf_counter() - started, 1)
+    with open(path + '.json', 'w') as f:
+        json.dump({'size': size, 'seed': seed, 'counts': counts}, f)
+    return counts
+
+
+def ensure(size, seed=42, data_dir=DEFAULT_DATA_DIR):
+    """Path of the cached dataset, generating it first if needed"""
+    os.makedirs(data_dir, exist_ok=True)
+    path = dataset_path(size, seed, data_dir)
+    if not os.path.exists(path + '.json'):
+        generate(path, size, seed)
+    return path
+
+
+def counts(path):
+    with open(path + '.json') as f:
+        return json.load(f)['counts']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', choices=SIZES, default='small')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    args = parser.parse_args()
+    path = ensure(args.size, args.seed, args.data_dir)
+    print(json.dumps({'path': path, 'counts': counts(path)}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Local stand-in for the OpenAI HTTP API.
+
+Serves /v1/chat/completions and /v1/audio/transcriptions with a
+configurable delay and canned content, so benchmarks never leave the box.
+The content may also be a function, called once per request, to vary it.
+Point a client at it with base_url=server.base_url (or OPENAI_BASE_URL).
+
+    python -m benchmarks.fake_openai --port 8765 --chat-latency 0.8
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_CHAT_CONTENT = json.dumps({
+    'amount': 50000,
+    'currency': "so'm",
+    'creditor_name': 'Alisher',
+    'debtor_name': None,
+    'reason': 'tushlik',
+    'direction': 'owe_me',
+})
+DEFAULT_TRANSCRIPT = "Alisher menga 50 ming so'm qarz berdi tushlik uchun"
+
+
+class FakeOpenAIServer:
+    """Threaded HTTP server answering like the OpenAI API"""
+
+    def __init__(self, host='127.0.0.1', port=0, chat_latency=0.5, transcribe_latency=1.5,
+                 chat_content=DEFAULT_CHAT_CONTENT, transcript=DEFAULT_TRANSCRIPT):
+        self.chat_latency = chat_latency
+        self.transcribe_latency = transcribe_latency
+        self.chat_content = chat_content
+        self.transcript = transcript
+        self.requests = {'chat': 0, 'transcription': 0}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def _count(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+
+    @staticmethod
+    def _content(content):
+        return content() if callable(content) else content
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path.endswith('/chat/completions'):
+                    server._count('chat')
+                    time.sleep(server.chat_latency)
+                    self._reply({
+                        'id': 'chatcmpl-fake',
+                        'object': 'chat.completion',
+                        'created': int(time.time()),
+                        'model': 'gpt-4o-mini',
+                        'choices': [{
+                            'index': 0,
+                            'finish_reason': 'stop',
+                            'message': {'role': 'assistant', 'content': server._content(server.chat_content)},
+                        }],
+                    })
+                elif self.path.endswith('/audio/transcriptions'):
+                    server._count('transcription')
+                    time.sleep(server.transcribe_latency)
+                    self._reply({'text': server._content(server.transcript)})
+                else:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--chat-latency', type=float, default=0.5)
+    parser.add_argument('--transcribe-latency', type=float, default=1.5)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(port=args.port, chat_latency=args.chat_latency,
+                              transcribe_latency=args.transcribe_latency)
+    print(f'Fake OpenAI listening on {server.base_url}')
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""In-process stand-ins for the Telegram Bot API.
+
+FakeRequest plugs into PTB as the HTTP client (Application.builder().request)
+and answers Bot API methods from memory, so handlers run end to end without
+a token or network. Every call is recorded with its timestamp (or only
+counted, for long runs), and the last message sent or edited in each chat is
+kept so a simulated user can answer it.
+
+    from bot import build_application
+    application = build_application('123:fake', request=FakeRequest())
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+
+from telegram.request import BaseRequest
+
+BOT_USER = {'id': 123, 'is_bot': True, 'first_name': 'Hamyon', 'username': 'hamyon_test_bot'}
+VOICE_BYTES = b'OggS' + bytes(1020)
+
+
+class FakeRequest(BaseRequest):
+    """BaseRequest answering like api.telegram.org, with optional latency per call"""
+
+    def __init__(self, latency=0.0, keep_calls=True):
+        self.latency = latency
+        self.keep_calls = keep_calls
+        self.calls = []  # (monotonic time, method, parameters), when keep_calls
+        self.counts = Counter()  # method -> calls
+        self.last = {}  # chat_id -> (message_id, parameters) of the last message sent or edited
+        self._message_ids = itertools.count(1000)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    def count(self, method):
+        return self.counts[method]
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if '/file/bot' in url:
+            # File download (Bot.get_file(...).download_*)
+            return 200, VOICE_BYTES
+        name = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.counts[name] += 1
+        if self.keep_calls:
+            self.calls.append((time.monotonic(), name, params))
+        result = self._result(name, params)
+        if name in ('sendMessage', 'editMessageText'):
+            self.last[result['chat']['id']] = (result['message_id'], params)
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def _result(self, name, params):
+        if name == 'getMe':
+            return BOT_USER
+        if name in ('sendMessage', 'editMessageText'):
+            chat_id = params.get('chat_id', 0)
+            return {
+                'message_id': params.get('message_id') or next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': params.get('text', ''),
+            }
+        if name == 'getFile':
+            return {
+                'file_id': params['file_id'],
+                'file_unique_id': f"u{params['file_id']}",
+                'file_size': len(VOICE_BYTES),
+                'file_path': f"voice/{params['file_id']}.oga",
+            }
+        # answerCallbackQuery, setWebhook, deleteWebhook, deleteMessage, ...
+        return True
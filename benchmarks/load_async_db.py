@@ -0,0 +1,100 @@
+"""Latency of light requests while one user runs a heavy query.
+
+Light "users" fire small lookups on a fixed schedule while a heavy user
+repeatedly loads a very long debt list. In 'sync' mode the handlers call
+Database directly on the event loop (the old behaviour); in 'async' mode
+they await AsyncDatabase. Latency is measured from each request's
+scheduled start, so time spent stuck behind a blocked loop is counted.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from async_database import AsyncDatabase
+from database import Database
+from benchmarks.common import print_report, summarize
+
+HEAVY_USER = 1
+
+
+def seed(db, heavy_debts, light_users, light_debts=10):
+    counterparty = light_users + 2
+    with db.transaction() as cursor:
+        cursor.executemany(
+            'INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)',
+            [(uid, f'user{uid}', f'User {uid}') for uid in range(1, counterparty + 1)]
+        )
+        insert = '''
+            INSERT INTO debts (creator_id, creditor_id, debtor_id, amount, reason, status)
+            VALUES (?, ?, ?, 1000, 'benchmark', 'active')
+        '''
+        cursor.executemany(insert, [(HEAVY_USER, HEAVY_USER, counterparty)] * heavy_debts)
+        cursor.executemany(insert, [
+            (counterparty, counterparty, 2 + i) for i in range(light_users) for _ in range(light_debts)
+        ])
+
+
+async def heavy_user(call, stop):
+    while not stop.is_set():
+        await call('get_user_debts', HEAVY_USER)
+        await asyncio.sleep(0)
+
+
+async def light_user(call, user_id, interval, duration, samples):
+    start = time.perf_counter()
+    tick = 0
+    while True:
+        scheduled = start + tick * interval
+        if scheduled - start > duration:
+            return
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await call('get_debts_i_owe', user_id)
+        samples.append(time.perf_counter() - scheduled)
+        tick += 1
+
+
+async def run(mode, db, light_users, interval, duration):
+    if mode == 'async':
+        adb = AsyncDatabase(db)
+
+        async def call(name, *args):
+            return await getattr(adb, name)(*args)
+    else:
+        async def call(name, *args):
+            return getattr(db, name)(*args)
+
+    samples = []
+    stop = asyncio.Event()
+    heavy = asyncio.create_task(heavy_user(call, stop))
+    await asyncio.gather(*(
+        light_user(call, 2 + i, interval, duration, samples) for i in range(light_users)
+    ))
+    stop.set()
+    await heavy
+    return summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--heavy-debts', type=int, default=200_000)
+    parser.add_argument('--light-users', type=int, default=20)
+    parser.add_argument('--interval', type=float, default=0.1, help='seconds between light requests')
+    parser.add_argument('--duration', type=float, default=5.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        seed(db, args.heavy_debts, args.light_users)
+        report = {'heavy_debts': args.heavy_debts, 'light_users': args.light_users}
+        for mode in ('sync', 'async'):
+            report[mode] = asyncio.run(run(mode, db, args.light_users, args.interval, args.duration))
+        db.close()
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
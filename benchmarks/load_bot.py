@@ -0,0 +1,361 @@
+"""Offline load test of the whole bot: synthetic users against fake Telegram and OpenAI.
+
+Runs the real Application (handlers, PerUserUpdateProcessor, outbox) against
+FakeRequest, a FakeOpenAIServer and a throwaway database. Updates arrive at
+--rate per second (Poisson), each from a random idle user out of --users, so
+the arrival rate holds however slow the handlers get; when every user is
+still waiting for a reply the arrival is counted as skipped.
+
+A user answers the last message the bot sent to its chat, like a person
+would: it presses the onboarding skip, confirm and accept buttons, answers
+"Qancha pul?" and "Kim qarz berdi?" questions, and otherwise sends a voice
+note, a menu button, a contact or /start. Some transcripts are parsed by
+fast_parser and the rest go to the fake chat model, which sometimes leaves a
+name out so the missing-info flow runs too.
+
+Reports throughput, latency per kind of update (queued until the handlers
+returned) and, every --sample-every seconds, the size of user_context and
+pending_debts, process RSS and (with --tracemalloc) traced Python memory,
+so growth over a long run shows up.
+
+    python -m benchmarks.load_bot --users 500 --rate 100 --duration 600
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+
+from benchmarks.common import print_report, summarize
+from benchmarks.fake_openai import DEFAULT_CHAT_CONTENT, FakeOpenAIServer
+from benchmarks.fakes import FakeRequest
+from benchmarks.replay_webhook import for_user, load_updates
+
+FIRST_USER_ID = 100000
+NAMES = ('Alisher', 'Dilnoza', 'Jasur', 'Malika', 'Bekzod', 'Nodira', 'Sardor', 'Gulnora')
+MENU = ('💰 Men qarzdorman', '💵 Menga qarzlar', '📜 Tarix', '📊 Statistika', '🤝 Hisob-kitob', 'ℹ️ Yordam')
+# What a user does when the bot is not waiting for an answer: (action, weight)
+ACTIONS = (('voice', 4), ('menu', 4), ('contact', 1), ('start', 1))
+# Buttons a user presses, in order of preference
+PRESS = ('onboard_skip', 'confirm_', 'accept_debt_', 'history_n_')
+# fast_parser handles the first three. The last goes to the chat model, numbered so parse_cache never answers it
+TRANSCRIPTS = (
+    "Alisher menga 50 ming so'm qarz berdi tushlik uchun",
+    "Men Dilnozaga kafe uchun 120 ming berdim",
+    "Men Jasurga 75000 qarz berdim kitob uchun",
+    "Kecha taksi uchun pul berdi, keyin qaytaraman ({n})",
+)
+MISSING_NAME_CONTENT = json.dumps({**json.loads(DEFAULT_CHAT_CONTENT), 'creditor_name': None})
+
+
+def rss_mb():
+    """Resident set size now (peak where /proc is missing)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Templates:
+    """Update JSON for each kind of message, built from the recorded fixtures"""
+
+    def __init__(self):
+        recorded = load_updates()
+        self.command = recorded[0]
+        self.callback = recorded[1]
+        self.text = recorded[2]
+        self.voice = recorded[-1]
+        self.message_ids = itertools.count(1)
+        self.voice_ids = itertools.count(1)
+
+    def _message(self, template, user_id, update_id):
+        update = for_user(template, user_id, update_id)
+        update['message']['message_id'] = next(self.message_ids)
+        update['message']['date'] = int(time.time())
+        return update
+
+    def start(self, user_id, update_id):
+        return self._message(self.command, user_id, update_id)
+
+    def text_message(self, user_id, update_id, text):
+        update = self._message(self.text, user_id, update_id)
+        update['message']['text'] = text
+        return update
+
+    def voice_message(self, user_id, update_id):
+        update = self._message(self.voice, user_id, update_id)
+        # Every note is a new recording, so none is answered from the transcript cache
+        voice_id = f'load-voice-{next(self.voice_ids)}'
+        update['message']['voice'].update(file_id=voice_id, file_unique_id=voice_id)
+        return update
+
+    def contact(self, user_id, update_id, contact_id):
+        update = self._message(self.text, user_id, update_id)
+        del update['message']['text']
+        update['message']['contact'] = {
+            'phone_number': f'+99890{contact_id:07d}',
+            'first_name': NAMES[contact_id % len(NAMES)],
+            'user_id': contact_id,
+        }
+        return update
+
+    def button(self, user_id, update_id, message_id, data):
+        update = for_user(self.callback, user_id, update_id)
+        update['callback_query']['id'] = str(update_id)
+        update['callback_query']['data'] = data
+        update['callback_query']['message']['message_id'] = message_id
+        return update
+
+
+class LoadUser:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.started = False
+
+
+class LoadRun:
+    """Feeds synthetic updates to a running Application and times them until its handlers return"""
+
+    def __init__(self, application, request, args):
+        self.application = application
+        self.request = request
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.templates = Templates()
+        self.update_ids = itertools.count(1)
+        self.pending = {}
+        self.latency = defaultdict(list)
+        self.sent = 0
+        self.handled = 0
+        self.skipped = 0
+        self.timeouts = 0
+        self.errors = Counter()
+        self.samples = []
+        self.snapshots = []
+
+    async def on_handled(self, update, context):
+        future = self.pending.pop(update.update_id, None)
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    async def on_error(self, update, context):
+        self.errors[type(context.error).__name__] += 1
+
+    def _answer(self, user, update_id):
+        """(kind, update) answering the bot's last message in the user's chat, or None"""
+        message = self.request.last.pop(user.user_id, None)
+        if message is None:
+            return None
+        message_id, params = message
+        markup = params.get('reply_markup') or {}
+        buttons = [button.get('callback_data', '') for row in markup.get('inline_keyboard', ()) for button in row]
+        for prefix in PRESS:
+            for data in buttons:
+                if data.startswith(prefix):
+                    return f"callback {prefix.rstrip('_')}", self.templates.button(
+                        user.user_id, update_id, message_id, data)
+        text = params.get('text', '')
+        if 'Qancha pul' in text:
+            return 'answer amount', self.templates.text_message(user.user_id, update_id, '50000')
+        if 'Kim qarz berdi' in text or 'Kimga qarz berdingiz' in text:
+            return 'answer name', self.templates.text_message(user.user_id, update_id, self.rng.choice(NAMES))
+        return None
+
+    def next_update(self, user):
+        update_id = next(self.update_ids)
+        if not user.started:
+            user.started = True
+            return 'start', self.templates.start(user.user_id, update_id)
+        answer = self._answer(user, update_id)
+        if answer is not None:
+            return answer
+        actions, weights = zip(*ACTIONS)
+        action = self.rng.choices(actions, weights)[0]
+        if action == 'voice':
+            return 'voice', self.templates.voice_message(user.user_id, update_id)
+        if action == 'menu':
+            return 'menu', self.templates.text_message(user.user_id, update_id, self.rng.choice(MENU))
+        if action == 'contact':
+            contact_id = FIRST_USER_ID + self.rng.randrange(self.args.users)
+            return 'contact', self.templates.contact(user.user_id, update_id, contact_id)
+        return 'start', self.templates.start(user.user_id, update_id)
+
+    async def step(self, user, idle):
+        from telegram import Update
+        kind, data = self.next_update(user)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[data['update_id']] = future
+        self.sent += 1
+        started = time.perf_counter()
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+        try:
+            finished = await asyncio.wait_for(future, self.args.timeout)
+        except asyncio.TimeoutError:
+            self.pending.pop(data['update_id'], None)
+            self.timeouts += 1
+        else:
+            self.handled += 1
+            self.latency[kind].append(finished - started)
+        idle.append(user)
+
+    def sample(self, started):
+        bot = self.application.bot_data['debt_bot']
+        row = {
+            'seconds': round(time.perf_counter() - started, 1),
+            'handled': self.handled,
+            'user_context': bot.user_context.stats(),
+            'pending_debts': bot.pending_debts.stats(),
+            'rss_mb': round(rss_mb(), 1),
+        }
+        if tracemalloc.is_tracing():
+            row['traced_mb'] = round(tracemalloc.get_traced_memory()[0] / 2 ** 20, 1)
+        self.samples.append(row)
+
+    async def sampler(self, started):
+        warmed_up = False
+        while True:
+            await asyncio.sleep(self.args.sample_every)
+            self.sample(started)
+            if tracemalloc.is_tracing() and not warmed_up and self.samples[-1]['seconds'] >= self.args.warmup:
+                warmed_up = True
+                self.snapshots.append(tracemalloc.take_snapshot())
+
+    async def run(self):
+        users = [LoadUser(FIRST_USER_ID + index) for index in range(self.args.users)]
+        idle = list(users)
+        self.rng.shuffle(idle)
+        tasks = set()
+        started = time.perf_counter()
+        self.sample(started)
+        sampler = asyncio.create_task(self.sampler(started))
+        arrival = started
+        while arrival - started < self.args.duration:
+            arrival += self.rng.expovariate(self.args.rate)
+            await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+            if not idle:
+                self.skipped += 1
+                continue
+            user = idle.pop(self.rng.randrange(len(idle)))
+            task = asyncio.create_task(self.step(user, idle))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+        elapsed = time.perf_counter() - started
+        sampler.cancel()
+        self.sample(started)
+        if tracemalloc.is_tracing():
+            self.snapshots.append(tracemalloc.take_snapshot())
+        return elapsed
+
+    def growth(self):
+        """Change from the first sample after --warmup to the last"""
+        after = [row for row in self.samples if row['seconds'] >= self.args.warmup] or self.samples
+        first, last = after[0], after[-1]
+        per_minute = 60 / (last['seconds'] - first['seconds']) if last['seconds'] > first['seconds'] else 0.0
+        growth = {'from_seconds': first['seconds'], 'to_seconds': last['seconds']}
+        for store in ('user_context', 'pending_debts'):
+            growth[f'{store}_entries_per_min'] = round(
+                (last[store]['entries'] - first[store]['entries']) * per_minute, 1)
+            growth[f'{store}_kb_per_min'] = round(
+                (last[store]['approx_bytes'] - first[store]['approx_bytes']) / 1024 * per_minute, 1)
+        growth['rss_mb_per_min'] = round((last['rss_mb'] - first['rss_mb']) * per_minute, 2)
+        if 'traced_mb' in last:
+            growth['traced_mb_per_min'] = round((last['traced_mb'] - first['traced_mb']) * per_minute, 2)
+        return growth
+
+    def top_allocations(self, limit=10):
+        """Source lines whose live memory grew most between the post-warmup and final snapshots"""
+        if len(self.snapshots) < 2:
+            return []
+        stats = self.snapshots[-1].compare_to(self.snapshots[0], 'lineno')
+        return [{'where': str(stat.traceback), 'kb': round(stat.size_diff / 1024, 1), 'count': stat.count_diff}
+                for stat in stats[:limit]]
+
+
+async def load(args, openai_server):
+    # Imported here so the environment set in main() is in place before bot.py builds its clients
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    from bot import build_application
+    from webhook import start_application, stop_application
+
+    request = FakeRequest(latency=args.telegram_latency, keep_calls=False)
+    application = build_application('123:load', request=request)
+    run = LoadRun(application, request, args)
+    # Runs after the bot's handlers (group 0) have returned
+    application.add_handler(TypeHandler(Update, run.on_handled), group=1)
+    application.add_error_handler(run.on_error)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    await start_application(application)
+    elapsed = await run.run()
+    await stop_application(application)
+    tracemalloc.stop()
+
+    return {
+        'users': args.users,
+        'rate': args.rate,
+        'seconds': round(elapsed, 1),
+        'sent': run.sent,
+        'handled': run.handled,
+        'skipped': run.skipped,
+        'timeouts': run.timeouts,
+        'errors': dict(run.errors),
+        'updates_per_sec': round(run.handled / elapsed, 1),
+        'latency': {kind: summarize(samples) for kind, samples in sorted(run.latency.items())},
+        'bot_api_calls': dict(request.counts),
+        'openai_requests': openai_server.requests,
+        'growth': run.growth(),
+        'top_allocations': run.top_allocations(),
+        'samples': run.samples,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=50.0, help='updates per second')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of arrivals')
+    parser.add_argument('--warmup', type=float, default=5.0, help='seconds left out of the growth figures')
+    parser.add_argument('--sample-every', type=float, default=5.0, help='seconds between memory samples')
+    parser.add_argument('--tracemalloc', action='store_true', help='trace Python allocations (slows the bot)')
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='seconds per fake Bot API call')
+    parser.add_argument('--chat-latency', type=float, default=0.05)
+    parser.add_argument('--transcribe-latency', type=float, default=0.1)
+    parser.add_argument('--missing-name-share', type=float, default=0.3,
+                        help='share of chat model answers without a name')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    # Called on the fake server's threads
+    transcript_rng = random.Random(args.seed + 1)
+    content_rng = random.Random(args.seed + 2)
+    transcript_numbers = itertools.count(1)
+    with tempfile.TemporaryDirectory() as tmp, FakeOpenAIServer(
+            chat_latency=args.chat_latency, transcribe_latency=args.transcribe_latency,
+            chat_content=lambda: (MISSING_NAME_CONTENT if content_rng.random() < args.missing_name_share
+                                  else DEFAULT_CHAT_CONTENT),
+            transcript=lambda: transcript_rng.choice(TRANSCRIPTS).format(n=next(transcript_numbers))) as openai_server:
+        os.environ['DATABASE_PATH'] = os.path.join(tmp, 'load.db')
+        os.environ['OPENAI_BASE_URL'] = openai_server.base_url
+        os.environ.setdefault('OPENAI_API_KEY', 'sk-load')
+        report = asyncio.run(load(args, openai_server))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    print_report(report)
+
+
+if __name__ == '__main__':
+    main()
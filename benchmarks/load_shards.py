@@ -0,0 +1,128 @@
+"""Update throughput of the sharded deployment for 1..N worker processes.
+
+For each worker count a sharding.Supervisor is started on localhost with
+workers that run the real handlers against FakeRequest and a throwaway
+database. Many simulated users then POST the recorded text updates
+(benchmarks/fixtures/updates.json, voice left out) to the front door,
+each user's in order and up to --concurrency at once, and the run ends
+when every worker reports all updates processed on /readyz.
+
+Scaling is only near-linear up to the number of cores; the report includes
+os.cpu_count() for that reason.
+
+    python -m benchmarks.load_shards --workers 1 2 4 8 --users 400
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.common import print_report, summarize
+from benchmarks.replay_webhook import for_user, load_updates
+
+SECRET = 'load-secret'
+
+
+def worker_main(telegram_latency):
+    """Entry point of each worker process: bot.py's webhook worker, with a fake Bot API"""
+    import logging
+    from benchmarks.fakes import FakeRequest
+    from bot import build_application
+    from webhook import run_webhook
+
+    logging.getLogger().setLevel(logging.WARNING)
+    application = build_application('123:load', request=FakeRequest(latency=telegram_latency))
+    asyncio.run(run_webhook(application, url=None))
+
+
+async def processed(supervisor):
+    total = 0
+    for worker in supervisor.workers:
+        status = (await worker.client.get('/readyz')).json()
+        total += status['update_processor']['processed']
+    return total
+
+
+async def run(workers, args, base_port, tmp):
+    from sharding import Supervisor
+
+    command = [sys.executable, '-m', 'benchmarks.load_shards', '--worker',
+               '--telegram-latency', str(args.telegram_latency)]
+    supervisor = Supervisor(
+        workers=workers, command=command, listen='127.0.0.1', port=0, secret=SECRET, base_port=base_port,
+        per_shard_database=args.database == 'per-shard',
+        extra_env={'DATABASE_PATH': os.path.join(tmp, f'load{workers}.db'), 'OPENAI_API_KEY': 'sk-load'},
+    )
+    recorded = [update for update in load_updates() if 'voice' not in update.get('message', {})]
+    sessions = []
+    update_id = 1
+    for user in range(args.users):
+        sessions.append([for_user(update, 1_000_000 + user, update_id + i) for i, update in enumerate(recorded)])
+        update_id += len(recorded)
+    total = update_id - 1
+
+    await supervisor.start()
+    try:
+        host, port = supervisor.address
+        acks = []
+        slots = asyncio.Semaphore(args.concurrency)
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=f'http://{host}:{port}', limits=limits, timeout=60) as client:
+            async def post_session(session):
+                # One user's updates go out in order, like Telegram delivers a chat's updates
+                for update in session:
+                    async with slots:
+                        started = time.perf_counter()
+                        response = await client.post(supervisor.path, json=update,
+                                                     headers={'X-Telegram-Bot-Api-Secret-Token': SECRET})
+                        response.raise_for_status()
+                        acks.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(post_session(session) for session in sessions))
+            while await processed(supervisor) < total:
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - started
+    finally:
+        await supervisor.stop()
+
+    return {
+        'workers': workers,
+        'updates': total,
+        'seconds': round(elapsed, 2),
+        'updates_per_sec': round(total / elapsed, 1),
+        'ack': summarize(acks),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=64, help='POSTs in flight at once')
+    parser.add_argument('--database', choices=('shared', 'per-shard'), default='shared')
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='seconds per fake Bot API call')
+    parser.add_argument('--base-port', type=int, default=9300)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker_main(args.telegram_latency)
+        return
+
+    report = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for run_index, workers in enumerate(args.workers):
+            report.append(asyncio.run(run(workers, args, args.base_port + 100 * run_index, tmp)))
+    baseline = report[0]['updates_per_sec'] / report[0]['workers']
+    for row in report:
+        row['scaling_efficiency'] = round(row['updates_per_sec'] / (baseline * row['workers']), 2)
+    print_report({'cpu_count': os.cpu_count(), 'database': args.database, 'runs': report})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Where the hot Database paths spend their time, per SQL statement shape.
+
+Runs get_debt, get_user_debts, get_history_page (show_history) and
+add_payment + confirm_payment against a seeded database with query_stats on,
+then reports Database.stats() and the cost of the timing itself (the same
+workload with query_stats off).
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from database import Database
+from benchmarks.common import print_report, seed_debts
+
+
+def workload(db, iterations, users, seed=7):
+    rng = random.Random(seed)
+    db.get_history_page(1, limit=1)  # warm the pool
+    started = time.perf_counter()
+    for _ in range(iterations):
+        user_id = rng.randrange(1, users + 1)
+        debts = db.get_user_debts(user_id)
+        db.get_debt(debts[0]['id'])
+        db.get_history_page(user_id, limit=10)
+        payment_id = db.add_payment(debts[0]['id'], user_id, 100)
+        db.confirm_payment(payment_id)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--debts-per-user', type=int, default=30)
+    parser.add_argument('--slow-ms', type=float, default=5.0)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    report = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for query_stats in (False, True):
+            db = Database(os.path.join(tmp, f'profile{int(query_stats)}.db'),
+                          query_stats=query_stats, slow_query_ms=args.slow_ms)
+            seed_debts(db, user_count=args.users, debts_per_user=args.debts_per_user)
+            if query_stats:
+                db.query_stats.reset()
+            elapsed = workload(db, args.iterations, args.users)
+            report['timed' if query_stats else 'untimed'] = {'seconds': round(elapsed, 3)}
+            if query_stats:
+                stats = db.stats()
+                stats['queries'] = stats['queries'][:args.top]
+                report['stats'] = stats
+            db.close()
+    report['overhead_pct'] = round((report['timed']['seconds'] / report['untimed']['seconds'] - 1) * 100, 1)
+    print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""End-to-end handler latency through the webhook, replaying recorded updates.
+
+Runs the real bot Application against FakeRequest (no Telegram), a
+FakeOpenAIServer and a throwaway database, serves it with
+webhook.WebhookServer on localhost and POSTs the Update JSON in
+benchmarks/fixtures/updates.json the way Telegram would, once per
+simulated user. Each user sends the next update only after the previous
+one was handled, like a person waiting for the reply.
+
+Reports the HTTP acknowledgement latency and the end-to-end latency (POST
+until the handler returns) per kind of update.
+
+    python -m benchmarks.replay_webhook --users 20 --concurrency 8
+"""
+import argparse
+import asyncio
+import copy
+import json
+import os
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+
+from benchmarks.common import print_report, summarize
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.fakes import FakeRequest
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'updates.json')
+SECRET = 'replay-secret'
+
+
+def load_updates(path=FIXTURES):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def for_user(update, user_id, update_id):
+    """Copy of a recorded update as if user_id had sent it"""
+    update = copy.deepcopy(update)
+    update['update_id'] = update_id
+    body = update.get('message') or update['callback_query']
+    body['from']['id'] = user_id
+    message = body if 'message' in update else body.get('message')
+    if message:
+        message['chat']['id'] = user_id
+        if 'voice' in message:
+            # A different recording per user, so the transcript cache only helps repeats
+            message['voice']['file_unique_id'] += f'-{user_id}'
+    return update
+
+
+def kind(update):
+    if 'callback_query' in update:
+        return f"callback {update['callback_query']['data']}"
+    message = update['message']
+    return 'voice' if 'voice' in message else message.get('text', 'other')
+
+
+class Replayer:
+    """POSTs updates to the webhook and times them until the handler finishes"""
+
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.pending = {}
+        self.ack = []
+        self.e2e = defaultdict(list)
+        self.errors = 0
+
+    async def handled(self, update, context):
+        future = self.pending.pop(update.update_id, None)
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    async def send(self, update, timeout):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[update['update_id']] = future
+        started = time.perf_counter()
+        response = await self.client.post(self.path, json=update,
+                                          headers={'X-Telegram-Bot-Api-Secret-Token': SECRET})
+        self.ack.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            self.errors += 1
+            self.pending.pop(update['update_id'], None)
+            return
+        try:
+            finished = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.errors += 1
+            return
+        self.e2e[kind(update)].append(finished - started)
+
+    async def user_session(self, updates, slots, timeout):
+        async with slots:
+            for update in updates:
+                await self.send(update, timeout)
+
+
+async def replay(args):
+    # Imported here so the environment below is in place before bot.py builds its clients
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    from bot import build_application
+    from webhook import WebhookServer, start_application, stop_application
+
+    request = FakeRequest(latency=args.telegram_latency)
+    application = build_application('123:replay', request=request)
+    server = WebhookServer(application, listen='127.0.0.1', port=0, secret=SECRET)
+
+    recorded = load_updates(args.fixtures)
+    sessions = []
+    update_id = 1
+    for index in range(args.users):
+        session = []
+        for _ in range(args.repeat):
+            for update in recorded:
+                session.append(for_user(update, args.first_user_id + index, update_id))
+                update_id += 1
+        sessions.append(session)
+
+    await start_application(application)
+    await server.start()
+    host, port = server.address
+    async with httpx.AsyncClient(base_url=f'http://{host}:{port}', timeout=args.timeout) as client:
+        replayer = Replayer(client, server.path)
+        # Runs after the bot's handlers (group 0) have returned
+        application.add_handler(TypeHandler(Update, replayer.handled), group=1)
+        slots = asyncio.Semaphore(args.concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(replayer.user_session(session, slots, args.timeout) for session in sessions))
+        elapsed = time.perf_counter() - started
+    await server.stop()
+    await stop_application(application)
+
+    calls = defaultdict(int)
+    for _, method, _ in request.calls:
+        calls[method] += 1
+    return {
+        'users': args.users,
+        'updates': update_id - 1,
+        'errors': replayer.errors,
+        'updates_per_sec': round((update_id - 1) / elapsed, 1),
+        'ack': summarize(replayer.ack),
+        'end_to_end': {name: summarize(samples) for name, samples in replayer.e2e.items()},
+        'bot_api_calls': dict(calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures', default=FIXTURES)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=10, help='users sending at the same time')
+    parser.add_argument('--repeat', type=int, default=1, help='times each user replays the fixtures')
+    parser.add_argument('--first-user-id', type=int, default=100000)
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='seconds per fake Bot API call')
+    parser.add_argument('--chat-latency', type=float, default=0.05)
+    parser.add_argument('--transcribe-latency', type=float, default=0.1)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp, FakeOpenAIServer(
+            chat_latency=args.chat_latency, transcribe_latency=args.transcribe_latency) as openai_server:
+        os.environ['DATABASE_PATH'] = os.path.join(tmp, 'replay.db')
+        os.environ['OPENAI_BASE_URL'] = openai_server.base_url
+        os.environ.setdefault('OPENAI_API_KEY', 'sk-replay')
+        print_report(asyncio.run(replay(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,100 @@
 import os
 import io
+import asyncio
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram.helpers import escape_markdown
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-from openai import OpenAI
+from telegram.request import HTTPXRequest
 import httpx
 from datetime import datetime
 import json
 import re
+import time
+import fast_parser
+import metrics
+import tracing
+import settlement
+from parse_cache import ParseCache, PARSE_CACHE_PERSIST
 from database import Database
+from async_database import AsyncDatabase
+from openai_client import OpenAIGateway, OpenAIBusyError
+from notifier import OutboxDispatcher
+from webhook import WEBHOOK_URL, run_webhook
+from update_processor import PerUserUpdateProcessor
+from sharding import IS_SHARD_WORKER, SHARD_COUNT, SHARD_INDEX, owns
+from conversation_state import (
+    ConversationStore, PENDING_DEBT_TTL, OnboardingState, ClarificationState, MissingInfoState,
+    GroupSplitState, UnequalSplitState, CollectUsernamesState, AddUsernameState, PaymentState, PendingDebt,
+)
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-db = Database()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+db = AsyncDatabase(Database(os.getenv('DATABASE_PATH', '/app/data/debt_manager.db')))
+TRANSCRIPT_CACHE_MAX_ROWS = int(os.getenv('TRANSCRIPT_CACHE_MAX_ROWS', '10000'))
+TRANSCRIPT_CACHE_MAX_AGE = float(os.getenv('TRANSCRIPT_CACHE_MAX_AGE_DAYS', '30')) * 86400
+HISTORY_PAGE_SIZE = 10
+ai_client = OpenAIGateway(api_key=os.getenv("OPENAI_API_KEY"))
+parse_cache = ParseCache(store=db if PARSE_CACHE_PERSIST else None)
+outbox = OutboxDispatcher(db, shard=(SHARD_INDEX, SHARD_COUNT) if IS_SHARD_WORKER else None)
+metrics_server = None
+# Callback data prefixes in the order handle_callback routes them; exact matches have no trailing _
+CALLBACK_ROUTES = (
+    'onboard_', 'settle_', 'circle_', 'skip_circle_', 'split_', 'history_', 'confirm_group',
+    'final_confirm_group', 'cancel_group', 'confirm_', 'cancel_', 'accept_debt_', 'dispute_debt_',
+    'pay_', 'adduser_', 'remind_',
+)
+
+def callback_route(update):
+    """Metrics label for a callback query: the handle_callback branch it takes"""
+    data = update.callback_query.data or ''
+    for route in CALLBACK_ROUTES:
+        if data.startswith(route) if route.endswith('_') else data == route:
+            return route.rstrip('_')
+    return 'other'
+
 class DebtBot:
     def __init__(self):
         self.db = db
-        self.pending_debts = {}
-        self.user_context = {}
+        self.pending_debts = ConversationStore('pending_debts', store=db, ttl=PENDING_DEBT_TTL, key_type=str)
+        self.user_context = ConversationStore('user_context', store=db)
+
+    async def post_init(self, application):
+        """Reload conversation state persisted before the last restart and start sending the outbox"""
+        # A shard worker only keeps the state of its own users; pending keys are pending_<user id>_<time>
+        await self.user_context.load(owns=owns)
+        await self.pending_debts.load(owns=lambda key: owns(int(key.split('_')[1])))
+        outbox.start(application.bot)
+        global metrics_server
+        metrics_server = await metrics.start_server()
+
+    async def notify(self, chat_id, text, parse_mode=None, reply_markup=None, notification=None):
+        """Queue a message for the outbox dispatcher instead of sending it inline"""
+        await self.db.enqueue_message(
+            chat_id, text, parse_mode=parse_mode,
+            reply_markup=reply_markup.to_json() if reply_markup else None,
+            notification=notification,
+            trace=json.dumps(tracing.current_context()) if tracing.current_context() else None
+        )
+        outbox.wake()
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        self.db.create_user(user.id, user.username, user.first_name, user.last_name)
+        await self.db.create_user(user.id, user.username, user.first_name, user.last_name)
         if user.username:
-            self.db.link_pending_debts(f'@{user.username}', user.id)
+            await self.db.link_pending_debts(f'@{user.username}', user.id)
         
         # Check if new user (no circles)
-        circles = self.db.get_user_circles(user.id)
+        circles = await self.db.get_user_circles(user.id)
         if not circles:
             # Start onboarding
-            self.user_context[user.id] = {
-                'action': 'onboarding_start',
-                'categories': ['Hamkasblar', 'Do\'stlar', 'Sinfdoshlar', 'Oila a\'zolari'],
-                'current_category_index': 0,
-                'names': []
-            }
+            self.user_context[user.id] = OnboardingState(
+                action='onboarding_start',
+                categories=['Hamkasblar', 'Do\'stlar', 'Sinfdoshlar', 'Oila a\'zolari'],
+                current_category_index=0,
+                names=[]
+            )
             keyboard = [
                 [InlineKeyboardButton("✅ Ha, kiritaman", callback_data="onboard_yes")],
                 [InlineKeyboardButton("❌ O'tkazib yuborish", callback_data="onboard_skip")]
@@ -50,7 +108,7 @@ class DebtBot:
         
         keyboard = [[KeyboardButton("💰 Men qarzdorman"), KeyboardButton("💵 Menga qarzlar")],
                     [KeyboardButton("📜 Tarix"), KeyboardButton("📊 Statistika")],
-                    [KeyboardButton("ℹ️ Yordam")]]
+                    [KeyboardButton("🤝 Hisob-kitob"), KeyboardButton("ℹ️ Yordam")]]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         
         welcome_text = (f"👋 Salom, {user.first_name}!\n\n"
@@ -82,6 +140,7 @@ class DebtBot:
             category = user_ctx['categories'][user_ctx['current_category_index']]
             await query.edit_message_text(f"📂 {category} ro'yxatini kiriting:\n\nIsmlarni matn sifatida yozing yoki ovozli xabar yuboring (masalan: 'Murad, Ibrohim, Asadbek').\n\nO'tkazib yuborish uchun 'Skip' yozing.")
             user_ctx['action'] = 'onboarding_names'
+            self.user_context.save(user_id)
             return
         
         # Other onboarding callbacks if needed
@@ -99,6 +158,8 @@ class DebtBot:
             await self.show_history(update, context)
         elif text == "📊 Statistika":
             await self.show_statistics(update, context)
+        elif text == "🤝 Hisob-kitob":
+            await self.show_settlement_circles(update, context)
         elif text == "ℹ️ Yordam":
             await self.help_command(update, context)
         else:
@@ -126,6 +187,7 @@ class DebtBot:
                 user_ctx['names'] = names
                 user_ctx['current_name_index'] = 0
                 user_ctx['action'] = 'onboarding_username'
+                self.user_context.save(user_id)
                 await self.ask_next_username(update, context)
                 return
             
@@ -136,24 +198,25 @@ class DebtBot:
                     return
                 
                 category = user_ctx['categories'][user_ctx['current_category_index']]
-                circle_id = self.db.create_circle(user_id, category)
+                circle_id = await self.db.create_circle(user_id, category)
                 
                 name = user_ctx['names'][user_ctx['current_name_index']]
                 member_user_id = None
                 if username.startswith('@'):
                     clean_username = username[1:]
-                    user = self.db.find_user_by_username(clean_username)
+                    user = await self.db.find_user_by_username(clean_username)
                     if user:
                         member_user_id = user['user_id']
                 else:
                     clean_username = username
                 
-                self.db.add_member_to_circle(circle_id, name, member_user_id, clean_username)
+                await self.db.add_member_to_circle(circle_id, name, member_user_id, clean_username)
                 
                 await update.message.reply_text(f"✅ {name} uchun {username} saqlandi.")
                 
                 if user_ctx['current_name_index'] + 1 < len(user_ctx['names']):
                     user_ctx['current_name_index'] += 1
+                    self.user_context.save(user_id)
                     await self.ask_next_username(update, context)
                 else:
                     await self.next_onboarding_category(update, context)
@@ -167,28 +230,43 @@ class DebtBot:
         
         try:
             voice = update.message.voice
-            file = await context.bot.get_file(voice.file_id)
-            buffer = io.BytesIO()
-            await file.download_to_memory(buffer)
-            buffer.seek(0)  # Reset buffer position
-            
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=("voice.ogg", buffer.read(), "audio/ogg")
-            )
-            transcribed_text = transcript.text
+            
+            async def notify_queued():
+                await processing_msg.edit_text("⏳ Navbatdasiz. So'rovlar ko'p, birozdan keyin javob beraman...")
+            
+            with tracing.span('transcribe', duration=voice.duration) as span:
+                # A forwarded or retried voice note has the same file_unique_id
+                cached = await self.db.get_cached_transcript(voice.file_unique_id)
+                if span is not None:
+                    span.set('cached', bool(cached))
+                if cached:
+                    # Counting the hit need not hold up the reply
+                    self.db.submit_write('record_transcript_hit', voice.file_unique_id)
+                    transcribed_text = cached['text']
+                    logger.info(f"Transcript cache hit for {voice.file_unique_id} ({cached['duration']}s of audio skipped)")
+                else:
+                    file = await context.bot.get_file(voice.file_id)
+                    buffer = io.BytesIO()
+                    await file.download_to_memory(buffer)
+                    buffer.seek(0)  # Reset buffer position
+                    
+                    transcribed_text = await ai_client.transcribe(buffer.read(), on_queued=notify_queued)
+                    await self.db.save_transcript(
+                        voice.file_unique_id, transcribed_text, voice.duration,
+                        max_rows=TRANSCRIPT_CACHE_MAX_ROWS, max_age=TRANSCRIPT_CACHE_MAX_AGE
+                    )
             
             await processing_msg.edit_text(f"📝 Matn: _{transcribed_text}_\n\n⏳ Tahlil qilyapman...", parse_mode='Markdown')
             
-            debt_info = await self.parse_debt_info(transcribed_text, user)
+            debt_info = await self.parse_debt_info(transcribed_text, user, on_queued=notify_queued)
             
             if debt_info.get('clarification_needed'):
                 # Store context for clarification response
-                self.user_context[user.id] = {
-                    'action': 'clarification',
-                    'original_text': transcribed_text,
-                    'processing_msg_id': processing_msg.message_id
-                }
+                self.user_context[user.id] = ClarificationState(
+                    action='clarification',
+                    original_text=transcribed_text,
+                    processing_msg_id=processing_msg.message_id
+                )
                 await processing_msg.edit_text(debt_info['clarification_question'])
                 return
             
@@ -197,11 +275,11 @@ class DebtBot:
                 return
             
             if debt_info.get('is_group'):
-                self.user_context[user.id] = {
-                    'action': 'split_type',
-                    'debt_info': debt_info,
-                    'processing_msg_id': processing_msg.message_id
-                }
+                self.user_context[user.id] = GroupSplitState(
+                    action='split_type',
+                    debt_info=debt_info,
+                    processing_msg_id=processing_msg.message_id
+                )
                 keyboard = [
                     [InlineKeyboardButton("🟰 Teng bo'lish", callback_data="split_equal")],
                     [InlineKeyboardButton("📊 Turli bo'lish", callback_data="split_unequal")]
@@ -216,6 +294,9 @@ class DebtBot:
             
             await self.create_debt_confirmation(update, context, debt_info, processing_msg)
             
+        except OpenAIBusyError as e:
+            logger.warning(f"Voice rejected, OpenAI queue full: {e}")
+            await processing_msg.edit_text("⏳ Hozir so'rovlar juda ko'p. Iltimos, birozdan keyin qayta yuboring.")
         except Exception as e:
             logger.error(f"Error processing voice: {e}")
             await processing_msg.edit_text(f"❌ Xatolik yuz berdi: {str(e)[:100]}")
@@ -233,9 +314,10 @@ class DebtBot:
         if user_ctx['current_category_index'] + 1 < len(user_ctx['categories']):
             user_ctx['current_category_index'] += 1
             user_ctx['names'] = []
+            user_ctx['action'] = 'onboarding_names'
+            self.user_context.save(user_id)
             category = user_ctx['categories'][user_ctx['current_category_index']]
             await update.message.reply_text(f"📂 {category} ro'yxatini kiriting:\n\nIsmlarni matn sifatida yozing yoki ovozli xabar yuboring.\n\nO'tkazib yuborish uchun 'Skip'.")
-            user_ctx['action'] = 'onboarding_names'
         else:
             del self.user_context[user_id]
             await update.message.reply_text("✅ Onboarding tugallandi! Botdan foydalanishingiz mumkin.")
@@ -243,7 +325,7 @@ class DebtBot:
     async def send_welcome(self, message):
         keyboard = [[KeyboardButton("💰 Men qarzdorman"), KeyboardButton("💵 Menga qarzlar")],
                     [KeyboardButton("📜 Tarix"), KeyboardButton("📊 Statistika")],
-                    [KeyboardButton("ℹ️ Yordam")]]
+                    [KeyboardButton("🤝 Hisob-kitob"), KeyboardButton("ℹ️ Yordam")]]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         
         welcome_text = ("👋 Salom!\n\n"
@@ -261,6 +343,7 @@ class DebtBot:
         await message.reply_text(welcome_text, parse_mode='Markdown', reply_markup=reply_markup)
     
     # In handle_group_split or after parsing is_group
+    @tracing.traced('process_group_participants')
     async def process_group_participants(self, update, context, debt_info, processing_msg):
         user_id = update.effective_user.id
         participants = debt_info.get('participants', [])
@@ -269,23 +352,23 @@ class DebtBot:
         unresolved = []
         
         for name in participants:
-            matches = self.db.search_member_by_name(user_id, name)
+            matches = await self.db.search_member_by_name(user_id, name)
             if matches:
                 if len(matches) == 1:
                     # Confirm
-                    self.user_context[user_id] = {
-                        'action': 'confirm_match',
-                        'name': name,
-                        'match': matches[0],
-                        'debt_info': debt_info,
-                        'processing_msg_id': processing_msg.message_id
-                    }
+                    self.user_context[user_id] = GroupSplitState(
+                        action='confirm_match',
+                        name=name,
+                        match=matches[0],
+                        debt_info=debt_info,
+                        processing_msg_id=processing_msg.message_id
+                    )
                     keyboard = [
                         [InlineKeyboardButton("✅ Ha", callback_data=f"confirm_match_{name}")],
                         [InlineKeyboardButton("❌ Yo'q", callback_data=f"no_match_{name}")]
                     ]
                     await update.message.reply_text(
-                        f"{name} uchun {matches[0]['circle_name']} dagi {matches[0]['member_username']}ni nazarda tutdingizmi?",
+                        f"{name} uchun {matches[0]['circle_name']} dagi {matches[0]['member_username'] or matches[0]['member_name']}ni nazarda tutdingizmi?",
                         reply_markup=InlineKeyboardMarkup(keyboard)
                     )
                     return
@@ -293,7 +376,7 @@ class DebtBot:
                     # Multiple matches - choose
                     keyboard = []
                     for i, m in enumerate(matches):
-                        keyboard.append([InlineKeyboardButton(f"{m['circle_name']} - {m['member_username']}", callback_data=f"select_match_{i}_{name}")])
+                        keyboard.append([InlineKeyboardButton(f"{m['circle_name']} - {m['member_username'] or m['member_name']}", callback_data=f"select_match_{i}_{name}")])
                     await update.message.reply_text(f"{name} uchun bir nechta moslik topildi. Qaysi biri?", reply_markup=InlineKeyboardMarkup(keyboard))
                     return
             else:
@@ -301,36 +384,20 @@ class DebtBot:
         
         # For unresolved, ask usernames
         if unresolved:
-            self.user_context[user_id] = {
-                'action': 'add_group_usernames',
-                'unresolved': unresolved,
-                'current_index': 0,
-                'usernames': [None] * len(unresolved),
-                'debt_info': debt_info,
-                'processing_msg_id': processing_msg.message_id
-            }
+            self.user_context[user_id] = CollectUsernamesState(
+                action='add_group_usernames',
+                unresolved=unresolved,
+                current_index=0,
+                usernames=[None] * len(unresolved),
+                debt_info=debt_info,
+                processing_msg_id=processing_msg.message_id
+            )
             await update.message.reply_text(f"❓ {unresolved[0]} uchun username kiriting (@ bilan).")
         else:
             # All resolved - proceed to split
             debt_info['resolved_participants'] = resolved
             await self.handle_group_split(update, debt_info, processing_msg)
 
-    def search_member_by_name(self, user_id, name):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-    
-        cursor.execute('''
-            SELECT cm.*, uc.circle_name, u.user_id as linked_user_id, u.username as db_username
-            FROM circle_members cm
-            JOIN user_circles uc ON cm.circle_id = uc.id
-            LEFT JOIN users u ON cm.member_user_id = u.user_id
-            WHERE uc.user_id = ? AND (cm.member_name LIKE ? OR cm.member_username LIKE ? OR u.username LIKE ?)
-        ''', (user_id, f'%{name}%', f'%{name}%', f'%{name}%'))
-        
-        members = cursor.fetchall()
-        conn.close()
-        return [dict(m) for m in members]
-
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         help_text = ("📖 *Yordam*\n\n"
                     "*Qarz yaratish:*\n"
@@ -344,10 +411,24 @@ class DebtBot:
         
         await update.message.reply_text(help_text, parse_mode='Markdown')
     
-    async def parse_debt_info(self, text: str, user):
+    @tracing.traced('parse_debt_info')
+    async def parse_debt_info(self, text: str, user, on_queued=None):
+        started = time.perf_counter()
+        result = fast_parser.parse(text)
+        if result is not None:
+            fast_parser.stats.record('fast', time.perf_counter() - started)
+            result['original_text'] = text
+            return result
+        
         try:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
+            cached = await parse_cache.get(text)
+            if cached is not None:
+                fast_parser.stats.record('cache', time.perf_counter() - started)
+                cached['original_text'] = text
+                return cached
+            
+            content = await ai_client.chat(
+                on_queued=on_queued,
                 messages=[
 
                     {"role": "system", "content": """Sen qarz va umumiy xarajatlarni tahlil qiluvchi AI yordamchisan. Matn o'zbek, rus va ingliz tillarida aralash bo'lishi mumkin.
@@ -415,7 +496,7 @@ class DebtBot:
                 temperature=0.3
             )
             
-            content = response.choices[0].message.content.strip()
+            content = content.strip()
             
             # Remove markdown code blocks if present
             if content.startswith('```'):
@@ -424,13 +505,19 @@ class DebtBot:
                     content = content[4:].strip()
             
             result = json.loads(content)
+            await parse_cache.put(text, result)
             result['original_text'] = text
+            fast_parser.stats.record('llm', time.perf_counter() - started)
             return result
+        except OpenAIBusyError as e:
+            logger.warning(f"Parse rejected, OpenAI queue full: {e}")
+            return {'error': "Hozir so'rovlar juda ko'p, birozdan keyin qayta urinib ko'ring."}
         except Exception as e:
             logger.error(f"Parse error: {e}")
             logger.error(f"Full error details: {type(e).__name__}: {str(e)}")
             return {'error': f'Tushunmadim. Xato: {str(e)[:50]}'}
     
+    @tracing.traced('check_missing_info')
     def check_missing_info(self, debt_info):
         missing = []
         if not debt_info.get('amount'):
@@ -444,6 +531,7 @@ class DebtBot:
             missing.append('direction')
         return missing
     
+    @tracing.traced('request_missing_info')
     async def request_missing_info(self, update, context, debt_info, missing, processing_msg):
         questions = {
             'amount': "💰 Qancha pul? (masalan: 50000)",
@@ -453,16 +541,17 @@ class DebtBot:
             'reason': "📝 Nima uchun?"
         }
         
-        self.user_context[update.effective_user.id] = {
-            'debt_info': debt_info,
-            'missing': missing,
-            'step': 0,
-            'message_id': processing_msg.message_id
-        }
+        self.user_context[update.effective_user.id] = MissingInfoState(
+            debt_info=debt_info,
+            missing=missing,
+            step=0,
+            message_id=processing_msg.message_id
+        )
         
         question_text = questions.get(missing[0], "Ma'lumot kerak")
         await processing_msg.edit_text(f"❓ {question_text}")
     
+    @tracing.traced('create_debt_confirmation')
     async def create_debt_confirmation(self, update, context, debt_info, processing_msg):
         user = update.effective_user
         direction = debt_info.get('direction')
@@ -480,27 +569,27 @@ class DebtBot:
         debtor_username = None
         creditor_username = None
         if debtor_name and debtor_name.startswith('@'):
-            other_user = self.db.find_user_by_username(debtor_name)
+            other_user = await self.db.find_user_by_username(debtor_name)
             debtor_username = debtor_name if not other_user else None
         elif creditor_name and creditor_name.startswith('@'):
-            other_user = self.db.find_user_by_username(creditor_name)
+            other_user = await self.db.find_user_by_username(creditor_name)
             creditor_username = creditor_name if not other_user else None
         
         debt_id = f"pending_{user.id}_{int(datetime.now().timestamp())}"
-        self.pending_debts[debt_id] = {
-            'creator_id': user.id,
-            'creditor_id': creditor_id if direction == 'owe_me' else (other_user['user_id'] if other_user else None),
-            'debtor_id': debtor_id if direction == 'i_owe' else (other_user['user_id'] if other_user else None),
-            'creditor_name': creditor_name,
-            'debtor_name': debtor_name,
-            'creditor_username': creditor_username,
-            'debtor_username': debtor_username,
-            'amount': debt_info['amount'],
-            'currency': debt_info.get('currency', "so'm"),
-            'reason': debt_info.get('reason', 'Sababsiz'),
-            'direction': direction,
-            'other_user': other_user
-        }
+        self.pending_debts[debt_id] = PendingDebt(
+            creator_id=user.id,
+            creditor_id=creditor_id if direction == 'owe_me' else (other_user['user_id'] if other_user else None),
+            debtor_id=debtor_id if direction == 'i_owe' else (other_user['user_id'] if other_user else None),
+            creditor_name=creditor_name,
+            debtor_name=debtor_name,
+            creditor_username=creditor_username,
+            debtor_username=debtor_username,
+            amount=debt_info['amount'],
+            currency=debt_info.get('currency', "so'm"),
+            reason=debt_info.get('reason', 'Sababsiz'),
+            direction=direction,
+            other_user=other_user
+        )
         
         confirmation_text = ("✅ *Tasdiqlash kerak:*\n\n"
                            f"💰 Summa: {debt_info['amount']:,} so'm\n"
@@ -567,13 +656,13 @@ class DebtBot:
                     'reason': reason
                 })
 
-            self.user_context[user_id] = {
-                'action': 'confirm_group',
-                'group_debts': group_debts,
-                'my_share': my_share,
-                'total_to_receive': total_to_receive,
-                'processing_msg_id': processing_msg_id
-            }
+            self.user_context[user_id] = GroupSplitState(
+                action='confirm_group',
+                group_debts=group_debts,
+                my_share=my_share,
+                total_to_receive=total_to_receive,
+                processing_msg_id=processing_msg_id
+            )
             
             confirmation_text = f"✅ *Teng bo'lish:*\n\n"
             confirmation_text += f"💰 Jami to'langan: {total_amount:,.0f} so'm\n"
@@ -592,17 +681,17 @@ class DebtBot:
             await query.edit_message_text(confirmation_text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
         
         elif split_type == 'unequal':
-            self.user_context[user_id] = {
-                'action': 'unequal_split',
-                'debtors': debtors,
-                'current_debtor_index': 0,
-                'amounts': [0] * num_debtors,
-                'total_amount': total_amount,
-                'payer_name': payer_name,
-                'reason': reason,
-                'currency': currency,
-                'processing_msg_id': processing_msg_id
-            }
+            self.user_context[user_id] = UnequalSplitState(
+                action='unequal_split',
+                debtors=debtors,
+                current_debtor_index=0,
+                amounts=[0] * num_debtors,
+                total_amount=total_amount,
+                payer_name=payer_name,
+                reason=reason,
+                currency=currency,
+                processing_msg_id=processing_msg_id
+            )
             await query.edit_message_text(f"❓ {debtors[0]} qancha qaytarishi kerak? (so'm)")
     
     async def confirm_group_debts(self, query):
@@ -616,57 +705,25 @@ class DebtBot:
             await query.edit_message_text("❌ Ma'lumot topilmadi.")
             return
         
-        created_count = 0
-
-        for debt_info in group_debts:
-
-            debtor_user_id = None
-            debtor_username = debt_info.get('debtor_username')
-
-            # 1️⃣ Try onboarding circle FIRST
-            circle_member = self.db.find_circle_member(user_id, debt_info['debtor_name'])
-            if circle_member:
-                debtor_user_id = circle_member.get('member_user_id')
-                debtor_username = circle_member.get('member_username')
-
-            # 2️⃣ Fallback: global username lookup
-            if not debtor_user_id and debtor_username:
-                user = self.db.find_user_by_username(debtor_username)
-                if user:
-                    debtor_user_id = user['user_id']
-
-            # 3️⃣ Create debt WITH resolved debtor
-            created_debt_id = self.db.create_debt(
-                creator_id=user_id,
-                creditor_id=user_id,
-                debtor_id=debtor_user_id,
-                amount=debt_info['amount'],
-                currency=debt_info['currency'],
-                reason=debt_info['reason'],
-                creditor_username=None,
-                debtor_username=debtor_username
+        try:
+            created = await self.db.create_group_expense(
+                user_id, group_debts,
+                notification_template=(
+                    "🔔 Yangi qarz:\n"
+                    "Siz {amount:,} so'm qaytarishingiz kerak.\n"
+                    "Sabab: {reason}"
+                ),
+                reply_markup=lambda debt_id: InlineKeyboardMarkup([[
+                    InlineKeyboardButton("✅ Tasdiqlash", callback_data=f"accept_debt_{debt_id}"),
+                    InlineKeyboardButton("❌ Rad etish", callback_data=f"dispute_debt_{debt_id}")
+                ]]).to_json()
             )
-
-            # 4️⃣ Auto-confirm creditor
-            self.db.confirm_debt(created_debt_id, user_id)
-
-            # 5️⃣ Notify debtor if linked
-            if debtor_user_id:
-                try:
-                    await query.get_bot().send_message(
-                        debtor_user_id,
-                        f"🔔 Yangi qarz:\n"
-                        f"Siz {debt_info['amount']:,} so'm qaytarishingiz kerak.\n"
-                        f"Sabab: {debt_info['reason']}",
-                        reply_markup=InlineKeyboardMarkup([[
-                            InlineKeyboardButton("✅ Tasdiqlash", callback_data=f"accept_debt_{created_debt_id}"),
-                            InlineKeyboardButton("❌ Rad etish", callback_data=f"dispute_debt_{created_debt_id}")
-                        ]])
-                    )
-                except:
-                    pass
-
-            created_count += 1
+        except Exception as e:
+            logger.error(f"Error creating group debts: {e}")
+            await query.edit_message_text("❌ Qarzlarni yaratishda xatolik yuz berdi. Qaytadan urinib ko'ring.")
+            return
+        created_count = len(created)
+        outbox.wake()
 
         result_text = f"✅ {created_count} ta qarz muvaffaqiyatli yaratildi!\n\n"
         result_text += f"📌 Sizing ulushingiz: {my_share:,.0f} so'm\n"
@@ -686,54 +743,29 @@ class DebtBot:
             await query.answer("❌ Ma'lumot topilmadi.")
             return
         
-        created_count = 0
-        for debt_info in group_debts:
-            try:
-                # Create debt in database
-                debt_id = self.db.create_debt(
-                    creator_id=user_id,
-                    creditor_id=user_id,  # Creator is always creditor in group expenses
-                    debtor_id=debt_info.get('debtor_id'),
-                    amount=debt_info['amount'],
-                    currency=debt_info.get('currency', "so'm"),
-                    reason=debt_info['reason'],
-                    creditor_username=None,
-                    debtor_username=debt_info.get('debtor_username') if not debt_info.get('debtor_id') else None
-                )
-                
-                # Auto-confirm creator side
-                self.db.confirm_debt(debt_id, user_id)
-                
-                # Send notification to debtor if registered
-                if debt_info.get('debtor_id'):
-                    notification_text = (
-                        "🔔 *Yangi umumiy xarajat qarzingiz*\n\n"
-                        f"💰 Summa: {debt_info['amount']:,.0f} so'm\n"
-                        f"📝 Sabab: {debt_info['reason']}\n"
-                        f"👤 Qarz beruvchi: {query.from_user.first_name}\n\n"
-                        "Iltimos, tasdiqlang:"
-                    )
-                    
-                    keyboard = [[
-                        InlineKeyboardButton("✅ Tasdiqlash", callback_data=f"accept_debt_{debt_id}"),
-                        InlineKeyboardButton("❌ E'tiroz", callback_data=f"dispute_debt_{debt_id}")
-                    ]]
-                    
-                    try:
-                        await query.get_bot().send_message(
-                            chat_id=debt_info['debtor_id'],
-                            text=notification_text,
-                            parse_mode='Markdown',
-                            reply_markup=InlineKeyboardMarkup(keyboard)
-                        )
-                        self.db.create_notification(debt_info['debtor_id'], debt_id, notification_text, 'group_debt_created')
-                    except Exception as e:
-                        logger.error(f"Notification error for debt {debt_id}: {e}")
-                
-                created_count += 1
-                
-            except Exception as e:
-                logger.error(f"Error creating group debt: {e}")
+        # Braces in the name would be taken for template fields
+        creditor_name = query.from_user.first_name.replace('{', '{{').replace('}', '}}')
+        try:
+            created = await self.db.create_group_expense(
+                user_id, group_debts,
+                notification_template=(
+                    "🔔 *Yangi umumiy xarajat qarzingiz*\n\n"
+                    "💰 Summa: {amount:,.0f} so'm\n"
+                    "📝 Sabab: {reason}\n"
+                    f"👤 Qarz beruvchi: {creditor_name}\n\n"
+                    "Iltimos, tasdiqlang:"
+                ),
+                parse_mode='Markdown',
+                reply_markup=lambda debt_id: InlineKeyboardMarkup([[
+                    InlineKeyboardButton("✅ Tasdiqlash", callback_data=f"accept_debt_{debt_id}"),
+                    InlineKeyboardButton("❌ E'tiroz", callback_data=f"dispute_debt_{debt_id}")
+                ]]).to_json()
+            )
+        except Exception as e:
+            logger.error(f"Error creating group debts: {e}")
+            created = []
+        created_count = len(created)
+        outbox.wake()
         for debt in group_debts:
             username_display = debt.get('debtor_username', 'username yo\'q')
             if debt.get('debtor_id'):
@@ -752,10 +784,10 @@ class DebtBot:
             [InlineKeyboardButton("❌ Bekor qilish", callback_data="cancel_group")]
         ]
         del self.user_context[user_id]
-        self.user_context[query.from_user.id] = {
-            'action': 'final_confirm_group',
-            'group_debts': group_debts
-        }
+        self.user_context[query.from_user.id] = GroupSplitState(
+            action='final_confirm_group',
+            group_debts=group_debts
+        )
         
         await query.edit_message_text(
             confirmation_text,
@@ -765,7 +797,7 @@ class DebtBot:
         await query.edit_message_text(
             f"✅ *Guruh qarzlari yaratildi!*\n\n"
             f"📊 Yaratilgan qarzlar: {created_count}\n"
-            f"🔔 Ro'yxatdan o'tgan a'zolarga xabarnomalar yuborildi.\n"
+            f"🔔 Ro'yxatdan o'tgan a'zolarga xabarnomalar navbatga qo'yildi.\n"
             f"⏳ Ro'yxatdan o'tmagan a'zolar botga kirganida xabarnoma olishadi.",
             parse_mode='Markdown'
         )
@@ -776,6 +808,9 @@ class DebtBot:
         if data.startswith('onboard_'):
             await self.onboard_callback(query, data)
             return
+        if data.startswith('settle_'):
+            await self.show_settlement(query, data)
+            return
         if data.startswith('circle_'):
             circle_name = data.replace('circle_', '')
             user_ctx = self.user_context.get(query.from_user.id, {})
@@ -795,11 +830,11 @@ class DebtBot:
             payer_name = debt_info.get('payer_name', '')
             debtors = [p for p in participants if p.lower() not in ['men', payer_name.lower()]]
             
-            circle_id = self.db.create_circle(query.from_user.id, circle_display_name)
+            circle_id = await self.db.create_circle(query.from_user.id, circle_display_name)
             
             # Add members to circle
             for debtor in debtors:
-                self.db.add_member_to_circle(circle_id, debtor)
+                await self.db.add_member_to_circle(circle_id, debtor)
             
             await query.answer(f"✅ '{circle_display_name}' guruh saqlandi!")
             
@@ -810,6 +845,7 @@ class DebtBot:
         if data.startswith('skip_circle_'):
             split_type = data.replace('skip_circle_', '')
             self.user_context[query.from_user.id]['circle_asked'] = True
+            self.user_context.save(query.from_user.id)
             await self.handle_group_split(query, split_type)
             return
         if data.startswith('split_'):
@@ -817,15 +853,9 @@ class DebtBot:
             await self.handle_group_split(query, split_type)
             return
         if data.startswith('history_'):
-            page = int(data.replace('history_', ''))
-            # Pass the query as update
-            class FakeUpdate:
-                def __init__(self, callback_query):
-                    self.callback_query = callback_query
-                    self.effective_user = callback_query.from_user
-            
-            fake_update = FakeUpdate(query)
-            await self.show_history(fake_update, context, page=page)
+            _, direction, cursor = data.split('_')
+            await self.show_history(update, context, cursor=int(cursor),
+                                    direction='prev' if direction == 'p' else 'next')
             return
         
         if data == 'confirm_group':
@@ -857,6 +887,7 @@ class DebtBot:
         elif data.startswith('remind_'):
             await self.send_reminder_callback(query, data)
     
+    @tracing.traced('confirm_debt_callback')
     async def confirm_debt_callback(self, query, data):
         debt_id = data.replace('confirm_', '')
         
@@ -866,7 +897,7 @@ class DebtBot:
         
         debt_data = self.pending_debts[debt_id]
         
-        created_debt_id = self.db.create_debt(
+        created_debt_id = await self.db.create_debt(
             creator_id=debt_data['creator_id'],
             creditor_id=debt_data['creditor_id'],
             debtor_id=debt_data['debtor_id'],
@@ -878,14 +909,14 @@ class DebtBot:
         )
         
         if debt_data['creator_id'] == debt_data['creditor_id']:
-            self.db.confirm_debt(created_debt_id, debt_data['creator_id'])
+            await self.db.confirm_debt(created_debt_id, debt_data['creator_id'])
         elif debt_data['creator_id'] == debt_data['debtor_id']:
-            self.db.confirm_debt(created_debt_id, debt_data['creator_id'])
+            await self.db.confirm_debt(created_debt_id, debt_data['creator_id'])
         
         other_user_id = (debt_data['debtor_id'] if debt_data['creator_id'] == debt_data['creditor_id'] 
                         else debt_data['creditor_id'])
         
-        notification_sent = False
+        notification_queued = False
         if other_user_id is not None:
             notification_text = ("🔔 *Yangi qarz*\n\n"
                                f"💰 Summa: {debt_data['amount']:,} so'm\n"
@@ -896,24 +927,21 @@ class DebtBot:
                         InlineKeyboardButton("❌ E'tiroz", callback_data=f"dispute_debt_{created_debt_id}")]]
             
             try:
-                await query.get_bot().send_message(
-                    chat_id=other_user_id,
-                    text=notification_text,
-                    parse_mode='Markdown',
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                await self.notify(
+                    other_user_id, notification_text, parse_mode='Markdown',
+                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    notification=(created_debt_id, 'debt_created')
                 )
-                
-                self.db.create_notification(other_user_id, created_debt_id, notification_text, 'debt_created')
-                notification_sent = True
+                notification_queued = True
             except Exception as e:
                 logger.error(f"Notification error: {e}")
         
-        if notification_sent:
+        if notification_queued:
             await query.edit_message_text(
                 f"✅ Qarz yaratildi!\n\n"
                 f"💰 {debt_data['amount']:,} so'm\n"
                 f"📝 {debt_data['reason']}\n\n"
-                "Xabarnoma yuborildi.",
+                "🔔 Xabarnoma navbatga qo'yildi, tez orada yetkaziladi.",
                 parse_mode='Markdown'
             )
         else:
@@ -935,22 +963,23 @@ class DebtBot:
             return
         
         # Store the debt_id in user context
-        self.user_context[query.from_user.id] = {
-            'action': 'add_username',
-            'debt_id': debt_id
-        }
+        self.user_context[query.from_user.id] = AddUsernameState(
+            action='add_username',
+            debt_id=debt_id
+        )
         
         await query.message.reply_text(
             "👤 Foydalanuvchi username kiriting:\n\n"
             "Masalan: @fayzkhanov\n\n"
             "Yoki kontakt ulashing."
         )
+    @tracing.traced('accept_debt_callback')
     async def accept_debt_callback(self, query, data):
         debt_id = int(data.replace('accept_debt_', ''))
         user_id = query.from_user.id
         
-        if self.db.confirm_debt(debt_id, user_id):
-            debt = self.db.get_debt(debt_id)
+        if await self.db.confirm_debt(debt_id, user_id):
+            debt = await self.db.get_debt(debt_id)
             
             if debt and debt['status'] == 'active':
                 await query.edit_message_text(
@@ -960,13 +989,7 @@ class DebtBot:
                     parse_mode='Markdown'
                 )
                 
-                try:
-                    await query.get_bot().send_message(
-                        chat_id=debt['creator_id'],
-                        text=f"✅ {debt['amount']:,} so'm qarzingiz tasdiqlandi!"
-                    )
-                except:
-                    pass
+                await self.notify(debt['creator_id'], f"✅ {debt['amount']:,} so'm qarzingiz tasdiqlandi!")
             else:
                 await query.edit_message_text("✅ Tasdiqingiz qayd qilindi.")
         else:
@@ -974,66 +997,102 @@ class DebtBot:
     
     async def dispute_debt_callback(self, query, data):
         debt_id = int(data.replace('dispute_debt_', ''))
-        debt = self.db.get_debt(debt_id)
+        debt = await self.db.get_debt(debt_id)
         
         if debt:
-            self.db.cancel_debt(debt_id, debt['creator_id'])
+            await self.db.cancel_debt(debt_id, debt['creator_id'])
             await query.edit_message_text("❌ Qarz bekor qilindi.")
             
-            try:
-                await query.get_bot().send_message(
-                    chat_id=debt['creator_id'],
-                    text=f"❌ {debt['amount']:,} so'm qarzga e'tiroz bildirildi."
-                )
-            except:
-                pass
+            await self.notify(debt['creator_id'], f"❌ {debt['amount']:,} so'm qarzga e'tiroz bildirildi.")
     async def show_my_debts(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        debts = self.db.get_user_debts(user_id)
+        balances = await self.db.get_pair_balances(user_id)
         
-        if not debts:
+        if not balances:
             await update.message.reply_text("📊 Faol qarzlar yo'q.\n\nQarz yaratish uchun ovozli xabar yuboring!")
             return
         
-        # Group by person
-        person_totals = {}
-        
-        for debt in debts:
-            balance = self.db.get_debt_balance(debt['id'])
-            
-            if debt['debtor_id'] == user_id:
-                # I owe this person
-                person = debt['creditor_name']
-                person_totals[person] = person_totals.get(person, 0) - balance  # Negative
-            else:
-                # This person owes me
-                person = debt['debtor_name']
-                person_totals[person] = person_totals.get(person, 0) + balance  # Positive
-        
         message = "📊 *Mening qarzlarim (odam bo'yicha):*\n\n"
         
-        total_owe = 0
-        total_owed = 0
+        # Totals per currency; a positive net_amount means they owe me
+        total_owe = {}
+        total_owed = {}
         
-        for person, balance in sorted(person_totals.items()):
+        for row in sorted(balances, key=lambda row: (row['first_name'] or row['username'] or '').lower()):
+            person = row['first_name'] or row['username'] or f"#{row['other_id']}"
+            balance = row['net_amount']
+            currency = row['currency']
             if balance < 0:
-                total_owe += abs(balance)
-                message += f"🔴 {person}: Men qarzdorman {abs(balance):,} so'm\n"
-            elif balance > 0:
-                total_owed += balance
-                message += f"🟢 {person}: Menga qarz {balance:,} so'm\n"
+                total_owe[currency] = total_owe.get(currency, 0) + abs(balance)
+                message += f"🔴 {person}: Men qarzdorman {abs(balance):,.0f} {currency}\n"
+            else:
+                total_owed[currency] = total_owed.get(currency, 0) + balance
+                message += f"🟢 {person}: Menga qarz {balance:,.0f} {currency}\n"
         
         message += f"\n━━━━━━━━━━━━━━━━\n"
         message += f"💰 *Jami:*\n"
-        message += f"❌ Men to'lashim kerak: {total_owe:,} so'm\n"
-        message += f"✅ Menga to'lashlari kerak: {total_owed:,} so'm\n"
-        message += f"📊 Balans: {(total_owed - total_owe):+,} so'm"
+        for currency in sorted(total_owe.keys() | total_owed.keys()):
+            owe = total_owe.get(currency, 0)
+            owed = total_owed.get(currency, 0)
+            message += f"❌ Men to'lashim kerak: {owe:,.0f} {currency}\n"
+            message += f"✅ Menga to'lashlari kerak: {owed:,.0f} {currency}\n"
+            message += f"📊 Balans: {(owed - owe):+,.0f} {currency}\n"
         
         await update.message.reply_text(message, parse_mode='Markdown')
     
+    async def show_settlement_circles(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        circles = await self.db.get_user_circles(update.effective_user.id)
+        
+        if not circles:
+            await update.message.reply_text("👥 Sizda hali guruhlar yo'q. Umumiy xarajat qayd qilganingizda guruh yaratiladi.")
+            return
+        
+        keyboard = [[InlineKeyboardButton(f"👥 {circle['circle_name']}", callback_data=f"settle_{circle['id']}")]
+                    for circle in circles]
+        await update.message.reply_text(
+            "🤝 Qaysi guruh uchun hisob-kitob qilamiz?",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    
+    async def show_settlement(self, query, data):
+        """Preview the fewest transfers that settle the requester's debts with the circle's members"""
+        circle_id = int(data.replace('settle_', ''))
+        user_id = query.from_user.id
+        
+        circle = next((c for c in await self.db.get_user_circles(user_id) if c['id'] == circle_id), None)
+        if not circle:
+            await query.edit_message_text("❌ Guruh topilmadi.")
+            return
+        
+        names = {user_id: "Siz"}
+        for member in await self.db.get_circle_members(circle_id):
+            if member['member_user_id']:
+                names.setdefault(member['member_user_id'], member['member_name'])
+        
+        # Only the requester's own balances: debts between other members are not theirs to see
+        pairs = [pair for pair in await self.db.get_pair_balances_among(names.keys())
+                 if user_id in (pair['user_a'], pair['user_b'])]
+        names = {member_id: escape_markdown(str(name)) for member_id, name in names.items()}
+        circle_name = escape_markdown(circle['circle_name'])
+        if not pairs:
+            await query.edit_message_text(f"✅ *{circle_name}*: ochiq qarzlar yo'q.", parse_mode='Markdown')
+            return
+        
+        message = f"🤝 *Hisob-kitob: {circle_name}*\n\n"
+        transfer_count = 0
+        for currency in sorted({pair['currency'] for pair in pairs}):
+            balances = settlement.net_balances([pair for pair in pairs if pair['currency'] == currency])
+            for debtor, creditor, amount in settlement.settle(balances):
+                message += f"• {names.get(debtor, debtor)} → {names.get(creditor, creditor)}: {amount:,.0f} {currency}\n"
+                transfer_count += 1
+        
+        message += (f"\n📉 {len(pairs)} ta qarz o'rniga {transfer_count} ta o'tkazma yetarli.\n"
+                    "Faqat ko'rib chiqish uchun, qarzlar o'zgartirilmadi.")
+        await query.edit_message_text(message, parse_mode='Markdown')
+    
     async def show_i_owe(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        debts = self.db.get_debts_i_owe(user_id)
+        debts = await self.db.get_debts_i_owe(user_id)
         
         if not debts:
             await update.message.reply_text("💰 To'lash uchun qarzlar yo'q! 🎉")
@@ -1043,7 +1102,7 @@ class DebtBot:
         total = 0
         
         for debt in debts:
-            balance = self.db.get_debt_balance(debt['id'])
+            balance = debt['balance']
             total += balance
             message += f"🔴 *#{debt['id']}* {debt['creditor_name']}ga\n"
             message += f"   💵 {balance:,} so'm\n   📝 {debt['reason']}\n   📅 {debt['created_at'][:10]}\n\n"
@@ -1052,7 +1111,7 @@ class DebtBot:
         
         keyboard = []
         for debt in debts[:5]:
-            balance = self.db.get_debt_balance(debt['id'])
+            balance = debt['balance']
             if balance > 0:
                 keyboard.append([InlineKeyboardButton(
                     f"💳 To'lash #{debt['id']} ({balance:,} so'm)", 
@@ -1064,7 +1123,7 @@ class DebtBot:
     
     async def show_owed_to_me(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        debts = self.db.get_debts_owed_to_me(user_id)
+        debts = await self.db.get_debts_owed_to_me(user_id)
         
         if not debts:
             await update.message.reply_text("💵 Sizga hech kim qarz emas.")
@@ -1074,7 +1133,7 @@ class DebtBot:
         total = 0
         
         for debt in debts:
-            balance = self.db.get_debt_balance(debt['id'])
+            balance = debt['balance']
             total += balance
             message += f"🟢 *#{debt['id']}* {debt['debtor_name']}dan\n"
             message += f"   💵 {balance:,} so'm\n   📝 {debt['reason']}\n   📅 {debt['created_at'][:10]}\n\n"
@@ -1084,7 +1143,7 @@ class DebtBot:
     
     async def show_statistics(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        all_debts = self.db.get_user_debts(user_id)
+        all_debts = await self.db.get_user_debts(user_id)
         
         total_owe = 0
         total_owed = 0
@@ -1093,7 +1152,7 @@ class DebtBot:
         paid_count = 0
         
         for debt in all_debts:
-            balance = self.db.get_debt_balance(debt['id'])
+            balance = debt['balance']
             
             if debt['status'] == 'active':
                 active_count += 1
@@ -1118,31 +1177,20 @@ class DebtBot:
         
         await update.message.reply_text(stats_text, parse_mode='Markdown')
     
-    async def show_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def show_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE, cursor=None, direction='next'):
         user_id = update.effective_user.id
-        conn = self.db.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT d.*, 
-                c.first_name as creditor_first_name, c.username as creditor_db_username,
-                b.first_name as debtor_first_name, b.username as debtor_db_username,
-                d.creditor_username, d.debtor_username
-            FROM debts d
-            LEFT JOIN users c ON d.creditor_id = c.user_id
-            LEFT JOIN users b ON d.debtor_id = b.user_id
-            WHERE d.creator_id = ? OR d.creditor_id = ? OR d.debtor_id = ?
-            ORDER BY d.created_at DESC LIMIT 20
-        ''', (user_id, user_id, user_id))
-        
-        debts = cursor.fetchall()
-        conn.close()
+        page = await self.db.get_history_page(user_id, cursor, HISTORY_PAGE_SIZE, direction)
+        debts = page['debts']
+        query = update.callback_query
         
         if not debts:
-            await update.message.reply_text("📜 Tarix bo'sh.")
+            if query:
+                await query.edit_message_text("📜 Tarix bo'sh.")
+            else:
+                await update.message.reply_text("📜 Tarix bo'sh.")
             return
         
-        message = "📜 *Tarix (oxirgi 20):*\n\n"
+        message = "📜 *Tarix:*\n\n"
         status_emoji = {'pending': '🟡', 'active': '🔵', 'paid': '✅', 'cancelled': '❌'}
         
         for debt in debts:
@@ -1161,11 +1209,22 @@ class DebtBot:
             message += f"   💰 {d['amount']:,} so'm\n   📝 {d['reason']}\n"
             message += f"   📅 {d['created_at'][:10]}\n   Status: {d['status']}\n\n"
         
-        await update.message.reply_text(message, parse_mode='Markdown')
+        # Cursors are debt ids: history_p_<id> pages to newer debts, history_n_<id> to older ones
+        buttons = []
+        if page['prev_cursor']:
+            buttons.append(InlineKeyboardButton("⬅️ Yangiroq", callback_data=f"history_p_{page['prev_cursor']}"))
+        if page['next_cursor']:
+            buttons.append(InlineKeyboardButton("Eskiroq ➡️", callback_data=f"history_n_{page['next_cursor']}"))
+        reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+        
+        if query:
+            await query.edit_message_text(message, parse_mode='Markdown', reply_markup=reply_markup)
+        else:
+            await update.message.reply_text(message, parse_mode='Markdown', reply_markup=reply_markup)
     
     async def send_reminder_callback(self, query, data):
         debt_id = int(data.replace('remind_', ''))
-        debt = self.db.get_debt(debt_id)
+        debt = await self.db.get_debt(debt_id)
         
         if not debt or debt['creditor_id'] != query.from_user.id:
             await query.edit_message_text("❌ Xatolik.")
@@ -1175,7 +1234,7 @@ class DebtBot:
             await query.edit_message_text("❌ Eslatma yuborib bo'lmaydi (foydalanuvchi ro'yxatdan o'tmagan).")
             return
         
-        balance = self.db.get_debt_balance(debt_id)
+        balance = await self.db.get_debt_balance(debt_id)
         
         if balance <= 0:
             await query.edit_message_text("✅ Qarz to'langan!")
@@ -1189,28 +1248,27 @@ class DebtBot:
                         "Iltimos, qarzni to'lashni unutmang!")
         
         try:
-            await query.get_bot().send_message(chat_id=debt['debtor_id'], text=reminder_text, parse_mode='Markdown')
-            await query.edit_message_text(f"✅ Eslatma yuborildi!\n\n📨 {debt['debtor_name']}ga")
-            self.db.create_notification(debt['debtor_id'], debt_id, "Qarz eslatmasi", 'reminder')
+            await self.notify(debt['debtor_id'], reminder_text, parse_mode='Markdown', notification=(debt_id, 'reminder'))
+            await query.edit_message_text(f"✅ Eslatma navbatga qo'yildi!\n\n📨 {debt['debtor_name']}ga")
         except Exception as e:
             logger.error(f"Reminder error: {e}")
             await query.edit_message_text("❌ Eslatma yuborilmadi.")
     
     async def initiate_payment(self, query, data):
         debt_id = int(data.replace('pay_', ''))
-        debt = self.db.get_debt(debt_id)
+        debt = await self.db.get_debt(debt_id)
         
         if not debt:
             await query.edit_message_text("❌ Qarz topilmadi.")
             return
         
-        balance = self.db.get_debt_balance(debt_id)
+        balance = await self.db.get_debt_balance(debt_id)
         
         if balance <= 0:
             await query.edit_message_text("✅ Qarz to'langan!")
             return
         
-        self.user_context[query.from_user.id] = {'action': 'payment', 'debt_id': debt_id, 'balance': balance}
+        self.user_context[query.from_user.id] = PaymentState(action='payment', debt_id=debt_id, balance=balance)
         
         await query.message.reply_text(
             f"💳 *To'lov:*\n\n"
@@ -1224,7 +1282,7 @@ class DebtBot:
         contact = update.message.contact
         user_id = update.effective_user.id
         
-        self.db.create_user(contact.user_id, None, contact.first_name, contact.last_name)
+        await self.db.create_user(contact.user_id, None, contact.first_name, contact.last_name)
         
         if user_id in self.user_context and 'debt_info' in self.user_context[user_id]:
             debt_ctx = self.user_context[user_id]
@@ -1236,6 +1294,7 @@ class DebtBot:
                 debt_info['debtor_name'] = contact.first_name
             
             debt_ctx['contact_user_id'] = contact.user_id
+            self.user_context.save(user_id)
             await update.message.reply_text(f"✅ Kontakt qabul qilindi: {contact.first_name}")
         else:
             await update.message.reply_text(f"✅ Kontakt saqlandi: {contact.first_name}")
@@ -1259,10 +1318,10 @@ class DebtBot:
                     await update.message.reply_text(f"❌ Summa qoldiqdan katta.\nQoldiq: {balance:,} so'm")
                     return
                 
-                payment_id = self.db.add_payment(debt_id, user_id, amount)
-                debt = self.db.get_debt(debt_id)
-                self.db.confirm_payment(payment_id)
-                new_balance = self.db.get_debt_balance(debt_id)
+                payment_id = await self.db.add_payment(debt_id, user_id, amount)
+                debt = await self.db.get_debt(debt_id)
+                await self.db.confirm_payment(payment_id)
+                new_balance = await self.db.get_debt_balance(debt_id)
                 
                 if new_balance == 0:
                     await update.message.reply_text(
@@ -1279,13 +1338,10 @@ class DebtBot:
                         parse_mode='Markdown'
                     )
                 
-                try:
-                    await context.bot.send_message(
-                        chat_id=debt['creditor_id'],
-                        text=f"💰 {debt['debtor_name']} {amount:,} so'm to'ladi!\nQarz: #{debt_id}\nQoldiq: {new_balance:,} so'm"
-                    )
-                except:
-                    pass
+                await self.notify(
+                    debt['creditor_id'],
+                    f"💰 {debt['debtor_name']} {amount:,} so'm to'ladi!\nQarz: #{debt_id}\nQoldiq: {new_balance:,} so'm"
+                )
                 
                 del self.user_context[user_id]
                 
@@ -1298,7 +1354,7 @@ class DebtBot:
             username = text.strip()
             
             # Try to find user
-            other_user = self.db.find_user_by_username(username)
+            other_user = await self.db.find_user_by_username(username)
             
             if other_user:
                 user_ctx['debtor_usernames'][debtors[current_index]] = {
@@ -1322,6 +1378,7 @@ class DebtBot:
             # Move to next debtor or finish
             if current_index + 1 < len(debtors):
                 user_ctx['current_debtor_index'] = current_index + 1
+                self.user_context.save(user_id)
                 await update.message.reply_text(
                     f"👤 {debtors[current_index + 1]} uchun telegram username yoki kontaktni ulashing:\n\n"
                     f"Masalan: @username"
@@ -1399,11 +1456,11 @@ class DebtBot:
                 return
             
             if debt_info.get('is_group'):
-                self.user_context[user_id] = {
-                    'action': 'split_type',
-                    'debt_info': debt_info,
-                    'processing_msg_id': processing_msg.message_id
-                }
+                self.user_context[user_id] = GroupSplitState(
+                    action='split_type',
+                    debt_info=debt_info,
+                    processing_msg_id=processing_msg.message_id
+                )
                 keyboard = [
                     [InlineKeyboardButton("🟰 Teng bo'lish", callback_data="split_equal")],
                     [InlineKeyboardButton("📊 Turli bo'lish", callback_data="split_unequal")]
@@ -1436,6 +1493,7 @@ class DebtBot:
             # Move to next debtor
             if index + 1 < len(debtors):
                 user_ctx['current_debtor_index'] += 1
+                self.user_context.save(user_id)
                 next_debtor = debtors[index + 1]
                 await update.message.reply_text(f"❓ {next_debtor} uchun qancha? (so'm)")
                 return
@@ -1449,6 +1507,7 @@ class DebtBot:
                 # User assigned more than total → restart
                 user_ctx['current_debtor_index'] = 0
                 user_ctx['amounts'] = [0] * len(debtors)
+                self.user_context.save(user_id)
                 await update.message.reply_text(
                     f"❌ Siz jami {assigned_total:,.0f} so'm belgiladingiz, lekin umumiy xarajat {total_amount:,.0f} so'm edi.\n"
                     f"Ortiqcha summa kiritildi. Qaytadan boshlaymiz:\n\n"
@@ -1474,13 +1533,13 @@ class DebtBot:
                     })
             
             # Save for final confirmation
-            self.user_context[user_id] = {
-                'action': 'confirm_group',
-                'group_debts': group_debts,
-                'my_share': my_share,
-                'total_to_receive': assigned_total,
-                'processing_msg_id': user_ctx['processing_msg_id']
-            }
+            self.user_context[user_id] = GroupSplitState(
+                action='confirm_group',
+                group_debts=group_debts,
+                my_share=my_share,
+                total_to_receive=assigned_total,
+                processing_msg_id=user_ctx['processing_msg_id']
+            )
             
             confirmation_text = "✅ *Turli bo'lish natijasi:*\n\n"
             confirmation_text += f"💰 Jami to'langan: {total_amount:,.0f} so'm\n"
@@ -1507,7 +1566,7 @@ class DebtBot:
             
             if debt_id in self.pending_debts:
                 # Find user by username
-                other_user = self.db.find_user_by_username(username)
+                other_user = await self.db.find_user_by_username(username)
                 
                 if other_user:
                     debt_data = self.pending_debts[debt_id]
@@ -1521,6 +1580,7 @@ class DebtBot:
                         debt_data['creditor_name'] = other_user['first_name']
                     
                     debt_data['other_user'] = other_user
+                    self.pending_debts.save(debt_id)
                     
                     await update.message.reply_text(
                         f"✅ Foydalanuvchi topildi: {other_user['first_name']}\n\n"
@@ -1538,6 +1598,7 @@ class DebtBot:
                         debt_data['creditor_username'] = f'@{clean_username}'
                         debt_data['creditor_name'] = clean_username.capitalize()
                     debt_data['other_user'] = None
+                    self.pending_debts.save(debt_id)
                     await update.message.reply_text(
                         f"✅ Username saqlandi: @{clean_username}\n"
                         "Foydalanuvchi botga kirganda avto yangilanadi.\n"
@@ -1569,6 +1630,7 @@ class DebtBot:
             
             if step + 1 < len(missing):
                 user_ctx['step'] = step + 1
+                self.user_context.save(user_id)
                 next_field = missing[step + 1]
                 questions = {
                     'amount': "💰 Qancha pul?",
@@ -1582,24 +1644,69 @@ class DebtBot:
                 processing_msg = await update.message.reply_text("⏳ Qayd qilyapman...")
                 await self.create_debt_confirmation(update, context, debt_info, processing_msg)
 
+async def shutdown(application):
+    """Stop the outbox, drain queued database calls and close the OpenAI connection pool"""
+    if metrics_server:
+        await metrics_server.stop()
+    await outbox.stop()
+    tracing.shutdown()
+    await ai_client.aclose()
+    db.close()
+
+def build_application(token, request=None):
+    """The Application with every handler registered; request replaces the HTTP client (tests, benchmarks)"""
+    bot = DebtBot()
+    # Different users are handled in parallel, each user's updates in order
+    builder = (Application.builder().token(token).concurrent_updates(PerUserUpdateProcessor())
+               .post_init(bot.post_init).post_shutdown(shutdown))
+    # Same pool size the builder would use; TimedRequest counts Bot API calls as telegram time
+    builder = builder.request(metrics.TimedRequest(request or HTTPXRequest(connection_pool_size=256)))
+    application = builder.build()
+    # Benchmarks read the conversation stores through it
+    application.bot_data['debt_bot'] = bot
+    
+    def resume_trace(update):
+        """Trace context of the conversation state this update continues"""
+        query = update.callback_query
+        if query and query.data and '_' in query.data:
+            # confirm_<debt id> / cancel_<debt id> answer a pending debt
+            trace = bot.pending_debts.trace(query.data.split('_', 1)[1])
+            if trace:
+                return trace
+        return bot.user_context.trace(update.effective_user.id) if update.effective_user else None
+    
+    def instrument(name, callback, route=None, resume=None):
+        return metrics.instrument(name, tracing.trace_handler(name, callback, resume), route)
+    
+    # /start, /help and a voice note begin a conversation; the rest may answer one
+    application.add_handler(CommandHandler("start", instrument('start', bot.start)))
+    application.add_handler(CommandHandler("help", instrument('help_command', bot.help_command)))
+    application.add_handler(MessageHandler(filters.VOICE, instrument('handle_voice', bot.handle_voice)))
+    application.add_handler(MessageHandler(filters.CONTACT,
+                                           instrument('handle_contact', bot.handle_contact, resume=resume_trace)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND,
+                                           instrument('handle_text', bot.handle_text, resume=resume_trace)))
+    application.add_handler(CallbackQueryHandler(
+        instrument('handle_callback', bot.handle_callback, callback_route, resume=resume_trace)))
+    return application
+
 def main():
     TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
     
     if not TOKEN:
         raise ValueError("TELEGRAM_BOT_TOKEN environment variable not set")
     
-    application = Application.builder().token(TOKEN).build()
-    bot = DebtBot()
-    
-    application.add_handler(CommandHandler("start", bot.start))
-    application.add_handler(CommandHandler("help", bot.help_command))
-    application.add_handler(MessageHandler(filters.VOICE, bot.handle_voice))
-    application.add_handler(MessageHandler(filters.CONTACT, bot.handle_contact))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_text))
-    application.add_handler(CallbackQueryHandler(bot.handle_callback))
+    application = build_application(TOKEN)
     
-    logger.info("Bot starting...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if IS_SHARD_WORKER:
+        logger.info(f"Bot starting as shard {SHARD_INDEX}/{SHARD_COUNT}...")
+        asyncio.run(run_webhook(application, url=None))
+    elif WEBHOOK_URL:
+        logger.info("Bot starting in webhook mode...")
+        asyncio.run(run_webhook(application))
+    else:
+        logger.info("Bot starting...")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,282 @@
+"""Bounded, persistent store for per-user conversation state and pending debts.
+
+ConversationStore behaves like the dicts it replaces (``in``, ``[]``, ``get``,
+``del``, ``pop``) but keeps at most ``max_size`` entries, drops entries not
+written to for ``ttl`` seconds and, given an AsyncDatabase, writes every
+change through to SQLite so in-flight flows survive a restart.
+
+Values are compact ``__slots__`` objects with dict-style access. A slot that
+was never assigned behaves like a missing key, so ``'debt_info' in state``
+and ``state.get('action')`` work exactly as they did on plain dicts.
+Handlers that mutate a state object in place must call ``store.save(key)``
+for the change to be persisted.
+"""
+import json
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_TTL = float(os.getenv('CONVERSATION_TTL', str(24 * 3600)))
+CONVERSATION_MAX_ENTRIES = int(os.getenv('CONVERSATION_MAX_ENTRIES', '10000'))
+PENDING_DEBT_TTL = float(os.getenv('PENDING_DEBT_TTL', str(7 * 24 * 3600)))
+STATS_LOG_EVERY = 500
+
+
+class State:
+    """Base class for conversation state: slots with dict-style access"""
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for key, value in fields.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(f'{type(self).__name__} has no field {key!r}')
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__ if hasattr(self, key)}
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+
+class OnboardingState(State):
+    __slots__ = ('action', 'categories', 'current_category_index', 'names', 'current_name_index')
+
+
+class ClarificationState(State):
+    __slots__ = ('action', 'original_text', 'processing_msg_id')
+
+
+class MissingInfoState(State):
+    __slots__ = ('action', 'debt_info', 'missing', 'step', 'message_id', 'contact_user_id')
+
+
+class GroupSplitState(State):
+    """Group expense from split type choice through confirmation"""
+    __slots__ = ('action', 'debt_info', 'processing_msg_id', 'split_type', 'circle_asked',
+                 'name', 'match', 'group_debts', 'my_share', 'total_to_receive', 'contact_user_id')
+
+
+class UnequalSplitState(State):
+    __slots__ = ('action', 'debtors', 'current_debtor_index', 'amounts', 'total_amount',
+                 'payer_name', 'reason', 'currency', 'processing_msg_id')
+
+
+class CollectUsernamesState(State):
+    """Asking for the usernames of group participants one by one"""
+    __slots__ = ('action', 'unresolved', 'current_index', 'usernames', 'debtors', 'current_debtor_index',
+                 'debtor_usernames', 'group_debts', 'debt_info', 'processing_msg_id', 'contact_user_id')
+
+
+class AddUsernameState(State):
+    __slots__ = ('action', 'debt_id')
+
+
+class PaymentState(State):
+    __slots__ = ('action', 'debt_id', 'balance')
+
+
+class PendingDebt(State):
+    """A debt shown to its creator and waiting for the confirm button"""
+    __slots__ = ('creator_id', 'creditor_id', 'debtor_id', 'creditor_name', 'debtor_name',
+                 'creditor_username', 'debtor_username', 'amount', 'currency', 'reason',
+                 'direction', 'other_user')
+
+
+STATE_TYPES = {cls.__name__: cls for cls in (
+    OnboardingState, ClarificationState, MissingInfoState, GroupSplitState, UnequalSplitState,
+    CollectUsernamesState, AddUsernameState, PaymentState, PendingDebt,
+)}
+
+
+def dump_state(state, trace=None):
+    """Serialize a state object, and the trace context it was saved in, to JSON"""
+    data = {'type': type(state).__name__, 'fields': state.to_dict()}
+    if trace:
+        data['trace'] = trace
+    return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def load_entry(payload):
+    """(state, trace context or None) from dump_state output"""
+    data = json.loads(payload)
+    trace = data.get('trace')
+    return STATE_TYPES[data['type']](**data['fields']), tuple(trace) if trace else None
+
+
+def load_state(payload):
+    """Rebuild a state object from dump_state output"""
+    return load_entry(payload)[0]
+
+
+class ConversationStore:
+    """Dict-like LRU + TTL store of State objects, written through to SQLite"""
+
+    def __init__(self, namespace, store=None, ttl=CONVERSATION_TTL, max_size=CONVERSATION_MAX_ENTRIES, key_type=int):
+        self.namespace = namespace
+        self.store = store
+        self.ttl = ttl
+        self.max_size = max_size
+        self.key_type = key_type
+        self._entries = OrderedDict()  # key -> (expires_at, state)
+        self._sizes = {}  # key -> serialized size in bytes
+        self._traces = {}  # key -> trace context the state was last saved in
+        self.evictions = 0
+        self.expirations = 0
+        self._writes = 0
+
+    def _persist(self, method, *args):
+        if self.store is None:
+            return
+        try:
+            self.store.submit_write(method, self.namespace, *args)
+        except RuntimeError as e:
+            # Writer already shut down
+            logger.warning(f"Could not persist {self.namespace} state: {e}")
+
+    def _drop(self, key):
+        self._entries.pop(key, None)
+        self._sizes.pop(key, None)
+        self._traces.pop(key, None)
+        self._persist('delete_conversation_state', str(key))
+
+    def _live(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            self.expirations += 1
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def __contains__(self, key):
+        return self._live(key) is not None
+
+    def __getitem__(self, key):
+        state = self._live(key)
+        if state is None:
+            raise KeyError(key)
+        return state
+
+    def get(self, key, default=None):
+        state = self._live(key)
+        return default if state is None else state
+
+    def __setitem__(self, key, state):
+        expires_at = time.time() + self.ttl
+        self._entries[key] = (expires_at, state)
+        self._entries.move_to_end(key)
+        # The next update of this conversation continues the trace it was saved in
+        trace = tracing.current_context()
+        if trace:
+            self._traces[key] = trace
+        else:
+            self._traces.pop(key, None)
+        payload = dump_state(state, trace)
+        self._sizes[key] = sys.getsizeof(payload)
+        self._persist('save_conversation_state', str(key), payload, expires_at)
+        self._evict()
+        self._writes += 1
+        if self._writes % STATS_LOG_EVERY == 0:
+            logger.info(f"{self.namespace} state stats: {self.stats()}")
+
+    def trace(self, key):
+        """Trace context the state under key was saved in, or None"""
+        return self._traces.get(key) if self._live(key) is not None else None
+
+    def save(self, key):
+        """Persist an in-place change to the state stored under key"""
+        state = self._live(key)
+        if state is not None:
+            self[key] = state
+
+    def __delitem__(self, key):
+        if self._live(key) is None:
+            raise KeyError(key)
+        self._drop(key)
+
+    def pop(self, key, *default):
+        state = self._live(key)
+        if state is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self._drop(key)
+        return state
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        now = time.time()
+        while self._entries:
+            key, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at < now:
+                self.expirations += 1
+            elif len(self._entries) > self.max_size:
+                self.evictions += 1
+            else:
+                break
+            self._drop(key)
+
+    async def load(self, owns=None):
+        """Warm the store from SQLite; call once at startup.
+        
+        owns(key) limits the load to the keys this process serves (its shard).
+        """
+        if self.store is None:
+            return
+        rows = await self.store.load_conversation_state(self.namespace)
+        for row in rows:
+            try:
+                state, trace = load_entry(row['state'])
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Skipping unreadable {self.namespace} state for {row['key']}: {e}")
+                continue
+            key = self.key_type(row['key'])
+            if owns is not None and not owns(key):
+                continue
+            self._entries[key] = (row['expires_at'], state)
+            self._sizes[key] = sys.getsizeof(row['state'])
+            if trace:
+                self._traces[key] = trace
+        self._evict()
+        logger.info(f"Restored {len(self._entries)} {self.namespace} entries")
+
+    def stats(self):
+        """Entry-count and memory gauges"""
+        return {
+            'entries': len(self._entries),
+            'approx_bytes': sum(self._sizes.values()),
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
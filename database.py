@@ -1,27 +1,671 @@
+import functools
 import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 import logging
 
+from transliteration import normalize_name, phonetic_key, trigrams
+
 logger = logging.getLogger(__name__)
 
+# Applied to every connection the pool opens. WAL lets the readers run while
+# the writer commits, and NORMAL sync is durable across app crashes in WAL mode.
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+    ('cache_size', -16000),       # negative = KiB, ~16 MB page cache per connection
+    ('mmap_size', 134217728),     # 128 MB memory-mapped reads
+    ('temp_store', 'MEMORY'),
+)
+STATEMENT_CACHE_SIZE = 256
+READER_POOL_SIZE = 4
+BATCH_SIZE = 500
+# Opt-in per-statement timing (see QueryStats); slow statements are logged with their plan
+DB_QUERY_STATS = os.getenv('DB_QUERY_STATS', '0') == '1'
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', '50'))
+
+# Columns added after the first release: (table, column, definition).
+# _add_missing_columns() ALTERs them into databases created before they existed.
+ADDED_COLUMNS = (
+    ('debts', 'paid_total', 'REAL NOT NULL DEFAULT 0'),
+    ('notifications', 'delivered_at', 'REAL'),
+    ('outbox', 'trace', 'TEXT'),
+)
+
+# Debt statuses whose outstanding balance counts towards pair_balances
+LEDGER_STATUSES = ('pending', 'active')
+
+# Secondary indexes owned by init_database: (name, table, columns, partial WHERE).
+INDEXES = (
+    ('idx_debts_debtor_status', 'debts', 'debtor_id, status, created_at', None),
+    ('idx_debts_creditor_status', 'debts', 'creditor_id, status, created_at', None),
+    ('idx_debts_creator_created', 'debts', 'creator_id, created_at', None),
+    ('idx_debts_creditor_created', 'debts', 'creditor_id, created_at', None),
+    ('idx_debts_debtor_created', 'debts', 'debtor_id, created_at', None),
+    ('idx_debts_creditor_username', 'debts', 'creditor_username', 'creditor_id IS NULL'),
+    ('idx_debts_debtor_username', 'debts', 'debtor_username', 'debtor_id IS NULL'),
+    ('idx_payments_debt_confirmed', 'payments', 'debt_id, confirmed, amount', None),
+    ('idx_notifications_user_unread', 'notifications', 'user_id, read, created_at', None),
+    ('idx_users_username', 'users', 'username', None),
+    ('idx_circle_members_circle', 'circle_members', 'circle_id', None),
+    ('idx_member_names_phonetic', 'circle_member_names', 'owner_user_id, phonetic', None),
+    ('idx_member_names_username', 'circle_member_names', 'owner_user_id, username', 'username IS NOT NULL'),
+    ('idx_transcripts_last_used', 'transcripts', 'last_used_at', None),
+    ('idx_outbox_next_attempt', 'outbox', 'next_attempt_at', None),
+    ('idx_outbox_chat', 'outbox', 'chat_id', None),
+    ('idx_pair_balances_user_b', 'pair_balances', 'user_b', None),
+)
+
+# Indexes an earlier version created and init_database drops. Only these are
+# dropped: an index an operator or a later migration added is left alone.
+RETIRED_INDEXES = ()
+
+# Queries on the request path that must never fall back to a table scan.
+# check_query_plans() runs EXPLAIN QUERY PLAN over each of them.
+HOT_QUERIES = {
+    'get_debts_i_owe': '''
+        SELECT d.*, d.amount - d.paid_total as balance
+        FROM debts d
+        LEFT JOIN users c ON d.creditor_id = c.user_id
+        WHERE d.debtor_id = ? AND d.status = 'active'
+        ORDER BY d.created_at DESC
+    ''',
+    'get_debts_owed_to_me': '''
+        SELECT d.*, d.amount - d.paid_total as balance
+        FROM debts d
+        LEFT JOIN users b ON d.debtor_id = b.user_id
+        WHERE d.creditor_id = ? AND d.status = 'active'
+        ORDER BY d.created_at DESC
+    ''',
+    'get_user_debts': '''
+        SELECT d.*, d.amount - d.paid_total as balance
+        FROM debts d
+        WHERE (d.creditor_id = ? OR d.debtor_id = ?)
+        AND d.status IN ('active', 'pending')
+        ORDER BY d.created_at DESC
+    ''',
+    'get_history_page': None,  # filled in below from _history_page_query
+    'get_debt_balances': 'SELECT id, amount - paid_total as balance FROM debts WHERE id IN (?, ?, ?)',
+    'get_debt_balance': 'SELECT amount - paid_total as balance FROM debts WHERE id = ?',
+    'check_paid_totals': '''
+        SELECT d.id, d.paid_total,
+               (SELECT COALESCE(SUM(p.amount), 0) FROM payments p
+                WHERE p.debt_id = d.id AND p.confirmed = TRUE) as actual
+        FROM debts d
+        WHERE d.id > ?
+        ORDER BY d.id
+        LIMIT ?
+    ''',
+    'get_unread_notifications': '''
+        SELECT * FROM notifications
+        WHERE user_id = ? AND read = FALSE
+        ORDER BY created_at DESC
+    ''',
+    'find_user_by_username': 'SELECT * FROM users WHERE username = ?',
+    'link_pending_debts': '''
+        UPDATE debts SET creditor_id = ?, creditor_username = NULL
+        WHERE creditor_username = ? AND creditor_id IS NULL
+    ''',
+    # Linked counterparties come from the ledger, username-only ones from debts
+    'get_pair_balances': '''
+        SELECT p.user_b as other_id, u.first_name, u.username, p.currency, p.net_amount
+        FROM pair_balances p
+        LEFT JOIN users u ON u.user_id = p.user_b
+        WHERE p.user_a = ? AND ABS(p.net_amount) > 0.005
+        UNION ALL
+        SELECT p.user_a, u.first_name, u.username, p.currency, -p.net_amount
+        FROM pair_balances p
+        LEFT JOIN users u ON u.user_id = p.user_a
+        WHERE p.user_b = ? AND ABS(p.net_amount) > 0.005
+    ''',
+    'get_unlinked_balances': '''
+        SELECT d.debtor_username as username, d.currency, SUM(d.amount - d.paid_total) as net_amount
+        FROM debts d
+        WHERE d.creditor_id = ? AND d.debtor_id IS NULL AND d.status IN ('pending', 'active')
+        GROUP BY d.debtor_username, d.currency
+        UNION ALL
+        SELECT d.creditor_username, d.currency, -SUM(d.amount - d.paid_total)
+        FROM debts d
+        WHERE d.debtor_id = ? AND d.creditor_id IS NULL AND d.status IN ('pending', 'active')
+        GROUP BY d.creditor_username, d.currency
+    ''',
+    # Only the oldest message of each chat is claimable, so a chat's messages
+    # go out in order even when one of them is waiting for a retry
+    'claim_outbox': '''
+        SELECT * FROM outbox o
+        WHERE o.next_attempt_at <= ?
+        AND NOT EXISTS (SELECT 1 FROM outbox e WHERE e.chat_id = o.chat_id AND e.id < o.id)
+        ORDER BY o.next_attempt_at
+        LIMIT ?
+    ''',
+    # Same, for one shard of a sharded deployment (sharding.shard_for the chat)
+    'claim_outbox_shard': '''
+        SELECT * FROM outbox o
+        WHERE o.next_attempt_at <= ? AND ABS(o.chat_id) % ? = ?
+        AND NOT EXISTS (SELECT 1 FROM outbox e WHERE e.chat_id = o.chat_id AND e.id < o.id)
+        ORDER BY o.next_attempt_at
+        LIMIT ?
+    ''',
+    'get_circle_members': '''
+        SELECT cm.* FROM circle_members cm
+        LEFT JOIN users u ON cm.member_user_id = u.user_id
+        WHERE cm.circle_id = ?
+    ''',
+    'find_circle_member': '''
+        SELECT cm.member_user_id, cm.member_username
+        FROM circle_member_names n
+        JOIN circle_members cm ON cm.id = n.member_id
+        WHERE n.owner_user_id = ? AND n.phonetic = ?
+        ORDER BY n.name_latin = ? DESC, n.member_id
+        LIMIT 1
+    ''',
+    # Filled in below from _member_match_query / _member_fuzzy_query
+    'match_member_by_name': None,
+    'fuzzy_member_by_name': None,
+    'find_circle_by_members': None,  # filled in below from _circle_overlap_query
+}
+
+def _ledger_entry(debt):
+    """The (user_a, user_b, currency, amount b owes a) a debt row contributes, or None"""
+    if debt is None or debt['status'] not in LEDGER_STATUSES:
+        return None
+    creditor_id, debtor_id = debt['creditor_id'], debt['debtor_id']
+    if not creditor_id or not debtor_id or creditor_id == debtor_id:
+        return None
+    outstanding = debt['amount'] - debt['paid_total']
+    currency = debt['currency'] or "so'm"
+    if creditor_id < debtor_id:
+        return creditor_id, debtor_id, currency, outstanding
+    return debtor_id, creditor_id, currency, -outstanding
+
+
+def _history_page_query(older=True, keyset=True):
+    """History page SQL: one keyset branch per role so each stays on its (role, created_at) index.
+    
+    Parameters: user_id, then (created_at, id) of the cursor debt when keyset, then limit.
+    """
+    op, order = ('<', 'DESC') if older else ('>', 'ASC')
+    condition = f'AND (created_at, id) {op} (:created_at, :id)' if keyset else ''
+    branches = '\n        UNION\n'.join(f'''
+            SELECT * FROM (
+                SELECT id, created_at FROM debts
+                WHERE {column} = :user_id {condition}
+                ORDER BY created_at {order}, id {order}
+                LIMIT :limit
+            )''' for column in ('creator_id', 'creditor_id', 'debtor_id'))
+    return f'''
+        WITH page AS ({branches}
+        )
+        SELECT d.*,
+            c.first_name as creditor_first_name, c.username as creditor_db_username,
+            b.first_name as debtor_first_name, b.username as debtor_db_username
+        FROM page
+        JOIN debts d ON d.id = page.id
+        LEFT JOIN users c ON d.creditor_id = c.user_id
+        LEFT JOIN users b ON d.debtor_id = b.user_id
+        ORDER BY d.created_at {order}, d.id {order}
+        LIMIT :limit
+    '''
+
+
+HOT_QUERIES['get_history_page'] = _history_page_query()
+
+
+_MEMBER_COLUMNS = '''
+    cm.*, uc.circle_name, u.user_id as linked_user_id, u.username as db_username'''
+
+
+def _member_match_query(word_count):
+    """Members whose phonetic name contains every word asked for, or with that username.
+
+    Exact spellings and usernames score 1, the whole name in another spelling
+    0.95 and a name that merely contains the words (first name only) 0.85.
+    """
+    values = ', '.join(f'(:w{i})' for i in range(word_count))
+    return f'''
+        WITH wanted(word) AS (VALUES {values}),
+        hits AS (
+            SELECT cw.member_id
+            FROM wanted
+            JOIN circle_member_words cw ON cw.owner_user_id = :owner AND cw.word = wanted.word
+            GROUP BY cw.member_id
+            HAVING COUNT(*) = :word_count
+            UNION
+            SELECT member_id FROM circle_member_names
+            WHERE owner_user_id = :owner AND username = :username
+        )
+        SELECT {_MEMBER_COLUMNS},
+               CASE
+                   WHEN n.name_latin = :latin OR n.username = :username THEN 1.0
+                   WHEN n.phonetic = :phonetic THEN 0.95
+                   ELSE 0.85
+               END as score
+        FROM hits
+        JOIN circle_member_names n ON n.member_id = hits.member_id
+        JOIN circle_members cm ON cm.id = hits.member_id
+        JOIN user_circles uc ON uc.id = cm.circle_id
+        LEFT JOIN users u ON u.user_id = cm.member_user_id
+        ORDER BY score DESC, cm.member_name
+        LIMIT :limit
+    '''
+
+
+def _member_fuzzy_query(trigram_count):
+    """Members ranked by trigram similarity (Jaccard) of their phonetic name, for typos"""
+    values = ', '.join(f'(:t{i})' for i in range(trigram_count))
+    return f'''
+        WITH wanted(trigram) AS (VALUES {values}),
+        hits AS (
+            SELECT ct.member_id, COUNT(*) as shared
+            FROM wanted
+            JOIN circle_member_trigrams ct ON ct.owner_user_id = :owner AND ct.trigram = wanted.trigram
+            GROUP BY ct.member_id
+        )
+        SELECT {_MEMBER_COLUMNS},
+               0.8 * hits.shared / (:trigram_count + n.trigram_count - hits.shared) as score
+        FROM hits
+        JOIN circle_member_names n ON n.member_id = hits.member_id
+        JOIN circle_members cm ON cm.id = hits.member_id
+        JOIN user_circles uc ON uc.id = cm.circle_id
+        LEFT JOIN users u ON u.user_id = cm.member_user_id
+        WHERE score >= :min_score
+        ORDER BY score DESC, cm.member_name
+        LIMIT :limit
+    '''
+
+
+HOT_QUERIES['match_member_by_name'] = _member_match_query(2)
+
+
+def _circle_overlap_query(name_count):
+    """The owner's circle holding the most of the wanted names.
+
+    Ties go to the tighter circle (higher Jaccard similarity), then the oldest.
+    """
+    values = ', '.join('(?)' for _ in range(name_count))
+    return f'''
+        WITH wanted(phonetic) AS (VALUES {values}),
+        overlap AS (
+            SELECT cm.circle_id, COUNT(DISTINCT n.phonetic) as matched
+            FROM wanted
+            JOIN circle_member_names n ON n.owner_user_id = ? AND n.phonetic = wanted.phonetic
+            JOIN circle_members cm ON cm.id = n.member_id
+            GROUP BY cm.circle_id
+        )
+        SELECT overlap.circle_id, overlap.matched,
+               (SELECT COUNT(*) FROM circle_members c WHERE c.circle_id = overlap.circle_id) as size
+        FROM overlap
+        ORDER BY overlap.matched DESC, overlap.matched * 1.0 / ({name_count} + size - overlap.matched) DESC,
+                 overlap.circle_id
+        LIMIT 1
+    '''
+HOT_QUERIES['fuzzy_member_by_name'] = _member_fuzzy_query(3)
+HOT_QUERIES['find_circle_by_members'] = _circle_overlap_query(3)
+
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LISTS = re.compile(r'\?(?:\s*,\s*\?)+')
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    """Statement shape: whitespace collapsed, literals as ?, IN lists of any length as one"""
+    shape = _LITERALS.sub('?', ' '.join(sql.split()))
+    return _PLACEHOLDER_LISTS.sub('?, ...', shape)
+
+
+_FROM_RE = re.compile(r'(?:\bFROM|\bJOIN|,)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+_NOT_ALIASES = {'WHERE', 'ON', 'USING', 'JOIN', 'LEFT', 'INNER', 'CROSS', 'NATURAL', 'GROUP', 'ORDER', 'LIMIT',
+                'UNION', 'WINDOW', 'HAVING', 'INDEXED', 'NOT'}
+
+
+def _table_names(query, tables):
+    """Names a plan can SCAN that refer to a real table in query: the tables and their aliases"""
+    names = set()
+    for table, alias in _FROM_RE.findall(query):
+        if table in tables:
+            names.add(alias if alias and alias.upper() not in _NOT_ALIASES else table)
+    return names
+
+
+class QueryStats:
+    """Count, total and max time per statement shape, shared by every connection.
+
+    Time runs from execute() to the last fetch, since SQLite produces rows
+    lazily. A statement slower than slow_ms is logged once per execution
+    with its EXPLAIN QUERY PLAN (captured once per shape).
+    """
+
+    def __init__(self, slow_ms=DB_SLOW_QUERY_MS):
+        self.slow_ms = slow_ms
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._shapes = {}  # shape -> [count, total seconds, max seconds, slow count]
+        self._plans = {}  # shape -> plan lines
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self._shapes = {}
+            self._plans.clear()
+
+    def entry(self, shape):
+        entry = self._shapes.get(shape)
+        if entry is None:
+            with self._lock:
+                entry = self._shapes.setdefault(shape, [0, 0.0, 0.0, 0])
+        return entry
+
+    def spent(self, entry, seconds, execution_total, executed=False):
+        with self._lock:
+            if executed:
+                entry[0] += 1
+            entry[1] += seconds
+            if execution_total > entry[2]:
+                entry[2] = execution_total
+
+    def slow(self, cursor, sql, params, shape, entry, seconds):
+        with self._lock:
+            entry[3] += 1
+            plan = self._plans.get(shape)
+        if plan is None:
+            try:
+                plan = [row[3] for row in cursor.connection.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+            except sqlite3.Error as e:
+                plan = [f'(no plan: {e})']
+            with self._lock:
+                self._plans[shape] = plan
+        logger.warning(f"Slow query {seconds * 1000:.1f} ms: {shape} | plan: {'; '.join(plan) or '-'}")
+
+    def snapshot(self):
+        with self._lock:
+            shapes = {shape: list(entry) for shape, entry in self._shapes.items()}
+            plans = dict(self._plans)
+        queries = [
+            {
+                'sql': shape,
+                'count': count,
+                'total_ms': round(total * 1000, 3),
+                'mean_ms': round(total * 1000 / count, 3),
+                'max_ms': round(longest * 1000, 3),
+                'slow': slow,
+                'plan': plans.get(shape),
+            }
+            for shape, (count, total, longest, slow) in shapes.items()
+        ]
+        queries.sort(key=lambda query: query['total_ms'], reverse=True)
+        return {'since': self.started, 'slow_ms': self.slow_ms, 'queries': queries}
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor reporting every statement to QueryStats; set .stats after creating it"""
+
+    stats = None
+    _entry = None
+
+    def _run(self, method, sql, params, plan_params):
+        shape = normalize_sql(sql)
+        started = time.perf_counter()
+        try:
+            return method(sql, params)
+        finally:
+            self._entry, self._sql, self._plan_params, self._shape = self.stats.entry(shape), sql, plan_params, shape
+            self._elapsed = 0.0
+            self._logged = False
+            self._spend(time.perf_counter() - started, executed=True)
+
+    def _spend(self, seconds, executed=False):
+        self._elapsed += seconds
+        self.stats.spent(self._entry, seconds, self._elapsed, executed)
+        if not self._logged and self._elapsed * 1000 >= self.stats.slow_ms:
+            self._logged = True
+            self.stats.slow(self, self._sql, self._plan_params, self._shape, self._entry, self._elapsed)
+
+    def _fetch(self, method, *args):
+        if self._entry is None:
+            return method(*args)
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._spend(time.perf_counter() - started)
+
+    def execute(self, sql, params=()):
+        return self._run(super().execute, sql, params, params)
+
+    def executemany(self, sql, seq_of_params):
+        # Materialized so the first row's parameters can be used for the plan
+        rows = list(seq_of_params)
+        return self._run(super().executemany, sql, rows, rows[0] if rows else ())
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(super().fetchmany, size if size is not None else self.arraysize)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+
 class Database:
-    def __init__(self, db_name='/app/data/debt_manager.db'):
+    def __init__(self, db_name='/app/data/debt_manager.db', pool_size=READER_POOL_SIZE,
+                 query_stats=DB_QUERY_STATS, slow_query_ms=DB_SLOW_QUERY_MS):
         self.db_name = db_name
-        os.makedirs(os.path.dirname(self.db_name), exist_ok=True)
+        self.pool_size = pool_size
+        self.connections_opened = 0
+        self.query_stats = QueryStats(slow_query_ms) if query_stats else None
+        db_dir = os.path.dirname(self.db_name)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        
+        # One long-lived writer guarded by a lock, plus a pool of readers.
+        # An in-memory database cannot be shared between connections, so
+        # there every read goes through the writer.
+        self._shared_connection = self.db_name == ':memory:'
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+        self._writer_thread = None
+        self._readers = queue.LifoQueue()
+        self._readers_created = 0
+        self._readers_lock = threading.Lock()
         self.init_database()
     
     def get_connection(self):
-        """Get database connection"""
-        conn = sqlite3.connect(self.db_name)
+        """Open a new tuned connection (used by the pool)"""
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=5,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
         conn.row_factory = sqlite3.Row
+        for pragma, value in PRAGMAS:
+            conn.execute(f'PRAGMA {pragma} = {value}')
+        self.connections_opened += 1
         return conn
     
+    def _cursor(self, conn):
+        if self.query_stats is None:
+            return conn.cursor()
+        cursor = conn.cursor(TimedCursor)
+        cursor.stats = self.query_stats
+        return cursor
+    
+    def _get_writer(self):
+        if self._writer is None:
+            self._writer = self.get_connection()
+        return self._writer
+    
+    def _acquire_reader(self):
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._readers_lock:
+            if self._readers_created < self.pool_size:
+                self._readers_created += 1
+                return self.get_connection()
+        return self._readers.get()
+    
+    @contextmanager
+    def transaction(self):
+        """Run statements on the writer connection inside one transaction.
+        
+        Commits on success and rolls back on any exception. Nested calls on
+        the same thread join the outer transaction.
+        """
+        with self._write_lock:
+            conn = self._get_writer()
+            if self._write_depth:
+                self._write_depth += 1
+                try:
+                    yield self._cursor(conn)
+                finally:
+                    self._write_depth -= 1
+                return
+            
+            conn.execute('BEGIN IMMEDIATE')
+            self._write_depth = 1
+            self._writer_thread = threading.get_ident()
+            try:
+                yield self._cursor(conn)
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')
+            finally:
+                self._write_depth = 0
+                self._writer_thread = None
+    
+    @contextmanager
+    def read(self):
+        """Borrow a pooled reader connection and yield a cursor"""
+        if self._shared_connection or self._writer_thread == threading.get_ident():
+            # Inside a write transaction reads must see its uncommitted rows
+            with self._write_lock:
+                yield self._cursor(self._get_writer())
+            return
+        
+        conn = self._acquire_reader()
+        try:
+            yield self._cursor(conn)
+        finally:
+            self._readers.put(conn)
+    
+    def stats(self):
+        """Connection counts, plus per-statement timings when query_stats is on"""
+        snapshot = {
+            'connections_opened': self.connections_opened,
+            'readers_created': self._readers_created,
+            'readers_idle': self._readers.qsize(),
+            'query_stats': self.query_stats is not None,
+        }
+        if self.query_stats is not None:
+            snapshot.update(self.query_stats.snapshot())
+        return snapshot
+    
+    def close(self):
+        """Close the writer and every pooled reader"""
+        if self.query_stats is not None:
+            for query in self.query_stats.snapshot()['queries'][:10]:
+                logger.info(f"Query {query['total_ms']} ms total, {query['count']} calls, "
+                            f"max {query['max_ms']} ms: {query['sql'][:200]}")
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._readers_lock:
+            while True:
+                try:
+                    self._readers.get_nowait().close()
+                except queue.Empty:
+                    break
+            self._readers_created = 0
+    
     def init_database(self):
         """Initialize database with required tables"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+        with self.transaction() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'pair_balances'")
+            has_ledger = cursor.fetchone() is not None
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'circle_member_names'")
+            has_name_index = cursor.fetchone() is not None
+            self._create_tables(cursor)
+            added = self._add_missing_columns(cursor)
+            self._create_indexes(cursor)
+        
+        if ('debts', 'paid_total') in added:
+            logger.info("Backfilling debts.paid_total for an existing database")
+            self.backfill_paid_totals()
+        if not has_ledger:
+            self.rebuild_pair_balances()
+        if not has_name_index:
+            self.rebuild_name_index()
+        
+        # Refresh planner statistics for the indexes that were just created
+        with self.transaction() as cursor:
+            cursor.execute('PRAGMA optimize')
+        
+        for name, details in self.check_query_plans().items():
+            logger.warning(f"Hot query {name} scans a table: {'; '.join(details)}")
+        logger.info("Database initialized successfully")
+    
+    def _add_missing_columns(self, cursor):
+        """Add ADDED_COLUMNS that an older database lacks; return the ones added"""
+        added = []
+        for table, column, definition in ADDED_COLUMNS:
+            cursor.execute(f'PRAGMA table_info({table})')
+            if column not in {row['name'] for row in cursor.fetchall()}:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+                added.append((table, column))
+        return added
+    
+    def _create_indexes(self, cursor):
+        """Create the managed index set and drop the retired ones"""
+        for name in RETIRED_INDEXES:
+            cursor.execute(f'DROP INDEX IF EXISTS {name}')
+        
+        for name, table, columns, where in INDEXES:
+            ddl = f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})'
+            if where:
+                ddl += f' WHERE {where}'
+            cursor.execute(ddl)
+    
+    def explain(self, query, params=None):
+        """Return the EXPLAIN QUERY PLAN detail lines for a query"""
+        if params is None:
+            names = re.findall(r'(?<!:):(\w+)', query)
+            params = dict.fromkeys(names) if names else (None,) * query.count('?')
+        with self.read() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {query}', params)
+            return [row['detail'] for row in cursor.fetchall()]
+    
+    def check_query_plans(self):
+        """Return {query name: plan lines} for every hot query that scans a table"""
+        with self.read() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            tables = {row['name'] for row in cursor.fetchall()}
+        offenders = {}
+        for name, query in HOT_QUERIES.items():
+            # Walking a CTE, subquery or VALUES result is not a table scan; the plan lines that
+            # build it are nested in the plan and checked like any other
+            names = _table_names(query, tables)
+            scans = [detail for detail in self.explain(query)
+                     if detail.startswith('SCAN ') and detail.split()[1] in names]
+            if scans:
+                offenders[name] = scans
+        return offenders
+    
+    def _create_tables(self, cursor):
         # Users table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -49,6 +693,7 @@ class Database:
                 confirmed_by_debtor BOOLEAN DEFAULT FALSE,
                 creditor_username TEXT,
                 debtor_username TEXT,
+                paid_total REAL NOT NULL DEFAULT 0,
                 FOREIGN KEY (creator_id) REFERENCES users(user_id),
                 FOREIGN KEY (creditor_id) REFERENCES users(user_id),
                 FOREIGN KEY (debtor_id) REFERENCES users(user_id)
@@ -117,6 +762,100 @@ class Database:
             )
         ''')
 
+        # Parsed utterances, the persistent tier of parse_cache.ParseCache
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS parse_cache (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        
+        # Name-resolution index over circle_members: the Latin spelling, a
+        # phonetic key (transliteration.phonetic_key), the words and trigrams of
+        # that key, all scoped to the circle owner so lookups never leave their rows
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS circle_member_names (
+                member_id INTEGER PRIMARY KEY,
+                owner_user_id INTEGER NOT NULL,
+                name_latin TEXT NOT NULL,
+                phonetic TEXT NOT NULL,
+                username TEXT,
+                trigram_count INTEGER NOT NULL,
+                FOREIGN KEY (member_id) REFERENCES circle_members(id)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS circle_member_words (
+                owner_user_id INTEGER NOT NULL,
+                word TEXT NOT NULL,
+                member_id INTEGER NOT NULL,
+                PRIMARY KEY (owner_user_id, word, member_id)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS circle_member_trigrams (
+                owner_user_id INTEGER NOT NULL,
+                trigram TEXT NOT NULL,
+                member_id INTEGER NOT NULL,
+                PRIMARY KEY (owner_user_id, trigram, member_id)
+            ) WITHOUT ROWID
+        ''')
+        
+        # Net outstanding balance per pair of users: what user_b owes user_a
+        # (negative when user_a owes user_b), kept in step with debts
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS pair_balances (
+                user_a INTEGER NOT NULL,
+                user_b INTEGER NOT NULL,
+                currency TEXT NOT NULL,
+                net_amount REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_a, user_b, currency),
+                CHECK (user_a < user_b)
+            )
+        ''')
+        
+        # Whisper transcripts keyed by Telegram's file_unique_id
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS transcripts (
+                file_unique_id TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                duration INTEGER NOT NULL DEFAULT 0,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )
+        ''')
+        
+        # Conversation state written through from ConversationStore
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_state (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                state TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        ''')
+        
+        # Telegram messages waiting to be sent by the OutboxDispatcher
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                parse_mode TEXT,
+                reply_markup TEXT,
+                notification_id INTEGER,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                last_error TEXT,
+                trace TEXT,
+                FOREIGN KEY (notification_id) REFERENCES notifications(id)
+            )
+        ''')
+        
         # Notifications table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS notifications (
@@ -127,144 +866,227 @@ class Database:
                 type TEXT NOT NULL,
                 read BOOLEAN DEFAULT FALSE,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                delivered_at REAL,
                 FOREIGN KEY (user_id) REFERENCES users(user_id),
                 FOREIGN KEY (debt_id) REFERENCES debts(id)
             )
         ''')
-        
-        conn.commit()
-        conn.close()
-        logger.info("Database initialized successfully")
-    
+
     def create_user(self, user_id, username, first_name, last_name):
         """Create or update user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO users (user_id, username, first_name, last_name)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-                username = excluded.username,
-                first_name = excluded.first_name,
-                last_name = excluded.last_name
-        ''', (user_id, username, first_name, last_name))
-        
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO users (user_id, username, first_name, last_name)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name
+            ''', (user_id, username, first_name, last_name))
     
     def get_user(self, user_id):
         """Get user by ID"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
+        with self.read() as cursor:
+            cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+            user = cursor.fetchone()
         
-        conn.close()
         return dict(user) if user else None
     
     def find_user_by_username(self, username):
         """Find user by username"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         # Remove @ if present
         username = username.lstrip('@')
         
-        cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-        user = cursor.fetchone()
+        with self.read() as cursor:
+            cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
+            user = cursor.fetchone()
         
-        conn.close()
         return dict(user) if user else None
     
     def link_pending_debts(self, username, user_id):
         """Link pending debts to newly registered user based on username"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Link as creditor
-        cursor.execute('''
-            UPDATE debts
-            SET creditor_id = ?, creditor_username = NULL
-            WHERE creditor_username = ? AND creditor_id IS NULL
-        ''', (user_id, username))
-        
-        # Link as debtor
-        cursor.execute('''
-            UPDATE debts
-            SET debtor_id = ?, debtor_username = NULL
-            WHERE debtor_username = ? AND debtor_id IS NULL
-        ''', (user_id, username))
-        
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                SELECT * FROM debts
+                WHERE (creditor_username = ? AND creditor_id IS NULL)
+                OR (debtor_username = ? AND debtor_id IS NULL)
+            ''', (username, username))
+            before = cursor.fetchall()
+            
+            # Link as creditor
+            cursor.execute('''
+                UPDATE debts
+                SET creditor_id = ?, creditor_username = NULL
+                WHERE creditor_username = ? AND creditor_id IS NULL
+            ''', (user_id, username))
+            
+            # Link as debtor
+            cursor.execute('''
+                UPDATE debts
+                SET debtor_id = ?, debtor_username = NULL
+                WHERE debtor_username = ? AND debtor_id IS NULL
+            ''', (user_id, username))
+            
+            self._update_ledger(cursor, [(debt, self._debt_row(cursor, debt['id'])) for debt in before])
     
     def create_debt(self, creator_id, creditor_id, debtor_id, amount, currency, reason, creditor_username=None, debtor_username=None):
         """Create a new debt record, allowing null IDs with usernames"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO debts (creator_id, creditor_id, debtor_id, amount, currency, reason, status, creditor_username, debtor_username)
-            VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, ?)
-        ''', (creator_id, creditor_id, debtor_id, amount, currency, reason, creditor_username, debtor_username))
-        
-        debt_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        return debt_id
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO debts (creator_id, creditor_id, debtor_id, amount, currency, reason, status, creditor_username, debtor_username)
+                VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, ?)
+            ''', (creator_id, creditor_id, debtor_id, amount, currency, reason, creditor_username, debtor_username))
+            debt_id = cursor.lastrowid
+            
+            self._update_ledger(cursor, [(None, self._debt_row(cursor, debt_id))])
+            return debt_id
     
     def confirm_debt(self, debt_id, user_id):
         """Confirm debt by creditor or debtor"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Get debt info
-        cursor.execute('SELECT * FROM debts WHERE id = ?', (debt_id,))
-        debt = cursor.fetchone()
-        
-        if not debt:
-            conn.close()
-            return False
+        with self.transaction() as cursor:
+            # Get debt info
+            cursor.execute('SELECT * FROM debts WHERE id = ?', (debt_id,))
+            debt = cursor.fetchone()
+            
+            if not debt:
+                return False
+            
+            # Check if user is creditor or debtor
+            if debt['creditor_id'] == user_id:
+                cursor.execute('UPDATE debts SET confirmed_by_creditor = TRUE WHERE id = ?', (debt_id,))
+            elif debt['debtor_id'] == user_id:
+                cursor.execute('UPDATE debts SET confirmed_by_debtor = TRUE WHERE id = ?', (debt_id,))
+            
+            # Check if both confirmed
+            cursor.execute('SELECT * FROM debts WHERE id = ?', (debt_id,))
+            updated_debt = cursor.fetchone()
+            
+            if updated_debt['confirmed_by_creditor'] and updated_debt['confirmed_by_debtor']:
+                cursor.execute("UPDATE debts SET status = 'active' WHERE id = ?", (debt_id,))
+            
+            # pending and active both count, so this is normally a no-op
+            self._update_ledger(cursor, [(debt, self._debt_row(cursor, debt_id))])
         
-        # Check if user is creditor or debtor
-        if debt['creditor_id'] == user_id:
-            cursor.execute('UPDATE debts SET confirmed_by_creditor = TRUE WHERE id = ?', (debt_id,))
-        elif debt['debtor_id'] == user_id:
-            cursor.execute('UPDATE debts SET confirmed_by_debtor = TRUE WHERE id = ?', (debt_id,))
+        return True
+    
+    def _resolve_participants(self, cursor, owner_user_id, debts):
+        """Resolve debtor ids for group debts in one query.
         
-        # Check if both confirmed
-        cursor.execute('SELECT * FROM debts WHERE id = ?', (debt_id,))
-        updated_debt = cursor.fetchone()
+        Follows the per-debt lookup order: the owner's circle member with that
+        name (phonetically, via circle_member_names) first, then a registered
+        user with the (circle or given) username.
+        """
+        wanted = [(i, normalize_name(debt['debtor_name']), phonetic_key(debt['debtor_name']), debt.get('debtor_username'))
+                  for i, debt in enumerate(debts) if not debt.get('debtor_id')]
+        if not wanted:
+            return {}
+        
+        values = ', '.join('(?, ?, ?, ?)' for _ in wanted)
+        cursor.execute(f'''
+            WITH wanted(idx, latin, phonetic, username) AS (VALUES {values}),
+            ranked AS (
+                -- Exact spelling first, then the oldest member; a correlated subquery cannot
+                -- ORDER BY the outer row's columns
+                SELECT w.idx, n.member_id,
+                       ROW_NUMBER() OVER (PARTITION BY w.idx ORDER BY n.name_latin = w.latin DESC, n.member_id) as rank
+                FROM wanted w
+                JOIN circle_member_names n ON n.owner_user_id = ? AND n.phonetic = w.phonetic
+            ),
+            matched AS (
+                SELECT w.idx, w.username, r.member_id
+                FROM wanted w
+                LEFT JOIN ranked r ON r.idx = w.idx AND r.rank = 1
+            ),
+            named AS (
+                SELECT m.idx, m.member_id, cm.member_user_id,
+                       CASE WHEN m.member_id IS NULL THEN m.username ELSE cm.member_username END as username
+                FROM matched m
+                LEFT JOIN circle_members cm ON cm.id = m.member_id
+            )
+            SELECT n.idx, n.username, COALESCE(n.member_user_id, u.user_id) as user_id
+            FROM named n
+            LEFT JOIN users u ON n.member_user_id IS NULL AND u.username = LTRIM(n.username, '@')
+        ''', [param for row in wanted for param in row] + [owner_user_id])
         
-        if updated_debt['confirmed_by_creditor'] and updated_debt['confirmed_by_debtor']:
-            cursor.execute('UPDATE debts SET status = "active" WHERE id = ?', (debt_id,))
+        return {row['idx']: (row['user_id'], row['username']) for row in cursor.fetchall()}
+    
+    def create_group_expense(self, creditor_id, debts, notification_template=None, notif_type='group_debt_created',
+                             parse_mode=None, reply_markup=None):
+        """Create all debts of a group expense in one transaction.
+        
+        debts: dicts with debtor_name, amount, reason and optionally currency,
+        debtor_id and debtor_username. Debtors without an id are resolved
+        through the creditor's circles and registered usernames. Debts are
+        created already confirmed by the creditor; when notification_template
+        is given, a notification formatted with amount/reason/currency is
+        created for every linked debtor and put in the outbox, with
+        reply_markup(debt_id) as its serialized keyboard. Nothing is written
+        if any step fails.
+        
+        Returns one dict per debt, in order, with debt_id, debtor_id,
+        debtor_username and notification (None when nobody is notified).
+        """
+        with self.transaction() as cursor:
+            resolved = self._resolve_participants(cursor, creditor_id, debts)
+            
+            created = []
+            for i, debt in enumerate(debts):
+                debtor_id, debtor_username = resolved.get(i, (debt.get('debtor_id'), debt.get('debtor_username')))
+                created.append({
+                    'debtor_id': debtor_id,
+                    # Keep the username only while the debtor is not linked yet
+                    'debtor_username': debtor_username if not debtor_id else None,
+                    'debtor_name': debt['debtor_name'],
+                    'amount': debt['amount'],
+                    'currency': debt.get('currency', "so'm"),
+                    'reason': debt['reason'],
+                })
+            
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM debts')
+            last_id = cursor.fetchone()[0]
+            cursor.executemany('''
+                INSERT INTO debts (creator_id, creditor_id, debtor_id, amount, currency, reason, status,
+                                   confirmed_by_creditor, debtor_username)
+                VALUES (?, ?, ?, ?, ?, ?, 'pending', TRUE, ?)
+            ''', [(creditor_id, creditor_id, debt['debtor_id'], debt['amount'], debt['currency'],
+                   debt['reason'], debt['debtor_username']) for debt in created])
+            
+            # The write lock is held, so every id above last_id is ours and in insert order
+            cursor.execute('SELECT * FROM debts WHERE id > ? ORDER BY id', (last_id,))
+            rows = cursor.fetchall()
+            self._update_ledger(cursor, [(None, row) for row in rows])
+            for debt, row in zip(created, rows):
+                debt['debt_id'] = row['id']
+                debt['notification'] = None
+                if notification_template and debt['debtor_id']:
+                    debt['notification'] = notification_template.format(
+                        amount=debt['amount'], reason=debt['reason'], currency=debt['currency']
+                    )
+            
+            for debt in created:
+                if debt['notification']:
+                    self._enqueue(cursor, debt['debtor_id'], debt['notification'], parse_mode,
+                                  reply_markup(debt['debt_id']) if reply_markup else None,
+                                  (debt['debt_id'], notif_type))
         
-        conn.commit()
-        conn.close()
-        return True
+        return created
     
     def get_debt(self, debt_id):
         """Get debt by ID, with fallback to usernames"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT d.*, 
-                   c.first_name as creditor_first_name, c.username as creditor_db_username,
-                   b.first_name as debtor_first_name, b.username as debtor_db_username,
-                   cr.first_name as creator_name
-            FROM debts d
-            LEFT JOIN users c ON d.creditor_id = c.user_id
-            LEFT JOIN users b ON d.debtor_id = b.user_id
-            JOIN users cr ON d.creator_id = cr.user_id
-            WHERE d.id = ?
-        ''', (debt_id,))
-        
-        debt = cursor.fetchone()
-        conn.close()
+        with self.read() as cursor:
+            cursor.execute('''
+                SELECT d.*, 
+                       c.first_name as creditor_first_name, c.username as creditor_db_username,
+                       b.first_name as debtor_first_name, b.username as debtor_db_username,
+                       cr.first_name as creator_name
+                FROM debts d
+                LEFT JOIN users c ON d.creditor_id = c.user_id
+                LEFT JOIN users b ON d.debtor_id = b.user_id
+                JOIN users cr ON d.creator_id = cr.user_id
+                WHERE d.id = ?
+            ''', (debt_id,))
+            
+            debt = cursor.fetchone()
         
         if debt:
             debt_dict = dict(debt)
@@ -277,23 +1099,21 @@ class Database:
     
     def get_user_debts(self, user_id):
         """Get all debts for a user, with fallback to usernames"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT d.*, 
-                   c.first_name as creditor_first_name, c.username as creditor_db_username,
-                   b.first_name as debtor_first_name, b.username as debtor_db_username
-            FROM debts d
-            LEFT JOIN users c ON d.creditor_id = c.user_id
-            LEFT JOIN users b ON d.debtor_id = b.user_id
-            WHERE (d.creditor_id = ? OR d.debtor_id = ?)
-            AND d.status IN ('active', 'pending')
-            ORDER BY d.created_at DESC
-        ''', (user_id, user_id))
-        
-        debts = cursor.fetchall()
-        conn.close()
+        with self.read() as cursor:
+            cursor.execute('''
+                SELECT d.*, 
+                       c.first_name as creditor_first_name, c.username as creditor_db_username,
+                       b.first_name as debtor_first_name, b.username as debtor_db_username,
+                       d.amount - d.paid_total as balance
+                FROM debts d
+                LEFT JOIN users c ON d.creditor_id = c.user_id
+                LEFT JOIN users b ON d.debtor_id = b.user_id
+                WHERE (d.creditor_id = ? OR d.debtor_id = ?)
+                AND d.status IN ('active', 'pending')
+                ORDER BY d.created_at DESC
+            ''', (user_id, user_id))
+            
+            debts = cursor.fetchall()
         
         debt_list = []
         for debt in debts:
@@ -305,20 +1125,18 @@ class Database:
     
     def get_debts_i_owe(self, user_id):
         """Get debts where user is the debtor, with fallback"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT d.*, 
-                   c.first_name as creditor_first_name, c.username as creditor_db_username
-            FROM debts d
-            LEFT JOIN users c ON d.creditor_id = c.user_id
-            WHERE d.debtor_id = ? AND d.status = 'active'
-            ORDER BY d.created_at DESC
-        ''', (user_id,))
-        
-        debts = cursor.fetchall()
-        conn.close()
+        with self.read() as cursor:
+            cursor.execute('''
+                SELECT d.*, 
+                       c.first_name as creditor_first_name, c.username as creditor_db_username,
+                       d.amount - d.paid_total as balance
+                FROM debts d
+                LEFT JOIN users c ON d.creditor_id = c.user_id
+                WHERE d.debtor_id = ? AND d.status = 'active'
+                ORDER BY d.created_at DESC
+            ''', (user_id,))
+            
+            debts = cursor.fetchall()
         
         debt_list = []
         for debt in debts:
@@ -329,20 +1147,18 @@ class Database:
     
     def get_debts_owed_to_me(self, user_id):
         """Get debts where user is the creditor, with fallback"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT d.*, 
-                   b.first_name as debtor_first_name, b.username as debtor_db_username
-            FROM debts d
-            LEFT JOIN users b ON d.debtor_id = b.user_id
-            WHERE d.creditor_id = ? AND d.status = 'active'
-            ORDER BY d.created_at DESC
-        ''', (user_id,))
-        
-        debts = cursor.fetchall()
-        conn.close()
+        with self.read() as cursor:
+            cursor.execute('''
+                SELECT d.*, 
+                       b.first_name as debtor_first_name, b.username as debtor_db_username,
+                       d.amount - d.paid_total as balance
+                FROM debts d
+                LEFT JOIN users b ON d.debtor_id = b.user_id
+                WHERE d.creditor_id = ? AND d.status = 'active'
+                ORDER BY d.created_at DESC
+            ''', (user_id,))
+            
+            debts = cursor.fetchall()
         
         debt_list = []
         for debt in debts:
@@ -356,261 +1172,695 @@ class Database:
             debt_list.append(debt_dict)
         return debt_list
     
+    def get_history(self, user_id, limit=20):
+        """Get the newest debts the user created or takes part in"""
+        return self.get_history_page(user_id, limit=limit)['debts']
+    
+    def get_history_page(self, user_id, cursor=None, limit=20, direction='next'):
+        """One page of history, newest first, keyset-paginated on (created_at, id).
+        
+        cursor is a debt id from a previous page: direction 'next' returns the
+        debts older than it, 'prev' the ones newer than it. Returns
+        {'debts', 'next_cursor', 'prev_cursor'}; a cursor is None when there
+        is nothing further that way.
+        """
+        older = direction == 'next'
+        with self.read() as db_cursor:
+            position = None
+            if cursor is not None:
+                db_cursor.execute('SELECT created_at, id FROM debts WHERE id = ?', (cursor,))
+                position = db_cursor.fetchone()
+            if position is None:
+                older = True
+            
+            params = {'user_id': user_id, 'limit': limit + 1}
+            if position is not None:
+                params.update(created_at=position['created_at'], id=position['id'])
+            db_cursor.execute(_history_page_query(older, keyset=position is not None), params)
+            debts = [dict(row) for row in db_cursor.fetchall()]
+        
+        has_more = len(debts) > limit
+        debts = debts[:limit]
+        if not older:
+            debts.reverse()
+        if not debts:
+            return {'debts': [], 'next_cursor': None, 'prev_cursor': None}
+        
+        # Paging away from a cursor means there is at least the cursor row behind us
+        next_cursor = debts[-1]['id'] if (has_more if older else True) else None
+        prev_cursor = debts[0]['id'] if (position is not None if older else has_more) else None
+        return {'debts': debts, 'next_cursor': next_cursor, 'prev_cursor': prev_cursor}
+    
     def add_payment(self, debt_id, payer_id, amount):
         """Add a partial payment to a debt"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO payments (debt_id, payer_id, amount, confirmed)
-            VALUES (?, ?, ?, FALSE)
-        ''', (debt_id, payer_id, amount))
-        
-        payment_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        return payment_id
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO payments (debt_id, payer_id, amount, confirmed)
+                VALUES (?, ?, ?, FALSE)
+            ''', (debt_id, payer_id, amount))
+            
+            return cursor.lastrowid
     
     def link_debt_to_user(self, debt_id, role, user_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        if role == 'debtor':
-            cursor.execute('UPDATE debts SET debtor_id = ? WHERE id = ?', (user_id, debt_id))
-        elif role == 'creditor':
-            cursor.execute('UPDATE debts SET creditor_id = ? WHERE id = ?', (user_id, debt_id))
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            before = self._debt_row(cursor, debt_id)
+            if role == 'debtor':
+                cursor.execute('UPDATE debts SET debtor_id = ? WHERE id = ?', (user_id, debt_id))
+            elif role == 'creditor':
+                cursor.execute('UPDATE debts SET creditor_id = ? WHERE id = ?', (user_id, debt_id))
+            self._update_ledger(cursor, [(before, self._debt_row(cursor, debt_id))])
 
     def confirm_payment(self, payment_id):
-        """Confirm a payment"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('UPDATE payments SET confirmed = TRUE WHERE id = ?', (payment_id,))
-        
-        # Get payment info
-        cursor.execute('SELECT * FROM payments WHERE id = ?', (payment_id,))
-        payment = cursor.fetchone()
-        
-        if payment:
-            # Check if debt is fully paid
-            cursor.execute('''
-                SELECT d.amount, COALESCE(SUM(p.amount), 0) as total_paid
-                FROM debts d
-                LEFT JOIN payments p ON d.id = p.debt_id AND p.confirmed = TRUE
-                WHERE d.id = ?
-                GROUP BY d.id
-            ''', (payment['debt_id'],))
+        """Confirm a payment and add it to the debt's paid_total"""
+        with self.transaction() as cursor:
+            # The confirmed = FALSE guard keeps a repeated confirmation from counting twice
+            cursor.execute('UPDATE payments SET confirmed = TRUE WHERE id = ? AND confirmed = FALSE', (payment_id,))
             
-            result = cursor.fetchone()
-            if result and result['total_paid'] >= result['amount']:
-                cursor.execute('UPDATE debts SET status = "paid" WHERE id = ?', (payment['debt_id'],))
+            if cursor.rowcount:
+                cursor.execute('SELECT debt_id, amount FROM payments WHERE id = ?', (payment_id,))
+                payment = cursor.fetchone()
+                before = self._debt_row(cursor, payment['debt_id'])
+                
+                # Right-hand side sees the old paid_total, so the CASE tests the new total
+                cursor.execute('''
+                    UPDATE debts
+                    SET paid_total = paid_total + ?,
+                        status = CASE WHEN paid_total + ? >= amount THEN 'paid' ELSE status END
+                    WHERE id = ?
+                ''', (payment['amount'], payment['amount'], payment['debt_id']))
+                self._update_ledger(cursor, [(before, self._debt_row(cursor, payment['debt_id']))])
         
-        conn.commit()
-        conn.close()
         return True
     
     def get_debt_balance(self, debt_id):
         """Get remaining balance for a debt"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT d.amount, COALESCE(SUM(p.amount), 0) as total_paid
-            FROM debts d
-            LEFT JOIN payments p ON d.id = p.debt_id AND p.confirmed = TRUE
-            WHERE d.id = ?
-            GROUP BY d.id
-        ''', (debt_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self.read() as cursor:
+            cursor.execute('SELECT amount - paid_total as balance FROM debts WHERE id = ?', (debt_id,))
+            result = cursor.fetchone()
         
         if result:
-            return result['amount'] - result['total_paid']
+            return result['balance']
         return 0
     
-    def cancel_debt(self, debt_id, user_id):
-        """Cancel a debt (only creator can cancel)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def get_debt_balances(self, debt_ids):
+        """Get remaining balances for many debts at once, as {debt_id: balance}"""
+        debt_ids = list(dict.fromkeys(debt_ids))
+        balances = {}
+        
+        with self.read() as cursor:
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(debt_ids), BATCH_SIZE):
+                chunk = debt_ids[start:start + BATCH_SIZE]
+                placeholders = ', '.join('?' * len(chunk))
+                cursor.execute(f'''
+                    SELECT id, amount - paid_total as balance
+                    FROM debts
+                    WHERE id IN ({placeholders})
+                ''', chunk)
+                balances.update((row['id'], row['balance']) for row in cursor.fetchall())
+        
+        return balances
+    
+    def backfill_paid_totals(self, chunk_size=1000):
+        """Recompute debts.paid_total from confirmed payments, one id range per transaction.
         
-        cursor.execute('SELECT creator_id FROM debts WHERE id = ?', (debt_id,))
-        debt = cursor.fetchone()
+        Active debts that turn out to be fully paid are flipped to 'paid'.
+        Returns the number of debts whose paid_total changed.
+        """
+        changed = 0
+        last_id = 0
+        while True:
+            with self.transaction() as cursor:
+                cursor.execute('SELECT id FROM debts WHERE id > ? ORDER BY id LIMIT ?', (last_id, chunk_size))
+                ids = [row['id'] for row in cursor.fetchall()]
+                if not ids:
+                    break
+                
+                cursor.execute('''
+                    UPDATE debts
+                    SET paid_total = (
+                        SELECT COALESCE(SUM(p.amount), 0) FROM payments p
+                        WHERE p.debt_id = debts.id AND p.confirmed = TRUE
+                    )
+                    WHERE id BETWEEN ? AND ?
+                    AND paid_total IS NOT (
+                        SELECT COALESCE(SUM(p.amount), 0) FROM payments p
+                        WHERE p.debt_id = debts.id AND p.confirmed = TRUE
+                    )
+                ''', (ids[0], ids[-1]))
+                changed += cursor.rowcount
+                
+                cursor.execute('''
+                    UPDATE debts SET status = 'paid'
+                    WHERE id BETWEEN ? AND ? AND status = 'active' AND paid_total >= amount
+                ''', (ids[0], ids[-1]))
+                last_id = ids[-1]
+        
+        logger.info(f"paid_total backfill finished, {changed} debts updated")
+        if changed:
+            self.rebuild_pair_balances()
+        return changed
+    
+    def check_paid_totals(self, chunk_size=1000, tolerance=0.005):
+        """Compare debts.paid_total against the payments table.
         
-        if debt and debt['creator_id'] == user_id:
-            cursor.execute('UPDATE debts SET status = "cancelled" WHERE id = ?', (debt_id,))
-            conn.commit()
-            conn.close()
-            return True
+        Returns a list of {'id', 'paid_total', 'actual'} for every debt that disagrees.
+        """
+        mismatches = []
+        last_id = 0
+        while True:
+            with self.read() as cursor:
+                cursor.execute(HOT_QUERIES['check_paid_totals'], (last_id, chunk_size))
+                rows = cursor.fetchall()
+            if not rows:
+                break
+            
+            mismatches.extend(dict(row) for row in rows if abs(row['paid_total'] - row['actual']) > tolerance)
+            last_id = rows[-1]['id']
+        
+        return mismatches
+    
+    def _debt_row(self, cursor, debt_id):
+        cursor.execute('SELECT * FROM debts WHERE id = ?', (debt_id,))
+        return cursor.fetchone()
+    
+    def _update_ledger(self, cursor, changes):
+        """Apply [(debt row before, debt row after)] to pair_balances inside the caller's transaction"""
+        deltas = {}
+        for before, after in changes:
+            for row, sign in ((before, -1), (after, 1)):
+                entry = _ledger_entry(row)
+                if entry:
+                    key = entry[:3]
+                    deltas[key] = deltas.get(key, 0) + sign * entry[3]
+        
+        cursor.executemany('''
+            INSERT INTO pair_balances (user_a, user_b, currency, net_amount)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_a, user_b, currency) DO UPDATE SET net_amount = net_amount + excluded.net_amount
+        ''', [(*key, delta) for key, delta in deltas.items() if delta])
+    
+    def _expected_pair_balances(self, cursor):
+        statuses = ', '.join(f"'{status}'" for status in LEDGER_STATUSES)
+        cursor.execute(f'''
+            SELECT MIN(creditor_id, debtor_id) as user_a, MAX(creditor_id, debtor_id) as user_b,
+                   COALESCE(currency, 'so''m') as currency,
+                   SUM(CASE WHEN creditor_id < debtor_id THEN amount - paid_total ELSE paid_total - amount END) as net_amount
+            FROM debts
+            WHERE status IN ({statuses})
+            AND creditor_id IS NOT NULL AND debtor_id IS NOT NULL AND creditor_id != debtor_id
+            GROUP BY 1, 2, 3
+        ''')
+        return {(row['user_a'], row['user_b'], row['currency']): row['net_amount'] for row in cursor.fetchall()}
+    
+    def rebuild_pair_balances(self):
+        """Recompute pair_balances from the debts table; returns the number of pairs"""
+        with self.transaction() as cursor:
+            expected = self._expected_pair_balances(cursor)
+            cursor.execute('DELETE FROM pair_balances')
+            cursor.executemany('''
+                INSERT INTO pair_balances (user_a, user_b, currency, net_amount) VALUES (?, ?, ?, ?)
+            ''', [(*key, amount) for key, amount in expected.items()])
+        
+        logger.info(f"pair_balances rebuilt, {len(expected)} pairs")
+        return len(expected)
+    
+    def check_pair_balances(self, tolerance=0.005):
+        """Compare pair_balances against the debts table.
+        
+        Returns a list of {'user_a', 'user_b', 'currency', 'net_amount', 'actual'} for every pair that disagrees.
+        """
+        with self.read() as cursor:
+            expected = self._expected_pair_balances(cursor)
+            cursor.execute('SELECT user_a, user_b, currency, net_amount FROM pair_balances')
+            stored = {(row['user_a'], row['user_b'], row['currency']): row['net_amount'] for row in cursor.fetchall()}
+        
+        mismatches = []
+        for key in sorted(expected.keys() | stored.keys()):
+            net_amount, actual = stored.get(key, 0), expected.get(key, 0)
+            if abs(net_amount - actual) > tolerance:
+                mismatches.append(dict(zip(('user_a', 'user_b', 'currency'), key), net_amount=net_amount, actual=actual))
+        return mismatches
+    
+    def get_pair_balances(self, user_id):
+        """Net outstanding balance with every counterparty, positive when they owe user_id.
+        
+        Registered counterparties are read from pair_balances; debts that only
+        name a @username are summed per username.
+        """
+        with self.read() as cursor:
+            cursor.execute(HOT_QUERIES['get_pair_balances'], (user_id, user_id))
+            linked = [dict(row) for row in cursor.fetchall()]
+            cursor.execute(HOT_QUERIES['get_unlinked_balances'], (user_id, user_id))
+            unlinked = [dict(row, other_id=None, first_name=None) for row in cursor.fetchall()
+                        if abs(row['net_amount']) > 0.005]
+        return linked + unlinked
+    
+    def get_pair_balances_among(self, user_ids):
+        """pair_balances rows with both users in user_ids and a non-zero balance"""
+        user_ids = list(dict.fromkeys(user_ids))
+        members = set(user_ids)
+        rows = []
+        
+        with self.read() as cursor:
+            for start in range(0, len(user_ids), BATCH_SIZE):
+                chunk = user_ids[start:start + BATCH_SIZE]
+                placeholders = ', '.join('?' * len(chunk))
+                cursor.execute(f'''
+                    SELECT user_a, user_b, currency, net_amount
+                    FROM pair_balances
+                    WHERE user_a IN ({placeholders}) AND ABS(net_amount) > 0.005
+                ''', chunk)
+                rows.extend(dict(row) for row in cursor.fetchall() if row['user_b'] in members)
+        
+        return rows
+    
+    def cancel_debt(self, debt_id, user_id):
+        """Cancel a debt (only creator can cancel)"""
+        with self.transaction() as cursor:
+            debt = self._debt_row(cursor, debt_id)
+            
+            if debt and debt['creator_id'] == user_id:
+                cursor.execute("UPDATE debts SET status = 'cancelled' WHERE id = ?", (debt_id,))
+                self._update_ledger(cursor, [(debt, self._debt_row(cursor, debt_id))])
+                return True
         
-        conn.close()
         return False
     
     def create_notification(self, user_id, debt_id, message, notif_type):
         """Create a notification for a user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO notifications (user_id, debt_id, message, type)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, debt_id, message, notif_type))
+    
+    def _enqueue(self, cursor, chat_id, text, parse_mode, reply_markup, notification, trace=None):
+        notification_id = None
+        if notification:
+            debt_id, notif_type = notification
+            cursor.execute('''
+                INSERT INTO notifications (user_id, debt_id, message, type)
+                VALUES (?, ?, ?, ?)
+            ''', (chat_id, debt_id, text, notif_type))
+            notification_id = cursor.lastrowid
+        now = time.time()
         cursor.execute('''
-            INSERT INTO notifications (user_id, debt_id, message, type)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, debt_id, message, notif_type))
+            INSERT INTO outbox (chat_id, text, parse_mode, reply_markup, notification_id, next_attempt_at, created_at,
+                                trace)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (chat_id, text, parse_mode, reply_markup, notification_id, now, now, trace))
+        return cursor.lastrowid
+    
+    def enqueue_message(self, chat_id, text, parse_mode=None, reply_markup=None, notification=None, trace=None):
+        """Queue a Telegram message in the outbox.
+        
+        reply_markup is the keyboard serialized as JSON. notification is an
+        optional (debt_id, type) pair; a notifications row with the same text
+        is created in the same transaction and marked delivered once sent.
+        trace is the JSON trace context the send should be recorded under.
+        """
+        with self.transaction() as cursor:
+            return self._enqueue(cursor, chat_id, text, parse_mode, reply_markup, notification, trace)
+    
+    def claim_outbox(self, limit=100, lease=60, shard=None):
+        """Return due outbox messages, at most one per chat, and hide them from other claimers for lease seconds.
         
-        conn.commit()
-        conn.close()
+        shard=(index, count) only claims chats that belong to that shard.
+        """
+        now = time.time()
+        with self.transaction() as cursor:
+            if shard:
+                index, count = shard
+                cursor.execute(HOT_QUERIES['claim_outbox_shard'], (now, count, index, limit))
+            else:
+                cursor.execute(HOT_QUERIES['claim_outbox'], (now, limit))
+            rows = [dict(row) for row in cursor.fetchall()]
+            cursor.executemany('UPDATE outbox SET next_attempt_at = ? WHERE id = ?',
+                               [(now + lease, row['id']) for row in rows])
+        return rows
+    
+    def complete_outbox(self, outbox_ids):
+        """Remove sent messages and mark their notifications delivered"""
+        if not outbox_ids:
+            return
+        now = time.time()
+        with self.transaction() as cursor:
+            for start in range(0, len(outbox_ids), BATCH_SIZE):
+                chunk = outbox_ids[start:start + BATCH_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f'''
+                    UPDATE notifications SET delivered_at = ?
+                    WHERE id IN (SELECT notification_id FROM outbox WHERE id IN ({placeholders}))
+                ''', (now, *chunk))
+                cursor.execute(f'DELETE FROM outbox WHERE id IN ({placeholders})', chunk)
+    
+    def retry_outbox(self, outbox_id, delay, error, count_attempt=True):
+        """Schedule another attempt for an outbox message"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE outbox SET attempts = attempts + ?, next_attempt_at = ?, last_error = ?
+                WHERE id = ?
+            ''', (1 if count_attempt else 0, time.time() + delay, error, outbox_id))
+    
+    def drop_outbox(self, outbox_id):
+        """Give up on an outbox message that can never be delivered"""
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM outbox WHERE id = ?', (outbox_id,))
     
     def get_unread_notifications(self, user_id):
         """Get unread notifications for a user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT * FROM notifications
-            WHERE user_id = ? AND read = FALSE
-            ORDER BY created_at DESC
-        ''', (user_id,))
-        
-        notifications = cursor.fetchall()
-        conn.close()
+        with self.read() as cursor:
+            cursor.execute('''
+                SELECT * FROM notifications
+                WHERE user_id = ? AND read = FALSE
+                ORDER BY created_at DESC
+            ''', (user_id,))
+            
+            notifications = cursor.fetchall()
         
         return [dict(notif) for notif in notifications]
     
     def mark_notification_read(self, notification_id):
         """Mark notification as read"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('UPDATE notifications SET read = TRUE WHERE id = ?', (notification_id,))
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('UPDATE notifications SET read = TRUE WHERE id = ?', (notification_id,))
+    
+    def get_cached_parse(self, key, max_age):
+        """Get a cached parse result younger than max_age seconds"""
+        with self.read() as cursor:
+            cursor.execute(
+                'SELECT result, created_at FROM parse_cache WHERE key = ? AND created_at >= ?',
+                (key, time.time() - max_age)
+            )
+            row = cursor.fetchone()
+        return dict(row) if row else None
+    
+    def save_cached_parse(self, key, result):
+        """Store a parse result (JSON text) under a normalized utterance key"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO parse_cache (key, result, created_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET result = excluded.result, created_at = excluded.created_at
+            ''', (key, result, time.time()))
+    
+    def prune_parse_cache(self, max_age):
+        """Delete cached parse results older than max_age seconds"""
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM parse_cache WHERE created_at < ?', (time.time() - max_age,))
+            return cursor.rowcount
+    
+    def get_cached_transcript(self, file_unique_id):
+        """Get a cached transcript; None if not cached. Count the hit with record_transcript_hit"""
+        with self.read() as cursor:
+            cursor.execute('SELECT * FROM transcripts WHERE file_unique_id = ?', (file_unique_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    def record_transcript_hit(self, file_unique_id):
+        """Count a cache hit and keep the entry from being evicted"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE transcripts SET hits = hits + 1, last_used_at = ?
+                WHERE file_unique_id = ?
+            ''', (time.time(), file_unique_id))
+    
+    def save_transcript(self, file_unique_id, text, duration, max_rows=10000, max_age=30 * 86400):
+        """Cache a transcript, evicting entries unused for max_age seconds or beyond max_rows"""
+        now = time.time()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO transcripts (file_unique_id, text, duration, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(file_unique_id) DO UPDATE SET
+                    text = excluded.text,
+                    duration = MAX(duration, excluded.duration),
+                    last_used_at = excluded.last_used_at
+            ''', (file_unique_id, text, duration or 0, now, now))
+            
+            cursor.execute('DELETE FROM transcripts WHERE last_used_at < ?', (now - max_age,))
+            cursor.execute('SELECT COUNT(*) FROM transcripts')
+            overflow = cursor.fetchone()[0] - max_rows
+            if overflow > 0:
+                cursor.execute('''
+                    DELETE FROM transcripts WHERE file_unique_id IN (
+                        SELECT file_unique_id FROM transcripts ORDER BY last_used_at LIMIT ?
+                    )
+                ''', (overflow,))
+    
+    def transcript_cache_stats(self):
+        """Entries, hits and seconds of audio whose transcription was skipped"""
+        with self.read() as cursor:
+            cursor.execute('''
+                SELECT COUNT(*) as entries,
+                       COALESCE(SUM(hits), 0) as hits,
+                       COALESCE(SUM(hits * duration), 0) as seconds_saved
+                FROM transcripts
+            ''')
+            return dict(cursor.fetchone())
+    
+    def save_conversation_state(self, namespace, key, state, expires_at):
+        """Insert or replace one serialized conversation state"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO conversation_state (namespace, key, state, expires_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(namespace, key) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at
+            ''', (namespace, key, state, expires_at))
+    
+    def delete_conversation_state(self, namespace, key):
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM conversation_state WHERE namespace = ? AND key = ?', (namespace, key))
+    
+    def load_conversation_state(self, namespace):
+        """Drop expired states and return the rest, least recently written first"""
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM conversation_state WHERE expires_at < ?', (time.time(),))
+            cursor.execute('''
+                SELECT key, state, expires_at FROM conversation_state
+                WHERE namespace = ?
+                ORDER BY expires_at
+            ''', (namespace,))
+            return [dict(row) for row in cursor.fetchall()]
     
     def create_circle(self, user_id, circle_name):
         """Create a user circle/category"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR IGNORE INTO user_circles (user_id, circle_name)
-            VALUES (?, ?)
-        ''', (user_id, circle_name))
-        
-        circle_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return circle_id
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR IGNORE INTO user_circles (user_id, circle_name)
+                VALUES (?, ?)
+            ''', (user_id, circle_name))
+            
+            return cursor.lastrowid
     
     def add_member_to_circle(self, circle_id, member_name, member_user_id=None, member_username=None):
         """Add member to circle"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO circle_members (circle_id, member_name, member_user_id, member_username)
-            VALUES (?, ?, ?, ?)
-        ''', (circle_id, member_name, member_user_id, member_username))
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO circle_members (circle_id, member_name, member_user_id, member_username)
+                VALUES (?, ?, ?, ?)
+            ''', (circle_id, member_name, member_user_id, member_username))
+            member_id = cursor.lastrowid
+            cursor.execute('SELECT user_id FROM user_circles WHERE id = ?', (circle_id,))
+            self._index_member_names(cursor, [(member_id, cursor.fetchone()['user_id'], member_name, member_username)])
+            return member_id
+    
+    def _index_member_names(self, cursor, members):
+        """Write circle_member_names/words/trigrams rows for (member_id, owner, name, username)"""
+        names = []
+        words = []
+        grams = []
+        for member_id, owner_user_id, member_name, member_username in members:
+            key = phonetic_key(member_name)
+            member_trigrams = trigrams(key)
+            username = normalize_name(member_username) if member_username else None
+            names.append((member_id, owner_user_id, normalize_name(member_name), key, username, len(member_trigrams)))
+            words.extend((owner_user_id, word, member_id) for word in set(key.split()))
+            grams.extend((owner_user_id, trigram, member_id) for trigram in member_trigrams)
+        cursor.executemany('''
+            INSERT OR REPLACE INTO circle_member_names
+                (member_id, owner_user_id, name_latin, phonetic, username, trigram_count)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', names)
+        cursor.executemany('''
+            INSERT OR IGNORE INTO circle_member_words (owner_user_id, word, member_id) VALUES (?, ?, ?)
+        ''', words)
+        cursor.executemany('''
+            INSERT OR IGNORE INTO circle_member_trigrams (owner_user_id, trigram, member_id) VALUES (?, ?, ?)
+        ''', grams)
+    
+    def rebuild_name_index(self):
+        """Recompute circle_member_names, words and trigrams; returns the number of members"""
+        count = 0
+        last_id = 0
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM circle_member_trigrams')
+            cursor.execute('DELETE FROM circle_member_words')
+            cursor.execute('DELETE FROM circle_member_names')
+            while True:
+                cursor.execute('''
+                    SELECT cm.id, uc.user_id, cm.member_name, cm.member_username
+                    FROM circle_members cm
+                    JOIN user_circles uc ON uc.id = cm.circle_id
+                    WHERE cm.id > ?
+                    ORDER BY cm.id
+                    LIMIT ?
+                ''', (last_id, BATCH_SIZE))
+                members = [tuple(row) for row in cursor.fetchall()]
+                if not members:
+                    break
+                self._index_member_names(cursor, members)
+                count += len(members)
+                last_id = members[-1][0]
+        
+        logger.info(f"Circle member name index rebuilt, {count} members")
+        return count
+    
+    def search_member_by_name(self, owner_user_id, name, limit=5, min_score=0.4):
+        """Circle members of this owner matching a name in any spelling, best first.
         
-        conn.commit()
-        conn.close()
+        Phonetic word matches come straight from circle_member_words; only when
+        there are none are members ranked by shared trigrams, to catch typos.
+        Each result is the circle_members row plus circle_name, linked_user_id,
+        db_username and a score between 0 and 1.
+        """
+        latin = normalize_name(name)
+        key = phonetic_key(name)
+        words = sorted(set(key.split()))
+        params = {'owner': owner_user_id, 'latin': latin, 'phonetic': key, 'username': latin, 'limit': limit}
+        with self.read() as cursor:
+            if words:
+                cursor.execute(_member_match_query(len(words)),
+                               dict(params, word_count=len(words), **{f'w{i}': word for i, word in enumerate(words)}))
+                matches = [dict(row) for row in cursor.fetchall()]
+                if matches:
+                    return matches
+            
+            wanted = sorted(trigrams(key))
+            cursor.execute(_member_fuzzy_query(len(wanted)),
+                           dict(params, trigram_count=len(wanted), min_score=min_score,
+                                **{f't{i}': trigram for i, trigram in enumerate(wanted)}))
+            return [dict(row) for row in cursor.fetchall()]
     
     def get_user_circles(self, user_id):
         """Get all circles for a user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT * FROM user_circles
-            WHERE user_id = ?
-            ORDER BY created_at DESC
-        ''', (user_id,))
-        
-        circles = cursor.fetchall()
-        conn.close()
+        with self.read() as cursor:
+            cursor.execute('''
+                SELECT * FROM user_circles
+                WHERE user_id = ?
+                ORDER BY created_at DESC
+            ''', (user_id,))
+            
+            circles = cursor.fetchall()
         return [dict(circle) for circle in circles]
     
     def get_circle_members(self, circle_id):
         """Get all members of a circle"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT cm.*, u.username as db_username
-            FROM circle_members cm
-            LEFT JOIN users u ON cm.member_user_id = u.user_id
-            WHERE cm.circle_id = ?
-        ''', (circle_id,))
-        
-        members = cursor.fetchall()
-        conn.close()
+        with self.read() as cursor:
+            cursor.execute('''
+                SELECT cm.*, u.username as db_username
+                FROM circle_members cm
+                LEFT JOIN users u ON cm.member_user_id = u.user_id
+                WHERE cm.circle_id = ?
+            ''', (circle_id,))
+            
+            members = cursor.fetchall()
         return [dict(member) for member in members]
     
     def ensure_user_by_username(self, username, display_name=None):
         username = username.lstrip('@')
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.transaction() as cursor:
+            cursor.execute('SELECT user_id FROM users WHERE username = ?', (username,))
+            row = cursor.fetchone()
 
-        cursor.execute('SELECT user_id FROM users WHERE username = ?', (username,))
-        row = cursor.fetchone()
+            if row:
+                return row['user_id']
 
-        if row:
-            conn.close()
-            return row['user_id']
+            cursor.execute('''
+                INSERT INTO users (username, first_name)
+                VALUES (?, ?)
+            ''', (username, display_name))
 
-        cursor.execute('''
-            INSERT INTO users (username, first_name)
-            VALUES (?, ?)
-        ''', (username, display_name))
-
-        user_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return user_id
+            return cursor.lastrowid
     def find_circle_member(self, owner_user_id, name):
         """
         Try to find a circle member by name for this user.
+        Any spelling with the same phonetic key matches, the exact one first.
         Returns dict with member_user_id / member_username if found.
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.read() as cursor:
+            cursor.execute(HOT_QUERIES['find_circle_member'],
+                           (owner_user_id, phonetic_key(name), normalize_name(name)))
 
-        cursor.execute("""
-            SELECT cm.member_user_id, cm.member_username
-            FROM circle_members cm
-            JOIN user_circles uc ON cm.circle_id = uc.id
-            WHERE uc.user_id = ?
-            AND LOWER(cm.member_name) = LOWER(?)
-            LIMIT 1
-        """, (owner_user_id, name))
-
-        row = cursor.fetchone()
-        conn.close()
+            row = cursor.fetchone()
 
         return dict(row) if row else None
 
     
-    def find_circle_by_members(self, user_id, member_names):
-        """Find circle that matches these members"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def find_circle_by_members(self, user_id, member_names, min_overlap=0.5):
+        """Find the circle that best matches these members.
         
-        # Get all circles for user
-        cursor.execute('SELECT id FROM user_circles WHERE user_id = ?', (user_id,))
-        circles = cursor.fetchall()
+        Returns (circle_id, score), score being the share of member_names found
+        in the circle (names match phonetically), or None when no circle holds
+        at least min_overlap of them.
+        """
+        keys = sorted({phonetic_key(name) for name in member_names} - {''})
+        if not keys:
+            return None
         
-        for circle in circles:
-            circle_id = circle['id']
-            cursor.execute('''
-                SELECT member_name FROM circle_members WHERE circle_id = ?
-            ''', (circle_id,))
-            
-            circle_members = [m['member_name'] for m in cursor.fetchall()]
-            
-            # Check if members match (at least 50% overlap)
-            overlap = len(set(member_names) & set(circle_members))
-            if overlap >= len(member_names) * 0.5:
-                conn.close()
-                return circle_id
-        
-        conn.close()
-        return None
\ No newline at end of file
+        with self.read() as cursor:
+            cursor.execute(_circle_overlap_query(len(keys)), [*keys, user_id])
+            circle = cursor.fetchone()
+        
+        if circle is None or circle['matched'] < min_overlap * len(keys):
+            return None
+        return circle['circle_id'], circle['matched'] / len(keys)
+
+
+def main():
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Database maintenance commands')
+    parser.add_argument('--db', default=os.getenv('DATABASE_PATH', '/app/data/debt_manager.db'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('check-plans', help='fail if a hot query scans a table')
+    backfill = subparsers.add_parser('backfill-paid-totals', help='recompute debts.paid_total from payments')
+    backfill.add_argument('--chunk-size', type=int, default=1000)
+    check = subparsers.add_parser('check-paid-totals', help='fail if debts.paid_total disagrees with payments')
+    check.add_argument('--chunk-size', type=int, default=1000)
+    subparsers.add_parser('rebuild-pair-balances', help='recompute pair_balances from debts')
+    subparsers.add_parser('check-pair-balances', help='fail if pair_balances disagrees with debts')
+    subparsers.add_parser('rebuild-name-index', help='recompute the circle member name index')
+    args = parser.parse_args()
+    
+    db = Database(args.db)
+    if args.command == 'check-plans':
+        offenders = db.check_query_plans()
+        for name in HOT_QUERIES:
+            status = 'SCAN' if name in offenders else 'ok'
+            print(f'{status:5} {name}: {" | ".join(db.explain(HOT_QUERIES[name]))}')
+        raise SystemExit(1 if offenders else 0)
+    elif args.command == 'backfill-paid-totals':
+        print(f'{db.backfill_paid_totals(args.chunk_size)} debts updated')
+    elif args.command == 'check-paid-totals':
+        mismatches = db.check_paid_totals(args.chunk_size)
+        for row in mismatches:
+            print(f"debt #{row['id']}: paid_total={row['paid_total']} payments={row['actual']}")
+        print(f'{len(mismatches)} mismatched debts')
+        raise SystemExit(1 if mismatches else 0)
+    elif args.command == 'rebuild-pair-balances':
+        print(f'{db.rebuild_pair_balances()} pairs rebuilt')
+    elif args.command == 'check-pair-balances':
+        mismatches = db.check_pair_balances()
+        for row in mismatches:
+            print(f"users {row['user_a']}/{row['user_b']} ({row['currency']}): "
+                  f"net_amount={row['net_amount']} debts={row['actual']}")
+        print(f'{len(mismatches)} mismatched pairs')
+        raise SystemExit(1 if mismatches else 0)
+    elif args.command == 'rebuild-name-index':
+        print(f'{db.rebuild_name_index()} members indexed')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    main()
@@ -0,0 +1,246 @@
+"""Rule-based parser for the formulaic debt phrases most users send.
+
+parse() returns the same JSON shape as the LLM prompt in DebtBot.parse_debt_info
+for phrases it is sure about, and None for anything else so the caller can
+fall back to the LLM. It never guesses: one amount, one direction phrase and
+one counterparty name are required, and a simple debt must be a single
+clause ("..., keyin qaytardim" may undo what came before).
+"""
+import logging
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+CURRENCY = "so'm"
+STATS_LOG_EVERY = 100
+
+# Thousands separators are '.', ',' or a space followed by exactly three digits;
+# any other '.' or ',' is a decimal point ("230.000" vs "1,5 mln").
+_NUMBER = r"\d{1,3}(?:[.,\s]\d{3})+(?![\d])|\d+(?:[.,]\d{1,2})?(?![\d])"
+_MULTIPLIERS = (
+    (r"mlrd|milliard|млрд|billion", 1_000_000_000),
+    (r"mln|million|millions|млн|миллион(?:а|ов)?", 1_000_000),
+    (r"ming|min|минг|тысяч[аи]?|тыс|thousand|k", 1_000),
+)
+_MULTIPLIER = '|'.join(pattern for pattern, _ in _MULTIPLIERS)
+_AMOUNT_RE = re.compile(rf"(?<![\w.,])(?P<number>{_NUMBER})\s*(?P<multiplier>{_MULTIPLIER})?(?![\w])", re.IGNORECASE)
+_CURRENCY_RE = re.compile(r"\b(?:so'?m|сум|сўм|sum|uzs|рублей|руб)\b\.?", re.IGNORECASE)
+
+# Anything that makes the sentence conditional, negated or a question goes to the LLM
+_UNSURE_RE = re.compile(r"\?|\b(?:emas|yo'q|mi|не|нет|not|didn't|never|agar|если|if|yoki|или|or)\b", re.IGNORECASE)
+
+# A second clause after the debt phrase: a comma or sentence break, or a connective
+_CLAUSES_RE = re.compile(
+    r"[,;]|\.\s+\S|\b(?:keyin\w*|so'ng|lekin|ammo|biroq|потом|затем|но|then|but|later|afterwards)\b", re.IGNORECASE)
+
+_NAME = r"@\w+|[A-ZА-ЯЁЎҚҒҲ][\w'’-]+"
+_DATIVE_SUFFIXES = ('ga', 'ka', 'qa', 'га', 'ка', 'қа')
+# Capitalized datives that are places, not people ("Men Toshkentga 100 ming berdim")
+_PLACE_NAMES = {
+    'toshkent', 'samarqand', 'buxoro', 'xiva', 'andijon', 'namangan', "farg'ona", "qo'qon", 'nukus',
+    'qarshi', 'termiz', 'jizzax', 'navoiy', 'guliston', 'urganch', 'moskva', 'rossiya', 'turkiya',
+}
+# Returning, paying off or gifting money is not a new loan: "qarzimni qaytarib berdim",
+# "to'lab berdim", "sovg'a qilib berdim"
+_NOT_A_LOAN_RE = re.compile(r"\b(?:qaytar\w*|to'?lab|qilib)\b", re.IGNORECASE)
+# What may stand between the name and "berdim" once the amount and currency are
+# removed: an optional "qarz(ga)" and an optional "... uchun" reason, nothing else
+_QARZ = r"(?i:qarz(?:ga)?)"
+_REASON = r"[\w'’-]+(?:\s+[\w'’-]+)?\s+(?i:uchun)"
+
+# Simple debts: (pattern, direction, role of the named person). Names must be
+# capitalized (or @usernames) so ordinary words are never taken for a person.
+_SIMPLE_PATTERNS = (
+    # "Alisher menga 50 ming so'm qarz berdi"
+    (re.compile(rf"^(?P<name>{_NAME})\s+(?i:menga)\b.*\b(?i:qarz\s+berdi)\b"), 'owe_me', 'name'),
+    # "Men Dilnozaga 100 ming berdim" / "Men Dilnozaga qarz berdim"
+    (re.compile(
+        rf"^(?:(?i:men)\s+)?(?P<name>{_NAME})\s+(?:{_QARZ}\s+)?(?:{_REASON}\s+)?(?:{_QARZ}\s+)?"
+        rf"(?i:berdim)(?:\s+{_REASON})?[.!]?$"), 'i_owe', 'dative'),
+    # "Алишер дал мне 50 тысяч" / "Alisher mne dal 50 tysyach"
+    (re.compile(rf"^(?P<name>{_NAME})\s+(?i:дала?\s+мне|мне\s+дала?|dala?\s+mne|mne\s+dala?)\b"), 'owe_me', 'name'),
+    # "Alisher lent me 50k" / "Alisher gave me 50k"
+    (re.compile(rf"^(?P<name>{_NAME})\s+(?i:lent|gave|loaned)\s+(?i:me)\b"), 'owe_me', 'name'),
+    # "I lent Alisher 50k"
+    (re.compile(rf"^(?i:i)\s+(?i:lent|gave|loaned)\s+(?P<name>{_NAME})\b"), 'i_owe', 'name'),
+)
+
+# Group expenses: "230000 to'ladim. Murod, Ibrohim va men" / "150 ming to'ladim Dilnoza bilan"
+_PAID_RE = re.compile(r"\bto'?l(?:a)?dim\b", re.IGNORECASE)
+_NAME_LIST = rf"(?:{_NAME})(?:\s*,\s*(?:{_NAME}))*"
+_GROUP_WITH_ME_RE = re.compile(rf"(?P<names>{_NAME_LIST})\s*,?\s+(?:va|и|and)\s+[Mm][ae]n\b")
+_GROUP_BILAN_RE = re.compile(rf"(?P<names>{_NAME_LIST}(?:\s+(?:va|и|and)\s+(?:{_NAME}))?)\s+bilan\b")
+
+_REASON_RES = (
+    re.compile(r"(?P<reason>[\w'’-]+(?:\s+[\w'’-]+)?)\s+uchun\b", re.IGNORECASE),
+    re.compile(r"\b(?:за|на)\s+(?P<reason>[\w-]+)", re.IGNORECASE),
+    re.compile(r"\bfor\s+(?P<reason>[\w-]+(?:\s+[\w-]+)?)", re.IGNORECASE),
+)
+# Words that show up next to "uchun"/"for" but are not a reason
+_NOT_REASON = {'qarz', 'pul', 'men', 'menga', 'berdi', 'berdim', 'to\'ladim', 'toladim', 'me', 'him', 'her'}
+_SELF_NAMES = {'men', 'man', 'ya', 'я', 'i', 'me'}
+
+
+def _to_number(raw):
+    raw = raw.strip()
+    if re.fullmatch(r"\d{1,3}(?:[.,\s]\d{3})+", raw):
+        return float(re.sub(r"[.,\s]", '', raw))
+    return float(raw.replace(',', '.'))
+
+
+def find_amounts(text):
+    """Return [(value, start, end)] for every amount mentioned in the text"""
+    amounts = []
+    for match in _AMOUNT_RE.finditer(text):
+        value = _to_number(match.group('number'))
+        multiplier = match.group('multiplier')
+        if multiplier:
+            for pattern, factor in _MULTIPLIERS:
+                if re.fullmatch(pattern, multiplier, re.IGNORECASE):
+                    value *= factor
+                    break
+        amounts.append((value, match.start(), match.end()))
+    return amounts
+
+
+def parse_amount(text):
+    """Parse a single amount like '50 ming', '230.000' or '1,5 mln'; None if not exactly one"""
+    amounts = find_amounts(text)
+    if len(amounts) != 1:
+        return None
+    value = amounts[0][0]
+    return int(value) if value.is_integer() else value
+
+
+def _clean_name(name, role):
+    name = name.strip("'’-")
+    if role == 'dative' and not name.startswith('@'):
+        for suffix in _DATIVE_SUFFIXES:
+            if name.lower().endswith(suffix) and len(name) > len(suffix) + 2:
+                return name[:-len(suffix)]
+        return None
+    return name
+
+
+def _find_reason(text):
+    for reason_re in _REASON_RES:
+        match = reason_re.search(text)
+        if match:
+            words = [w for w in match.group('reason').split() if w.lower() not in _NOT_REASON]
+            if words:
+                return ' '.join(words)
+    return None
+
+
+def _split_names(names):
+    return [n.strip() for n in re.split(r"\s*,\s*|\s+(?:va|и|and)\s+", names) if n.strip()]
+
+
+def _parse_group(text, amount):
+    for group_re in (_GROUP_WITH_ME_RE, _GROUP_BILAN_RE):
+        match = group_re.search(text)
+        if not match:
+            continue
+        participants = _split_names(match.group('names'))
+        if any(p.lower() in _SELF_NAMES for p in participants):
+            return None
+        result = {
+            'is_group': True,
+            'payer_name': 'Men',
+            'participants': participants + ['Men'],
+            'total_amount': amount,
+            'currency': CURRENCY,
+        }
+        reason = _find_reason(text)
+        if reason:
+            result['reason'] = reason
+        return result
+    return None
+
+
+def parse(text):
+    """Parse a formulaic debt phrase, or return None when unsure"""
+    if not text:
+        return None
+    text = ' '.join(text.replace('’', "'").replace('ʻ', "'").replace('`', "'").split())
+    if _UNSURE_RE.search(text):
+        return None
+
+    amounts = find_amounts(text)
+    if len(amounts) != 1:
+        return None
+    value, start, end = amounts[0]
+    amount = int(value) if value.is_integer() else value
+    if amount <= 0:
+        return None
+    rest = _CURRENCY_RE.sub(' ', text[:start] + ' ' + text[end:])
+    rest = ' '.join(rest.split())
+
+    if _PAID_RE.search(rest):
+        return _parse_group(rest, amount)
+
+    if _CLAUSES_RE.search(rest) or _NOT_A_LOAN_RE.search(rest):
+        return None
+    for pattern, direction, role in _SIMPLE_PATTERNS:
+        match = pattern.search(rest)
+        if not match:
+            continue
+        name = _clean_name(match.group('name'), role)
+        if not name or name.lower() in _SELF_NAMES or name.lower() in _PLACE_NAMES:
+            return None
+        result = {
+            'amount': amount,
+            'currency': CURRENCY,
+            'creditor_name': name if direction == 'owe_me' else None,
+            'debtor_name': name if direction == 'i_owe' else None,
+            'direction': direction,
+            'is_group': False,
+        }
+        reason = _find_reason(rest[match.end('name'):])
+        if reason:
+            result['reason'] = reason
+        return result
+    return None
+
+
+class ParserStats:
+    """Counts fast-path hits and misses and per-path latency"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.latency = {}
+
+    def record(self, path, seconds):
+        with self._lock:
+            if path == 'fast':
+                self.hits += 1
+            elif path == 'llm':
+                self.misses += 1
+            count, total, worst = self.latency.get(path, (0, 0.0, 0.0))
+            self.latency[path] = (count + 1, total + seconds, max(worst, seconds))
+            should_log = (self.hits + self.misses) % STATS_LOG_EVERY == 0
+        if should_log:
+            snapshot = self.snapshot()
+            logger.info(
+                f"Parser fast-path hit rate {snapshot['hit_rate']:.0%} "
+                f"({snapshot['hits']} fast / {snapshot['misses']} llm), latency ms: {snapshot['latency_ms']}"
+            )
+
+    def snapshot(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'latency_ms': {
+                    path: {'count': count, 'avg': total_s / count * 1000, 'max': worst * 1000}
+                    for path, (count, total_s, worst) in self.latency.items()
+                },
+            }
+
+
+stats = ParserStats()
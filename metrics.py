@@ -0,0 +1,238 @@
+"""Handler latency, error and in-flight metrics in Prometheus text format.
+
+Every handler registered in build_application is wrapped with instrument(),
+which records:
+
+    bot_handler_seconds{handler,route}             latency histogram
+    bot_handler_errors_total{handler,route}        handlers that raised
+    bot_handler_in_flight{handler}                 updates being handled now
+    bot_handler_component_seconds{handler,component}
+        time one update spent in Telegram I/O, OpenAI and the database
+
+route is the callback prefix for handle_callback and empty otherwise.
+Component time is collected with timed(), which TimedRequest (Bot API),
+OpenAIGateway and AsyncDatabase wrap around every call; the call is also
+recorded in bot_component_seconds{component,operation}, whether or not a
+handler made it (the outbox sends outside any handler), and traced as a
+"<component>.<operation>" span when it runs inside a trace.
+
+With METRICS_PORT set the process serves GET /metrics on
+METRICS_LISTEN:METRICS_PORT for Prometheus to scrape.
+"""
+import contextlib
+import functools
+import logging
+import os
+import time
+from contextvars import ContextVar
+
+from telegram.request import BaseRequest
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COMPONENTS = ('telegram', 'openai', 'database')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REGISTRY = []
+# Seconds per component spent by the handler running in this context
+_components = ContextVar('metric_components', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # label values -> value
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for key, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{_labels(self.labelnames, key)} {_number(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            # Per-bucket counts (not cumulative), then sum and count
+            series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                labels = _labels(self.labelnames, key, f'le="{_number(bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            inf = _labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{inf} {count}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {count}')
+        return lines
+
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Time to handle one update', ('handler', 'route'))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Updates whose handler raised', ('handler', 'route'))
+HANDLER_IN_FLIGHT = Gauge('bot_handler_in_flight', 'Updates being handled right now', ('handler',))
+HANDLER_COMPONENT_SECONDS = Histogram(
+    'bot_handler_component_seconds', 'Time one update spent in each component', ('handler', 'component'))
+COMPONENT_SECONDS = Histogram(
+    'bot_component_seconds', 'Duration of each Telegram, OpenAI and database call', ('component', 'operation'))
+
+
+def render():
+    """The whole registry in Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def record(component, operation, seconds):
+    COMPONENT_SECONDS.observe(seconds, component=component, operation=operation)
+    components = _components.get()
+    if components is not None:
+        components[component] = components.get(component, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def timed(component, operation):
+    """Record the time spent in the block against component and the running handler, in a trace span"""
+    started = time.perf_counter()
+    try:
+        # Calls made outside any update (outbox polling, startup) are not traced
+        with tracing.span(f'{component}.{operation}', new_trace=False):
+            yield
+    finally:
+        record(component, operation, time.perf_counter() - started)
+
+
+def instrument(name, callback, route=None):
+    """Wrap a handler callback; route(update) names the sub-route (e.g. a callback prefix)"""
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        label = route(update) if route else ''
+        # Tasks the handler spawns copy the context, so they add to the same dict
+        components = {}
+        token = _components.set(components)
+        HANDLER_IN_FLIGHT.inc(handler=name)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name, route=label)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name, route=label)
+            HANDLER_IN_FLIGHT.dec(handler=name)
+            for component in COMPONENTS:
+                HANDLER_COMPONENT_SECONDS.observe(components.get(component, 0.0), handler=name, component=component)
+            _components.reset(token)
+
+    return wrapper
+
+
+class TimedRequest(BaseRequest):
+    """Wraps the Bot API client so every request counts as 'telegram' time"""
+
+    def __init__(self, request):
+        self.request = request
+
+    async def initialize(self):
+        await self.request.initialize()
+
+    async def shutdown(self):
+        await self.request.shutdown()
+
+    @property
+    def read_timeout(self):
+        return self.request.read_timeout
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        operation = 'file_download' if '/file/bot' in url else url.rsplit('/', 1)[-1]
+        with timed('telegram', operation):
+            return await self.request.do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+
+
+async def _scrape(request):
+    return 200, CONTENT_TYPE, render().encode()
+
+
+async def start_server(listen=METRICS_LISTEN, port=METRICS_PORT):
+    """Serve GET /metrics; returns the server, or None when port is 0"""
+    if not port:
+        return None
+    from webhook import HttpServer
+    server = HttpServer(listen, port)
+    server.add_route('/metrics', _scrape)
+    await server.start()
+    return server
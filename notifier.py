@@ -0,0 +1,212 @@
+"""Background delivery of queued Telegram messages.
+
+Handlers put messages in the SQLite outbox (Database.enqueue_message) and
+return immediately; OutboxDispatcher sends them concurrently while staying
+under Telegram's limits: about 30 messages a second overall and one a
+second per chat. Messages to the same chat go out in the order queued.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '30'))
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', '1'))
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', '8'))
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_POLL_INTERVAL = 1.0
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_BACKOFF = 2.0  # seconds, doubled after every failed attempt
+
+SENT, RETRY, DROPPED = 'sent', 'retry', 'dropped'
+
+
+class TokenBucket:
+    """Allows rate events a second with bursts of up to capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.paused_until - now
+                if wait <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep(max(wait, (1 - self.tokens) / self.rate))
+
+    def pause(self, seconds):
+        """Hand out nothing for the next seconds (after a RetryAfter)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+
+def _seconds(retry_after):
+    # RetryAfter.retry_after is an int or a timedelta depending on the PTB version
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+class OutboxDispatcher:
+    """Sends outbox messages under global and per-chat token buckets"""
+
+    def __init__(self, db, global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE,
+                 concurrency=OUTBOX_CONCURRENCY, batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_INTERVAL,
+                 shard=None):
+        self.db = db
+        # (index, count) in a sharded deployment: only this shard's chats are sent
+        self.shard = shard
+        self.bot = None
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self, bot):
+        self.bot = bot
+        self._task = asyncio.create_task(self._run(), name='outbox-dispatcher')
+
+    def wake(self):
+        """Tell the dispatcher new messages were queued"""
+        self._wakeup.set()
+
+    async def stop(self, timeout=10):
+        """Finish the batch in flight; unsent messages stay in the outbox"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Outbox dispatcher did not stop in time")
+        logger.info(f"Outbox dispatcher stopped: {self.stats()}")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                messages = await self.db.claim_outbox(self.batch_size, shard=self.shard)
+            except Exception as e:
+                logger.error(f"Outbox claim failed: {e}")
+                messages = []
+            if not messages:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._dispatch(messages)
+            except Exception as e:
+                # Claimed rows are sent again once their lease runs out
+                logger.error(f"Outbox dispatch failed: {e}")
+
+    async def _dispatch(self, messages):
+        # claim_outbox returns at most one message per chat
+        results = await asyncio.gather(*(self._send_one(message) for message in messages), return_exceptions=True)
+        for message, outcome in zip(messages, results):
+            if isinstance(outcome, Exception):
+                logger.error(f"Outbox message {message['id']} failed: {outcome}")
+        delivered = [message['id'] for message, outcome in zip(messages, results) if outcome == SENT]
+        if delivered:
+            await self.db.complete_outbox(delivered)
+        self._prune_buckets()
+
+    async def _send_one(self, message):
+        async with self._slots:
+            bucket = self.chat_buckets.get(message['chat_id'])
+            if bucket is None:
+                bucket = self.chat_buckets[message['chat_id']] = TokenBucket(self.chat_rate)
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            # Recorded in the trace of the update that queued the message
+            parent = tuple(json.loads(message['trace'])) if message.get('trace') else None
+            with tracing.span('outbox.send', parent=parent, chat_id=message['chat_id'], attempts=message['attempts'],
+                              queued_ms=round((time.time() - message['created_at']) * 1000, 1)) as span:
+                outcome = await self._send(message, bucket)
+                if span is not None:
+                    span.set('outcome', outcome)
+                return outcome
+
+    async def _send(self, message, bucket):
+        try:
+            reply_markup = None
+            if message['reply_markup']:
+                reply_markup = InlineKeyboardMarkup.de_json(json.loads(message['reply_markup']), self.bot)
+            await self.bot.send_message(
+                chat_id=message['chat_id'],
+                text=message['text'],
+                parse_mode=message['parse_mode'],
+                reply_markup=reply_markup,
+            )
+            self.sent += 1
+            return SENT
+        except RetryAfter as e:
+            delay = _seconds(e.retry_after)
+            logger.warning(f"Telegram flood limit, pausing {delay}s (chat {message['chat_id']})")
+            bucket.pause(delay)
+            self.global_bucket.pause(delay)
+            await self.db.retry_outbox(message['id'], delay, str(e), count_attempt=False)
+            self.retried += 1
+            return RETRY
+        except (Forbidden, BadRequest) as e:
+            # Blocked bot, deleted chat or a malformed message: retrying cannot help
+            logger.warning(f"Dropping outbox message {message['id']} to {message['chat_id']}: {e}")
+            await self.db.drop_outbox(message['id'])
+            self.failed += 1
+            return DROPPED
+        except Exception as e:
+            attempts = message['attempts'] + 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"Giving up on outbox message {message['id']} after {attempts} attempts: {e}")
+                await self.db.drop_outbox(message['id'])
+                self.failed += 1
+                return DROPPED
+            logger.warning(f"Outbox message {message['id']} failed, retrying: {e}")
+            await self.db.retry_outbox(message['id'], OUTBOX_BACKOFF * 2 ** message['attempts'], str(e))
+            self.retried += 1
+            return RETRY
+
+    def _prune_buckets(self):
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items() if bucket.idle(now)]:
+            del self.chat_buckets[chat_id]
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'chats_tracked': len(self.chat_buckets),
+        }
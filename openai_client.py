@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import os
+
+import httpx
+from openai import AsyncOpenAI
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CHAT_MODEL = 'gpt-4o-mini'
+TRANSCRIBE_MODEL = 'whisper-1'
+
+CHAT_CONCURRENCY = int(os.getenv('OPENAI_CHAT_CONCURRENCY', '8'))
+TRANSCRIBE_CONCURRENCY = int(os.getenv('OPENAI_TRANSCRIBE_CONCURRENCY', '4'))
+CHAT_TIMEOUT = float(os.getenv('OPENAI_CHAT_TIMEOUT', '20'))
+TRANSCRIBE_TIMEOUT = float(os.getenv('OPENAI_TRANSCRIBE_TIMEOUT', '30'))
+# Callers waiting for a slot beyond this are turned away instead of queued
+MAX_WAITING = int(os.getenv('OPENAI_MAX_WAITING', '100'))
+
+
+class OpenAIBusyError(Exception):
+    """Raised when too many calls are already waiting for a slot"""
+
+
+class _Limiter:
+    def __init__(self, name, limit, max_waiting):
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    @property
+    def saturated(self):
+        return self.active >= self.limit
+
+    async def __aenter__(self):
+        if self.waiting >= self.max_waiting:
+            raise OpenAIBusyError(f'{self.name}: {self.waiting} calls already queued')
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+
+    async def __aexit__(self, *exc_info):
+        self.active -= 1
+        self._semaphore.release()
+
+
+class OpenAIGateway:
+    """Async OpenAI client with one keep-alive connection pool and per-kind limits.
+
+    Chat completions and Whisper transcriptions each get their own concurrency
+    limit, so a burst of voice notes cannot starve text parsing or the other
+    way round. Pass ``on_queued`` to be told when a call has to wait.
+    """
+
+    def __init__(self, api_key=None, base_url=None,
+                 chat_concurrency=CHAT_CONCURRENCY, transcribe_concurrency=TRANSCRIBE_CONCURRENCY,
+                 chat_timeout=CHAT_TIMEOUT, transcribe_timeout=TRANSCRIBE_TIMEOUT,
+                 max_waiting=MAX_WAITING):
+        self.chat_timeout = chat_timeout
+        self.transcribe_timeout = transcribe_timeout
+        pool_size = chat_concurrency + transcribe_concurrency
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(max(chat_timeout, transcribe_timeout), connect=5.0),
+        )
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=self.http_client, max_retries=1)
+        self.limits = {
+            'chat': _Limiter('chat', chat_concurrency, max_waiting),
+            'transcription': _Limiter('transcription', transcribe_concurrency, max_waiting),
+        }
+
+    def is_saturated(self, kind):
+        """True when a new call of this kind ('chat' or 'transcription') would queue"""
+        return self.limits[kind].saturated
+
+    async def _acquire(self, kind, on_queued):
+        limiter = self.limits[kind]
+        if limiter.saturated and on_queued is not None:
+            try:
+                await on_queued()
+            except Exception as e:
+                logger.warning(f"Queued notice failed: {e}")
+        return limiter
+
+    async def chat(self, messages, model=CHAT_MODEL, temperature=0.3, on_queued=None):
+        """Run a chat completion and return the message content"""
+        # Timed from the caller's side, so waiting for a slot counts too
+        with metrics.timed('openai', 'chat'):
+            async with await self._acquire('chat', on_queued):
+                response = await self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    timeout=self.chat_timeout,
+                )
+        return response.choices[0].message.content
+
+    async def transcribe(self, audio, filename='voice.ogg', content_type='audio/ogg', on_queued=None):
+        """Transcribe audio bytes with Whisper and return the text"""
+        with metrics.timed('openai', 'transcription'):
+            async with await self._acquire('transcription', on_queued):
+                transcript = await self.client.audio.transcriptions.create(
+                    model=TRANSCRIBE_MODEL,
+                    file=(filename, audio, content_type),
+                    timeout=self.transcribe_timeout,
+                )
+        return transcript.text
+
+    async def aclose(self):
+        await self.http_client.aclose()
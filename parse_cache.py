@@ -0,0 +1,122 @@
+"""Cache of parse_debt_info results keyed on normalized utterance text.
+
+The in-memory tier is an LRU with a per-entry TTL. An optional persistent
+tier in SQLite (through AsyncDatabase) survives restarts and is consulted
+on memory misses.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import fast_parser
+from transliteration import to_latin
+
+logger = logging.getLogger(__name__)
+
+PARSE_CACHE_SIZE = int(os.getenv('PARSE_CACHE_SIZE', '2000'))
+PARSE_CACHE_TTL = float(os.getenv('PARSE_CACHE_TTL', str(24 * 3600)))
+PARSE_CACHE_PERSIST = os.getenv('PARSE_CACHE_PERSIST', '1') == '1'
+STATS_LOG_EVERY = 100
+PRUNE_EVERY = 500
+
+# '?' is kept: "Ali 50 ming qaytardi?" asks, it does not record a debt
+_PUNCTUATION_RE = re.compile(r"[^\w\s'@?]")
+
+
+def normalize_utterance(text):
+    """Reduce text to a cache key: case, spacing, script and number formats folded"""
+    text = to_latin(text).lower()
+    # Rewrite every amount as plain digits so "50 ming", "50 000" and "50000" match
+    for value, start, end in reversed(fast_parser.find_amounts(text)):
+        number = int(value) if value.is_integer() else value
+        text = f'{text[:start]} {number} {text[end:]}'
+    text = _PUNCTUATION_RE.sub(' ', text).replace('?', ' ? ')
+    return ' '.join(text.split())
+
+
+class ParseCache:
+    """LRU + TTL cache of parse results with an optional SQLite tier"""
+
+    def __init__(self, max_size=PARSE_CACHE_SIZE, ttl=PARSE_CACHE_TTL, store=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.store = store
+        self._entries = OrderedDict()  # key -> (expires_at, result JSON)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts = 0
+
+    def _remember(self, key, payload, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _lookup_memory(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, payload = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                self.evictions += 1
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    async def get(self, text):
+        """Return a fresh copy of the cached result for this text, or None"""
+        key = normalize_utterance(text)
+        payload = self._lookup_memory(key)
+        if payload is not None:
+            self.hits += 1
+        elif self.store is not None:
+            row = await self.store.get_cached_parse(key, self.ttl)
+            if row is not None:
+                payload = row['result']
+                self.persistent_hits += 1
+                self._remember(key, payload, row['created_at'] + self.ttl)
+        if payload is None:
+            self.misses += 1
+        self._maybe_log()
+        return json.loads(payload) if payload is not None else None
+
+    async def put(self, text, result):
+        """Cache a successful parse result"""
+        if result.get('error'):
+            return
+        key = normalize_utterance(text)
+        payload = json.dumps({k: v for k, v in result.items() if k != 'original_text'}, ensure_ascii=False)
+        self._remember(key, payload, time.time() + self.ttl)
+        if self.store is not None:
+            await self.store.save_cached_parse(key, payload)
+            self._puts += 1
+            if self._puts % PRUNE_EVERY == 0:
+                await self.store.prune_parse_cache(self.ttl)
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        lookups = self.hits + self.persistent_hits + self.misses
+        return {
+            'size': size,
+            'hits': self.hits,
+            'persistent_hits': self.persistent_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits + self.persistent_hits) / lookups if lookups else 0.0,
+        }
+
+    def _maybe_log(self):
+        if (self.hits + self.persistent_hits + self.misses) % STATS_LOG_EVERY == 0:
+            logger.info(f"Parse cache stats: {self.stats()}")
@@ -0,0 +1,113 @@
+"""Debt simplification: settle a group's net balances with few transfers.
+
+Balances map a participant to their net position, positive when the group
+owes them and negative when they owe the group; they must sum to zero.
+Amounts are handled in integer cents so rounding can never leave a
+transfer of 0.01 behind.
+
+Small groups (up to EXACT_LIMIT people with a non-zero balance) are solved
+exactly: the fewest transfers is n minus the largest number of disjoint
+zero-sum subgroups, found with a DP over subsets. Larger groups use the
+greedy heap strategy, which always pays the largest debtor to the largest
+creditor and needs at most n - 1 transfers.
+"""
+import heapq
+
+EXACT_LIMIT = 12
+
+
+def to_cents(amount):
+    return int(round(amount * 100))
+
+
+def net_balances(pairs, members=None):
+    """Net balance per user from pair_balances rows (user_a, user_b, net_amount).
+
+    Only pairs with both users in members count when members is given.
+    """
+    balances = {}
+    for row in pairs:
+        user_a, user_b, amount = row['user_a'], row['user_b'], row['net_amount']
+        if members is not None and (user_a not in members or user_b not in members):
+            continue
+        # user_b owes user_a
+        balances[user_a] = balances.get(user_a, 0) + to_cents(amount)
+        balances[user_b] = balances.get(user_b, 0) - to_cents(amount)
+    return {user: cents / 100 for user, cents in balances.items()}
+
+
+def greedy_transfers(balances):
+    """Settle with a max-heap of creditors and one of debtors; at most n - 1 transfers"""
+    creditors = [(-cents, user) for user, cents in _cents(balances).items() if cents > 0]
+    debtors = [(cents, user) for user, cents in _cents(balances).items() if cents < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append((debtor, creditor, amount / 100))
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, creditor))
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, debtor))
+    return transfers
+
+
+def exact_transfers(balances):
+    """Settle with the fewest possible transfers; exponential, keep n small"""
+    cents = _cents(balances)
+    users = [user for user, amount in cents.items() if amount]
+    amounts = [cents[user] for user in users]
+    n = len(users)
+    full = (1 << n) - 1
+
+    subset_sum = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        low = mask & -mask
+        subset_sum[mask] = subset_sum[mask ^ low] + amounts[low.bit_length() - 1]
+
+    # groups[mask]: most zero-sum groups the members of mask can be split into,
+    # counting only complete groups along some removal order
+    groups = [0] * (full + 1)
+    best_bit = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        best = -1
+        remaining = mask
+        while remaining:
+            bit = remaining & -remaining
+            remaining ^= bit
+            if groups[mask ^ bit] > best:
+                best = groups[mask ^ bit]
+                best_bit[mask] = bit
+        groups[mask] = best + (subset_sum[mask] == 0)
+
+    # Walk the removal order back; every zero-sum prefix closes one subgroup
+    transfers = []
+    mask = full
+    group = {}
+    while mask:
+        bit = best_bit[mask]
+        index = bit.bit_length() - 1
+        group[users[index]] = amounts[index] / 100
+        mask ^= bit
+        if subset_sum[mask] == 0:
+            transfers.extend(greedy_transfers(group))
+            group = {}
+    return transfers
+
+
+def settle(balances, exact_limit=EXACT_LIMIT):
+    """Transfers (debtor, creditor, amount) that bring every balance to zero"""
+    cents = _cents(balances)
+    if sum(cents.values()) != 0:
+        raise ValueError(f'Balances do not sum to zero (off by {sum(cents.values()) / 100})')
+    if sum(1 for amount in cents.values() if amount) <= exact_limit:
+        return exact_transfers(balances)
+    return greedy_transfers(balances)
+
+
+def _cents(balances):
+    return {user: to_cents(amount) for user, amount in balances.items()}
@@ -0,0 +1,298 @@
+"""Multi-process deployment: a supervisor and N bot workers sharded by user.
+
+    python sharding.py
+
+The supervisor owns the public webhook (WEBHOOK_URL, WEBHOOK_PORT, ...) and
+runs SHARD_WORKERS copies of ``python bot.py`` on localhost ports starting
+at SHARD_BASE_PORT. Every update is forwarded to worker
+shard_for(user id), so one user always lands on the same process and their
+conversation state stays local to it. Workers know their shard from
+SHARD_INDEX / SHARD_COUNT: they load only their users' conversation state
+and send only their chats' outbox messages, each at its share of the
+global Telegram rate.
+
+All workers share the SQLite database in WAL mode. benchmarks/load_shards.py
+can give every worker its own file instead (per_shard_database) to measure
+the shared file's cost. That is not a deployment option: a debt with a
+counterparty on another shard, and the outbox row notifying them, live in
+the creator's file, which the counterparty's worker never reads, so the
+notification is never sent and the debt can never be accepted.
+
+Startup: the schema is migrated once, every worker must answer /readyz,
+then the front door opens and the webhook is registered. Shutdown
+(SIGTERM/SIGINT): the front door answers 503 (Telegram redelivers later),
+waits for forwards in flight, then every worker drains its own queue.
+A worker that dies is restarted; its users get 503 until it is back.
+"""
+import asyncio
+import json
+import logging
+import os
+import secrets
+import signal
+import sys
+import time
+
+import httpx
+
+from database import Database
+from webhook import (
+    SECRET_HEADER, WEBHOOK_LISTEN, WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_URL,
+    HttpError, HttpServer, json_response, webhook_secret,
+)
+
+logger = logging.getLogger(__name__)
+
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', str(os.cpu_count() or 1)))
+SHARD_BASE_PORT = int(os.getenv('SHARD_BASE_PORT', '9100'))
+# Set by the supervisor in each worker's environment
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0'))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
+IS_SHARD_WORKER = 'SHARD_INDEX' in os.environ
+
+WORKER_START_TIMEOUT = 60
+WORKER_STOP_TIMEOUT = 30
+WORKER_RESTART_DELAY = 1.0
+DEFAULT_DATABASE_PATH = '/app/data/debt_manager.db'
+
+
+def shard_for(user_id, count=SHARD_COUNT):
+    """Shard serving a user or chat id (the outbox claim uses the same formula in SQL)"""
+    return abs(user_id) % count
+
+
+def owns(user_id):
+    """Whether this process serves user_id"""
+    return SHARD_COUNT <= 1 or shard_for(user_id) == SHARD_INDEX
+
+
+def update_user_id(update):
+    """effective_user.id (else the chat id) of a raw Update dict, without parsing it into objects"""
+    for key, body in update.items():
+        if key == 'update_id' or not isinstance(body, dict):
+            continue
+        for field in ('from', 'user'):
+            if isinstance(body.get(field), dict):
+                return body[field]['id']
+        chat = body.get('chat') or (body.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+    return 0
+
+
+def shard_database_path(path, index):
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard{index}{ext}'
+
+
+class Worker:
+    """One bot process serving a shard on a localhost port"""
+
+    def __init__(self, index, count, port, command, env):
+        self.index = index
+        self.count = count
+        self.port = port
+        self.command = command
+        self.env = env
+        self.process = None
+        self.client = httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}', timeout=30)
+        self.restarts = 0
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(*self.command, env=self.env)
+        logger.info(f"Worker {self.index}/{self.count} started (pid {self.process.pid}, port {self.port})")
+
+    async def wait_ready(self, timeout=WORKER_START_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.returncode is not None:
+                raise RuntimeError(f"Worker {self.index} exited with {self.process.returncode} during startup")
+            try:
+                if (await self.client.get('/readyz')).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"Worker {self.index} not ready after {timeout}s")
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def stop(self, timeout=WORKER_STOP_TIMEOUT):
+        """SIGTERM (the worker drains its queue), SIGKILL after timeout"""
+        if self.alive:
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Worker {self.index} did not drain in {timeout}s, killing it")
+                self.process.kill()
+                await self.process.wait()
+        await self.client.aclose()
+
+
+class Supervisor(HttpServer):
+    """Front door forwarding each update to the worker of its user's shard"""
+
+    def __init__(self, workers=SHARD_WORKERS, command=None, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                 path=WEBHOOK_PATH, secret=WEBHOOK_SECRET, base_port=SHARD_BASE_PORT,
+                 per_shard_database=False, extra_env=None):
+        super().__init__(listen, port)
+        self.path = path
+        self.secret = webhook_secret(secret)
+        self.command = command or [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')]
+        self.database_path = (extra_env or {}).get('DATABASE_PATH') or os.getenv('DATABASE_PATH', DEFAULT_DATABASE_PATH)
+        if per_shard_database and command is None:
+            raise ValueError("per_shard_database is for load tests only: it loses cross-shard debts")
+        self.per_shard_database = per_shard_database
+        # Workers only accept updates carrying this, i.e. coming from the front door
+        internal_secret = secrets.token_urlsafe(24)
+        self.workers = [
+            Worker(index, workers, base_port + index, self.command,
+                   self._worker_env(index, workers, base_port + index, internal_secret, extra_env))
+            for index in range(workers)
+        ]
+        self.internal_secret = internal_secret
+        self.forwarded = 0
+        self.unavailable = 0
+        self._monitor = None
+        self.add_route(path, self._forward, 'POST')
+        self.add_route('/healthz', self._healthz)
+        self.add_route('/readyz', self._readyz)
+
+    def _worker_env(self, index, count, port, internal_secret, extra_env):
+        env = dict(os.environ, **(extra_env or {}))
+        env.pop('WEBHOOK_URL', None)  # the supervisor registers the webhook
+        global_rate = float(env.get('OUTBOX_GLOBAL_RATE', '30'))
+        env.update(
+            SHARD_INDEX=str(index),
+            SHARD_COUNT=str(count),
+            WEBHOOK_LISTEN='127.0.0.1',
+            WEBHOOK_PORT=str(port),
+            WEBHOOK_PATH=self.path,
+            WEBHOOK_SECRET=internal_secret,
+            OUTBOX_GLOBAL_RATE=str(global_rate / count),
+        )
+        if int(env.get('METRICS_PORT') or 0):
+            # Worker i serves /metrics on METRICS_PORT + 1 + i
+            env['METRICS_PORT'] = str(int(env['METRICS_PORT']) + 1 + index)
+        if self.per_shard_database:
+            env['DATABASE_PATH'] = shard_database_path(self.database_path, index)
+        return env
+
+    @property
+    def ready(self):
+        return self.accepting and all(worker.alive for worker in self.workers)
+
+    def _migrate(self):
+        """Create and migrate the schema once, before workers race to do it"""
+        paths = ([shard_database_path(self.database_path, i) for i in range(len(self.workers))]
+                 if self.per_shard_database else [self.database_path])
+        for path in paths:
+            Database(path).close()
+
+    async def start(self):
+        await asyncio.to_thread(self._migrate)
+        for worker in self.workers:
+            await worker.start()
+        await asyncio.gather(*(worker.wait_ready() for worker in self.workers))
+        await super().start()
+        self._monitor = asyncio.create_task(self._watch_workers(), name='shard-monitor')
+        logger.info(f"Supervisor ready with {len(self.workers)} workers")
+
+    async def stop(self, timeout=WORKER_STOP_TIMEOUT):
+        if self._monitor:
+            self._monitor.cancel()
+        # No new updates; forwards in flight finish first
+        await super().stop(timeout)
+        await asyncio.gather(*(worker.stop(timeout) for worker in self.workers))
+        logger.info(f"Supervisor stopped: {self.stats()}")
+
+    async def _watch_workers(self):
+        while True:
+            for worker in self.workers:
+                if worker.process.returncode is not None and self.accepting:
+                    logger.error(f"Worker {worker.index} exited with {worker.process.returncode}, restarting")
+                    await asyncio.sleep(WORKER_RESTART_DELAY)
+                    worker.restarts += 1
+                    await worker.start()
+                    try:
+                        await worker.wait_ready()
+                    except RuntimeError as e:
+                        logger.error(str(e))
+            await asyncio.sleep(1)
+
+    async def _forward(self, request):
+        if request.headers.get(SECRET_HEADER) != self.secret:
+            raise HttpError(403)
+        if not self.accepting:
+            raise HttpError(503)
+        try:
+            user_id = update_user_id(json.loads(request.body))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            raise HttpError(400) from None
+        worker = self.workers[shard_for(user_id, len(self.workers))]
+        try:
+            response = await worker.client.post(self.path, content=request.body, headers={
+                SECRET_HEADER: self.internal_secret, 'Content-Type': 'application/json',
+            })
+        except httpx.TransportError as e:
+            # Worker down or restarting: Telegram redelivers on 503
+            logger.warning(f"Worker {worker.index} unreachable: {e}")
+            self.unavailable += 1
+            raise HttpError(503) from None
+        self.forwarded += 1
+        return response.status_code, 'application/json', response.content
+
+    async def _healthz(self, request):
+        return json_response(200, {'status': 'ok'})
+
+    async def _readyz(self, request):
+        return json_response(200 if self.ready else 503, dict(self.stats(), ready=self.ready))
+
+    def stats(self):
+        return {
+            'workers': len(self.workers),
+            'alive': sum(worker.alive for worker in self.workers),
+            'restarts': sum(worker.restarts for worker in self.workers),
+            'forwarded': self.forwarded,
+            'unavailable': self.unavailable,
+        }
+
+
+async def register_webhook(url, path, secret):
+    from telegram import Bot, Update
+    async with Bot(os.environ['TELEGRAM_BOT_TOKEN']) as bot:
+        await bot.set_webhook(url=url.rstrip('/') + path, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+    logger.info("Webhook registered")
+
+
+async def run_supervisor(supervisor=None, url=WEBHOOK_URL):
+    """Run the workers behind the front door until SIGTERM or SIGINT"""
+    supervisor = supervisor or Supervisor()
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+    try:
+        await supervisor.start()
+        if url:
+            await register_webhook(url, supervisor.path, supervisor.secret)
+        await stopping.wait()
+        logger.info("Shutting down, draining workers")
+    finally:
+        await supervisor.stop()
+
+
+def main():
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL environment variable not set (sharded mode needs a webhook)")
+    if not os.getenv('TELEGRAM_BOT_TOKEN'):
+        raise ValueError("TELEGRAM_BOT_TOKEN environment variable not set")
+    asyncio.run(run_supervisor())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    main()
@@ -0,0 +1,275 @@
+"""Trace spans for the update pipeline, exported as JSONL or OTLP.
+
+Every handler runs inside an "update <handler>" root span (trace_handler).
+Stages are child spans, opened with span() or the @traced decorator, and
+each Telegram, OpenAI and database call gets one from metrics.timed().
+
+A conversation spans several updates: a voice note, then the confirm button
+minutes later, then the notification the outbox sends. ConversationStore
+saves the trace context with each state it stores, the outbox saves it with
+each queued message, and the next update resumes that trace, so the whole
+voice-to-debt flow is one trace_id.
+
+TRACE_EXPORT selects the exporter:
+    jsonl   one span per line appended to TRACE_FILE
+    otlp    OTLP/HTTP JSON batches POSTed to TRACE_OTLP_ENDPOINT
+Unset, spans are not recorded and span() costs next to nothing.
+"""
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+TRACE_EXPORT = os.getenv('TRACE_EXPORT', '')
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://127.0.0.1:4318/v1/traces')
+SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'hamyon-bot')
+EXPORT_BATCH_SIZE = 512
+EXPORT_INTERVAL = 2.0
+MAX_QUEUED_SPANS = 10000
+
+_current = ContextVar('trace_span', default=None)
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.error = None
+
+    @property
+    def context(self):
+        """(trace_id, span_id): what to store to continue this trace later"""
+        return self.trace_id, self.span_id
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_ns': self.start_ns,
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class JsonlExporter:
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+
+    def export(self, spans):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + '\n')
+
+    def close(self):
+        pass
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class OtlpExporter:
+    """OTLP/HTTP with the JSON encoding, which any OpenTelemetry collector accepts"""
+
+    def __init__(self, endpoint=TRACE_OTLP_ENDPOINT, service_name=SERVICE_NAME):
+        import httpx
+        self.endpoint = endpoint
+        self.resource = {'attributes': [{'key': 'service.name', 'value': {'stringValue': service_name}}]}
+        self.client = httpx.Client(timeout=5)
+
+    def _span(self, span):
+        return {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'parentSpanId': span.parent_id or '',
+            'name': span.name,
+            'kind': 1,  # internal
+            'startTimeUnixNano': str(span.start_ns),
+            'endTimeUnixNano': str(span.end_ns),
+            'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in span.attributes.items()],
+            'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+        }
+
+    def export(self, spans):
+        payload = {'resourceSpans': [{
+            'resource': self.resource,
+            'scopeSpans': [{'scope': {'name': 'hamyon'}, 'spans': [self._span(span) for span in spans]}],
+        }]}
+        response = self.client.post(self.endpoint, json=payload)
+        response.raise_for_status()
+
+    def close(self):
+        self.client.close()
+
+
+class BatchProcessor:
+    """Hands finished spans to the exporter in batches on a background thread"""
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.dropped = 0
+        self.exported = 0
+        self._queue = queue.Queue(MAX_QUEUED_SPANS)
+        self._thread = threading.Thread(target=self._run, name='trace-export', daemon=True)
+        self._thread.start()
+
+    def on_end(self, span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + EXPORT_INTERVAL
+            while len(batch) < EXPORT_BATCH_SIZE:
+                try:
+                    span = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if span is None:
+                    stopping = True
+                    break
+                batch.append(span)
+            if batch:
+                try:
+                    self.exporter.export(batch)
+                    self.exported += len(batch)
+                except Exception as e:
+                    self.dropped += len(batch)
+                    logger.warning(f"Could not export {len(batch)} spans: {e}")
+
+    def shutdown(self, timeout=5):
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self.exporter.close()
+        logger.info(f"Tracing stopped: {self.exported} spans exported, {self.dropped} dropped")
+
+
+def _make_processor():
+    if TRACE_EXPORT == 'jsonl':
+        return BatchProcessor(JsonlExporter())
+    if TRACE_EXPORT == 'otlp':
+        return BatchProcessor(OtlpExporter())
+    if TRACE_EXPORT:
+        logger.warning(f"Unknown TRACE_EXPORT {TRACE_EXPORT!r}, tracing disabled")
+    return None
+
+
+_processor = None
+_enabled = bool(TRACE_EXPORT)
+
+
+def _get_processor():
+    global _processor, _enabled
+    if _processor is None and _enabled:
+        _processor = _make_processor()
+        _enabled = _processor is not None
+    return _processor
+
+
+def current_context():
+    """(trace_id, span_id) of the running span, or None"""
+    span = _current.get()
+    return span.context if span is not None else None
+
+
+@contextlib.contextmanager
+def span(name, parent=None, new_trace=True, **attributes):
+    """Run the block in a child of the current span (or of parent, a stored context).
+
+    Outside any trace a new one is started, unless new_trace is False.
+    """
+    processor = _get_processor()
+    if processor is None:
+        yield None
+        return
+    if parent is None:
+        parent = current_context()
+        if parent is None and not new_trace:
+            yield None
+            return
+    trace_id, parent_id = parent if parent else (secrets.token_hex(16), None)
+    current = Span(name, trace_id, parent_id, attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _current.reset(token)
+        processor.on_end(current)
+
+
+def traced(name):
+    """Decorator running a function or coroutine function in its own span"""
+
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+
+def trace_handler(name, callback, resume=None):
+    """Wrap a handler in the update's root span; resume(update) may return a stored context to continue"""
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        parent = resume(update) if resume and _enabled else None
+        attributes = {'update_id': update.update_id, 'resumed': parent is not None}
+        if update.effective_user:
+            attributes['user_id'] = update.effective_user.id
+        with span(f'update {name}', parent=parent, **attributes):
+            return await callback(update, context)
+
+    return wrapper
+
+
+def shutdown():
+    """Export the spans still queued"""
+    if _processor is not None:
+        _processor.shutdown()
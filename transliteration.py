@@ -0,0 +1,56 @@
+"""Uzbek/Russian Cyrillic to Uzbek Latin transliteration."""
+
+CYRILLIC_TO_LATIN = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo', 'ж': 'j',
+    'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o',
+    'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'x', 'ц': 'ts',
+    'ч': 'ch', 'ш': 'sh', 'щ': 'sh', 'ъ': "'", 'ы': 'i', 'ь': '', 'э': 'e', 'ю': 'yu',
+    'я': 'ya', 'ў': "o'", 'қ': 'q', 'ғ': "g'", 'ҳ': 'h',
+}
+
+# Every apostrophe-like character Uzbek Latin text is typed with
+APOSTROPHES = "’‘ʻʼ`´"
+
+
+def to_latin(text):
+    """Transliterate Cyrillic letters to Uzbek Latin and unify apostrophes"""
+    out = []
+    for char in text:
+        lower = char.lower()
+        latin = CYRILLIC_TO_LATIN.get(lower)
+        if latin is None:
+            out.append("'" if char in APOSTROPHES else char)
+        elif char != lower and latin:
+            out.append(latin[0].upper() + latin[1:])
+        else:
+            out.append(latin)
+    return ''.join(out)
+
+
+# Spellings that sound alike in Uzbek names, applied in order by phonetic_key
+# (Murod/Murad/Мурад, Xurshid/Hurshid/Khurshid, Qodir/Kodir, G'ayrat/Gayrat)
+PHONETIC_RULES = (
+    ("o'", 'u'), ("g'", 'g'), ("'", ''), ('kh', 'h'), ('x', 'h'), ('q', 'k'),
+    ('zh', 'j'), ('dj', 'j'), ('w', 'v'), ('y', 'i'), ('o', 'a'), ('e', 'i'),
+)
+
+
+def normalize_name(text):
+    """Lowercase Latin spelling of a name with single spaces and no leading @"""
+    return ' '.join(to_latin(text).lower().lstrip('@').split())
+
+
+def phonetic_key(text):
+    """Spelling-insensitive key for a name; alike-sounding variants share it"""
+    key = normalize_name(text)
+    for old, new in PHONETIC_RULES:
+        key = key.replace(old, new)
+    key = ''.join(char for char in key if char.isalnum() or char == ' ')
+    # Doubled letters (Muhammad/Muhamad) collapse to one
+    return ''.join(char for i, char in enumerate(key) if i == 0 or char != key[i - 1])
+
+
+def trigrams(text):
+    """Set of padded trigrams of a string, for similarity lookups"""
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
@@ -0,0 +1,114 @@
+"""Concurrent update processing that keeps each user's updates in order.
+
+With PTB's default processing one slow handler (a Whisper call, say) holds
+up every other user. Plain concurrent_updates would fix that but let two
+updates from the same user race through the user_context state machine.
+PerUserUpdateProcessor runs different users in parallel, up to a limit,
+and a user's updates strictly one after another in the order received.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '16'))
+# Updates PTB may hand over at once; they wait in do_process_update, not in PTB
+MAX_QUEUED_UPDATES = 10000
+WAIT_SAMPLES = 1000
+
+
+def _ordering_key(update):
+    """Updates with the same key run in order; None means no ordering needed"""
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Up to max_concurrent users at a time, one update at a time per user"""
+
+    def __init__(self, max_concurrent=UPDATE_CONCURRENCY):
+        # The base class semaphore only bounds what PTB hands over; the real
+        # limit is taken once it is the user's turn, so an update queued behind
+        # its own user's previous one never holds a slot
+        super().__init__(MAX_QUEUED_UPDATES)
+        self.max_concurrent = max_concurrent
+        self._slots = None
+        self._tails = {}  # ordering key -> future resolved when its latest update finishes
+        self._depths = {}  # ordering key -> updates received and not finished
+        self.waiting = 0
+        self.running = 0
+        self.processed = 0
+        self.max_user_depth = 0
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+
+    async def initialize(self):
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+
+    async def shutdown(self):
+        logger.info(f"Update processor stopped: {self.stats()}")
+
+    async def do_process_update(self, update, coroutine):
+        key = _ordering_key(update)
+        received = time.monotonic()
+        previous = self._tails.get(key) if key is not None else None
+        finished = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._tails[key] = finished
+            self._depths[key] = depth = self._depths.get(key, 0) + 1
+            self.max_user_depth = max(self.max_user_depth, depth)
+
+        self.waiting += 1
+        started = False
+        try:
+            if previous is not None:
+                # Shielded: cancelling this update must not cancel the previous one's marker
+                await asyncio.shield(previous)
+            async with self._slots:
+                self.waiting -= 1
+                started = True
+                self.running += 1
+                self._waits.append(time.monotonic() - received)
+                try:
+                    await coroutine
+                finally:
+                    self.running -= 1
+                    self.processed += 1
+        finally:
+            if not started:
+                self.waiting -= 1
+            finished.set_result(None)
+            if key is not None:
+                if self._tails.get(key) is finished:
+                    del self._tails[key]
+                self._depths[key] -= 1
+                if not self._depths[key]:
+                    del self._depths[key]
+
+    def stats(self):
+        """Queue depth and wait-time gauges (waits in ms over the recent updates)"""
+        waits = sorted(self._waits)
+
+        def pct(p):
+            return round(waits[min(len(waits) - 1, int(p / 100 * len(waits)))] * 1000, 2) if waits else 0.0
+
+        return {
+            'max_concurrent': self.max_concurrent,
+            'running': self.running,
+            'waiting': self.waiting,
+            'busy_users': len(self._depths),
+            'max_user_depth': self.max_user_depth,
+            'processed': self.processed,
+            'wait_p50_ms': pct(50),
+            'wait_p99_ms': pct(99),
+            'wait_max_ms': round(waits[-1] * 1000, 2) if waits else 0.0,
+        }
@@ -0,0 +1,288 @@
+"""Webhook mode: Telegram POSTs updates to an embedded HTTP server.
+
+An alternative to Application.run_polling, enabled by setting WEBHOOK_URL
+to the bot's public HTTPS base URL. Updates arrive without long-poll delay
+and are put straight on the Application's update_queue.
+
+The same server answers:
+    GET /healthz   200 while the process is up (liveness)
+    GET /readyz    200 while updates are being accepted, 503 otherwise
+
+On SIGTERM/SIGINT the bot turns unready, stops accepting updates (Telegram
+retries anything answered with 503), lets in-flight requests finish and
+then stops the Application, which handles every update already queued.
+The webhook itself stays registered, so Telegram holds new updates until
+the next instance is up.
+
+Every update must carry the secret token registered with the webhook;
+without WEBHOOK_SECRET a random one is generated for the run, since an open
+endpoint would accept forged updates from any user.
+"""
+import asyncio
+import json
+import logging
+import os
+import secrets
+import signal
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', '8443')))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+MAX_BODY = 1 << 20  # Telegram updates are far smaller
+REQUEST_TIMEOUT = 30
+
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+
+class HttpRequest:
+    __slots__ = ('method', 'path', 'headers', 'body')
+
+    def __init__(self, method, path, headers, body):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+
+class HttpError(Exception):
+    def __init__(self, status):
+        super().__init__(REASONS.get(status, str(status)))
+        self.status = status
+
+
+def webhook_secret(secret=WEBHOOK_SECRET):
+    """secret, or a random token when none is configured"""
+    if secret:
+        return secret
+    logger.warning("WEBHOOK_SECRET not set, using a random secret token for this run")
+    return secrets.token_urlsafe(32)
+
+
+def json_response(status, payload):
+    return status, 'application/json', json.dumps(payload).encode()
+
+
+class HttpServer:
+    """Minimal asyncio HTTP/1.1 server.
+
+    Endpoints are registered with add_route(path, handler, method), where
+    handler(request) is a coroutine returning (status, content_type, body).
+    """
+
+    def __init__(self, listen, port):
+        self.listen = listen
+        self.port = port
+        self.accepting = False
+        self.routes = {}  # (method, path) -> handler
+        self._server = None
+        self._connections = set()
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def add_route(self, path, handler, method='GET'):
+        self.routes[(method, path)] = handler
+
+    @property
+    def address(self):
+        """(host, port) actually bound, useful with port=0"""
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve_connection, self.listen, self.port)
+        self.accepting = True
+        host, port = self.address
+        logger.info(f"{type(self).__name__} listening on {host}:{port}")
+
+    async def stop(self, timeout=REQUEST_TIMEOUT):
+        """Stop listening and wait for requests in flight; queued updates are left to the Application"""
+        self.accepting = False
+        if self._server is None:
+            return
+        self._server.close()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self._in_flight} webhook requests still running at shutdown")
+        for writer in list(self._connections):
+            writer.close()
+
+    async def _serve_connection(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), REQUEST_TIMEOUT)
+                except HttpError as e:
+                    await self._write(writer, *json_response(e.status, {'error': str(e)}), keep_alive=False)
+                    break
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if request is None:
+                    break
+                keep_alive = request.headers.get('connection', '').lower() != 'close' and self.accepting
+                self._in_flight += 1
+                self._idle.clear()
+                try:
+                    response = await self._dispatch(request)
+                finally:
+                    self._in_flight -= 1
+                    if not self._in_flight:
+                        self._idle.set()
+                await self._write(writer, *response, keep_alive=keep_alive)
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise HttpError(400) from None
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_BODY:
+            raise HttpError(413)
+        body = await reader.readexactly(length) if length else b''
+        return HttpRequest(method, target.split('?', 1)[0], headers, body)
+
+    async def _write(self, writer, status, content_type, body, keep_alive=True):
+        head = (f'HTTP/1.1 {status} {REASONS.get(status, "")}\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+    async def _dispatch(self, request):
+        try:
+            handler = self.routes.get((request.method, request.path))
+            if handler is None:
+                raise HttpError(405 if any(path == request.path for _, path in self.routes) else 404)
+            return await handler(request)
+        except HttpError as e:
+            return json_response(e.status, {'error': str(e)})
+
+
+class WebhookServer(HttpServer):
+    """Receives Telegram updates for an Application and answers the health checks"""
+
+    def __init__(self, application, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                 secret=WEBHOOK_SECRET):
+        super().__init__(listen, port)
+        self.application = application
+        self.path = path
+        self.secret = webhook_secret(secret)
+        self.received = 0
+        self.rejected = 0
+        self.add_route(path, self._webhook, 'POST')
+        self.add_route('/healthz', self._healthz)
+        self.add_route('/readyz', self._readyz)
+
+    @property
+    def ready(self):
+        return self.accepting and self.application.running
+
+    async def stop(self, timeout=REQUEST_TIMEOUT):
+        await super().stop(timeout)
+        logger.info(f"Webhook server stopped: {self.received} updates received, {self.rejected} rejected")
+
+    async def _webhook(self, request):
+        if request.headers.get(SECRET_HEADER) != self.secret:
+            self.rejected += 1
+            raise HttpError(403)
+        if not self.ready:
+            # Telegram redelivers the update once an instance is ready again
+            raise HttpError(503)
+        try:
+            update = Update.de_json(json.loads(request.body), self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Malformed webhook update: {e}")
+            self.rejected += 1
+            raise HttpError(400) from None
+        await self.application.update_queue.put(update)
+        self.received += 1
+        return 200, 'application/json', b'{}'
+
+    async def _healthz(self, request):
+        return json_response(200, {'status': 'ok'})
+
+    async def _readyz(self, request):
+        status = {
+            'ready': self.ready,
+            'queued_updates': self.application.update_queue.qsize(),
+            'in_flight_requests': self._in_flight,
+        }
+        processor = self.application.update_processor
+        if hasattr(processor, 'stats'):
+            status['update_processor'] = processor.stats()
+        return json_response(200 if self.ready else 503, status)
+
+
+async def start_application(application):
+    """initialize, post_init and start, as run_polling would"""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+
+async def stop_application(application):
+    """Handle every queued update, then stop and shut down with the post_ hooks"""
+    if application.running:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+async def run_webhook(application, url=WEBHOOK_URL, server=None):
+    """Serve updates over a webhook until SIGTERM or SIGINT.
+
+    With url=None the webhook is not registered; a sharding supervisor in
+    front of this process has done that.
+    """
+    server = server or WebhookServer(application)
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    await start_application(application)
+    try:
+        await server.start()
+        if url:
+            await application.bot.set_webhook(
+                url=url.rstrip('/') + server.path,
+                secret_token=server.secret,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info("Webhook registered")
+        logger.info("Bot is ready")
+        await stopping.wait()
+        logger.info("Shutting down, draining in-flight updates")
+    finally:
+        await server.stop()
+        await stop_application(application)